@@ -0,0 +1,42 @@
+"""Convert "P13 standard" spectrum files to touchstone files (.sNp).
+
+Usage: p13pt-touchstone [-h] [-o DESTINATION] [-j PROCESSES] [-f] path [path ...]
+
+Each path can be a file or a folder. Folders are converted in parallel.
+Files that are already up to date are skipped, unless -f is given.
+"""
+from __future__ import print_function
+import os
+import argparse
+
+from P13pt.rfspectrum import convert_to_touchstone, convert_folder_to_touchstone, p13_nports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert "P13 standard" spectrum files to touchstone files.')
+    parser.add_argument('paths', metavar='path', nargs='+', help='spectrum file or folder')
+    parser.add_argument('-o', '--destination', help='folder for the touchstone files (default: same folder)')
+    parser.add_argument('-j', '--processes', type=int, help='number of processes (default: number of CPUs)')
+    parser.add_argument('-f', '--force', action='store_true', help='also convert files that are up to date')
+    args = parser.parse_args()
+
+    if args.destination and not os.path.isdir(args.destination):
+        os.makedirs(args.destination)
+
+    for path in args.paths:
+        if os.path.isdir(path):
+            converted = convert_folder_to_touchstone(path, args.destination, args.processes, args.force)
+            print(path+':', len(converted), 'file(s) converted')
+        else:
+            folder = args.destination if args.destination else os.path.dirname(path)
+            newfilename = os.path.join(folder, os.path.splitext(os.path.basename(path))[0]+'.s{}p'.format(p13_nports(path)))
+            if (not args.force and os.path.exists(newfilename) and
+                    os.path.getmtime(newfilename) >= os.path.getmtime(path)):
+                print(path+': up to date')
+                continue
+            convert_to_touchstone(path, newfilename)
+            print(path, '->', newfilename)
+
+
+if __name__ == '__main__':
+    main()
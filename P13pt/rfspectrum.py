@@ -6,6 +6,11 @@ for more detail.
 
 * Adding P13 spectrum file format support to the base class.
 * Adding P13 style thru deembedding support to the base class.
+* ThruDeembedder: thru de-embedding with a cached half-thru inverse.
+* SidecarCache: binary cache of parsed "P13 standard" files.
+* NetworkStack: array-backed container for whole sweeps of spectra.
+* Resampler: interpolation of spectra onto a different frequency grid.
+* convert_to_stack: memory mapped binary version of multi-spectrum files.
 
 De-embedding algorithm and original idea: Andreas Inhofer
 
@@ -17,11 +22,21 @@ from matplotlib import pyplot as plt
 from scipy.linalg import sqrtm
 from numpy.linalg import inv
 from .params_from_filename import params_from_filename
-from copy import deepcopy
+from copy import copy, deepcopy
+from collections import OrderedDict
+from itertools import islice
+import hashlib
 import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import warnings
 import skrf
 from skrf import a2s as abcd2s
 from skrf import s2a as s2abcd        
+from skrf import s2y, s2z, y2s, z2s
 
 # compatible with scikit-rf version 0.14.5
 class Network(skrf.Network):
@@ -35,11 +50,13 @@ class Network(skrf.Network):
     Refer to scikit-rf's documentation for more detail.
     """
     def __init__(self, file=None, params=None, z0=50.0, **kwargs):
-        self.params = dict()
+        # the parameters dictionary is only assigned after calling the base
+        # class constructor, since recent versions of scikit-rf overwrite it
+        file_params = dict()
          
         if file:
             # update parameters dictionary from filename
-            self.params.update(params_from_filename(file))       
+            file_params.update(params_from_filename(file))
     
             # in the following, we will check if we let skrf handle the file
             # or if we do it ourselves
@@ -65,34 +82,24 @@ class Network(skrf.Network):
                 # call base class constructor
                 super(Network, self).__init__(z0=z0)
                 # read S parameters from file
-                # we will assume the file is compatible with numpy.genfromtxt,
-                # that we are dealing with a 2 port network and the values
-                # are stored in the order f, Real(S11), Imag(S11) and so forth
-                # for S12, S21, S22 ("P13 standard")
-                if ext == 'dat':       # Matthieu Dartiailh's file format
-                    # get rid of first row of data since it corresponds to the column headers
-                    self.raw = np.genfromtxt(file)[1:].T
-                else:
-                    self.raw = np.genfromtxt(file).T
-                
-                if len(self.raw) != 9:
-                    raise Exception('Invalid number of columnns')
+                # we will assume that we are dealing with a 2 port network
+                # and the values are stored in the order f, Real(S11),
+                # Imag(S11) and so forth for S12, S21, S22 ("P13 standard")
+                f, s = spectrum_cache.read(file, skip_header=(ext == 'dat'))
                 
                 self.frequency.unit = 'hz'
-                self.f = self.raw[0]
+                self.f = f
                 self.name = os.path.basename(os.path.splitext(file)[0])                
                 
-                # S-matrix is created as a len(f)x2x2 matrix, see below for
-                # a comment on this shape
-                self.s = np.empty((len(self.f),2,2), dtype=complex)
-                self.s[:,0,0] = self.raw[1] + 1j*self.raw[2]
-                self.s[:,0,1] = self.raw[3] + 1j*self.raw[4]
-                self.s[:,1,0] = self.raw[5] + 1j*self.raw[6]
-                self.s[:,1,1] = self.raw[7] + 1j*self.raw[8]
+                # S-matrix is a len(f)x2x2 matrix
+                self.s = s
             
         else:
             # pass all arguments to skrf constructor
             super(Network, self).__init__(z0=z0, **kwargs)
+
+        self.params = file_params
+        self.file = os.path.abspath(file) if file else None
         
         # update parameters dictionary from function argument
         if params is not None:
@@ -103,6 +110,128 @@ class Network(skrf.Network):
         # omega is calculated automatically in base class using Frequency class
         return self.frequency.w
 
+    # Memoized S, Y and Z representations
+    #
+    # The representation that was assigned last (s, y or z) is authoritative,
+    # the other ones are converted from it on first access and then kept
+    # until the next assignment to s, y, z or z0. This avoids converting back
+    # and forth when e.g. the Y matrix is read repeatedly or modified with
+    # ``ntwk.y -= dummy.y``. Note that modifying an array in place without
+    # assigning it back (``ntwk.s[:, 0, 0] = 0``) does not update the other
+    # representations; call :meth:`invalidate` in that case. As the cached
+    # arrays are returned without copying, ``ntwk.y -= dummy.y`` also
+    # modifies arrays previously obtained from ``ntwk.y``.
+    #
+    # The class attribute conversion_stats counts the conversions that were
+    # calculated and the ones that were avoided by returning a cached result
+    # (networks are also converted by worker threads, hence the lock).
+    conversion_stats = {'conversions': 0, 'avoided': 0}
+    _stats_lock = threading.Lock()
+
+    _from_s = {'y': s2y, 'z': s2z}
+    _to_s = {'y': y2s, 'z': z2s}
+
+    @classmethod
+    def reset_conversion_stats(cls):
+        with Network._stats_lock:
+            Network.conversion_stats = {'conversions': 0, 'avoided': 0}
+
+    @staticmethod
+    def _count(key, n=1):
+        with Network._stats_lock:
+            Network.conversion_stats[key] += n
+
+    def _get_repr(self, name):
+        reprs = self.__dict__.get('_reprs')
+        if not reprs:
+            # nothing assigned yet (scikit-rf relies on hasattr(self, '_s'))
+            raise AttributeError('_'+name)
+        if name in reprs:
+            if name != self._authoritative:
+                self._count('avoided')
+            return reprs[name]
+        kwargs = dict(s_def=self.s_def) if getattr(self, 's_def', None) else dict()
+        if 's' not in reprs:
+            reprs['s'] = self._to_s[self._authoritative](reprs[self._authoritative],
+                                                         self.z0, **kwargs)
+            self._count('conversions')
+        if name != 's':
+            reprs[name] = self._from_s[name](reprs['s'], self.z0, **kwargs)
+            self._count('conversions')
+        return reprs[name]
+
+    def _set_repr(self, name, value):
+        value = np.array(value, dtype=complex)
+        if value.ndim < 3:
+            value = value.reshape((-1, 1, 1) if value.ndim < 2 else (1,)+value.shape)
+        # always bind a new dictionary, shallow copies may share the old one
+        self.__dict__['_reprs'] = {name: value}
+        self.__dict__['_authoritative'] = name
+        if np.ndim(self.z0) == 0:
+            # broadcast scalar impedance to the number of frequencies and
+            # ports (without going through the setter, which needs S)
+            self.__dict__['_z0'] = np.full(value.shape[:2], self.z0, dtype=complex)
+
+    def invalidate(self):
+        """Drop the cached representations derived from the authoritative one.
+
+        Needs to be called after the authoritative array was modified in
+        place.
+        """
+        reprs = self.__dict__.get('_reprs')
+        if reprs:
+            self.__dict__['_reprs'] = {self._authoritative: reprs[self._authoritative]}
+
+    @property
+    def _s(self):
+        return self._get_repr('s')
+
+    @_s.setter
+    def _s(self, value):
+        self._set_repr('s', value)
+
+    @property
+    def s(self):
+        return self._get_repr('s')
+
+    @s.setter
+    def s(self, value):
+        self._set_repr('s', value)
+
+    @property
+    def y(self):
+        return self._get_repr('y')
+
+    @y.setter
+    def y(self, value):
+        self._set_repr('y', value)
+
+    @property
+    def z(self):
+        return self._get_repr('z')
+
+    @z.setter
+    def z(self, value):
+        self._set_repr('z', value)
+
+    @property
+    def z0(self):
+        return skrf.Network.z0.fget(self)
+
+    @z0.setter
+    def z0(self, value):
+        if self.__dict__.get('_reprs'):
+            # S is the reference representation when the port impedance
+            # changes (as in scikit-rf), so it becomes authoritative
+            self.__dict__['_reprs'] = {'s': self._get_repr('s')}
+            self.__dict__['_authoritative'] = 's'
+        skrf.Network.z0.fset(self, value)
+
+    def renumber(self, from_ports, to_ports):
+        super(Network, self).renumber(from_ports, to_ports)
+        # the base class reorders S in place
+        self.invalidate()
+
     def deembed_thru(self, thru):
         """De-embed the propagation towards the active region of the DUT.
         
@@ -110,6 +239,19 @@ class Network(skrf.Network):
         root of the ABCD matrix of the thru network. The inverse of the result
         is multiplied on both sides of the DUT ABCD matrix, which is then
         converted back to S.
+
+        Networks with more than two ports (e.g. 4-port differential
+        structures) are handled with block ABCD matrices, the first half of
+        the ports being on the input side and the second half on the output
+        side (see :func:`s2abcd_block`).
+
+        All frequency points are treated at once: the square root is
+        calculated for the whole stack of matrices (in closed form for 2x2
+        matrices, see :func:`sqrtm_stack`), the inversion and the
+        multiplications are batched.
+        The half-thru inverse is computed once per thru and kept by
+        :class:`ThruDeembedder`, so that de-embedding many DUTs with the
+        same thru does not repeat this calculation.
     
         Arguments
         ---------
@@ -121,20 +263,68 @@ class Network(skrf.Network):
         dut_deembedded : Network object
             the deembedded DUT network
         """
-        dut_abcd = s2abcd(self.s)
+        return ThruDeembedder.for_thru(thru).deembed(self)
+
+    def deembed_thru_reference(self, thru):
+        """Reference implementation of :meth:`deembed_thru`.
+
+        Calculates the matrix square root and the inverse frequency point by
+        frequency point with scipy and numpy. This is slow, but it is kept to
+        validate the batched implementation.
+        """
+        dut_abcd = _to_abcd(self.s)
         # the list(...) in the following are for python 3
-        half_thru_abcd = np.array(list(map(sqrtm, s2abcd(thru.s))))
+        half_thru_abcd = np.array(list(map(sqrtm, _to_abcd(thru.s))))
         half_thru_inv = np.array(list(map(inv, half_thru_abcd)))
         three_mat_multiplication = lambda x,y,z: np.dot(np.dot(x,y),z)
         deembedded_abcd = np.array(list(map(three_mat_multiplication,
                                       half_thru_inv, dut_abcd, half_thru_inv)))
         dut_deembedded = deepcopy(self)
-        dut_deembedded.s = abcd2s(deembedded_abcd)
+        dut_deembedded.s = _from_abcd(deembedded_abcd)
         
         return dut_deembedded
 
+    def resample(self, f, mode='magphase'):
+        """Interpolate the network onto a new frequency grid.
+
+        Arguments
+        ---------
+        f : numpy array
+            the new frequencies, which have to lie within the frequency range
+            of the network
+        mode : string
+            'magphase' to interpolate magnitude and phase, 'ri' to
+            interpolate real and imaginary part
+
+        Returns
+        -------
+        Network object
+        """
+        s = Resampler.for_grids(self.f, f)(self.s, mode=mode)
+        return Network(f=f, s=s, z0=np.asarray(self.z0).flat[0], name=self.name, params=self.params)
+
+    def _with_s(self, s):
+        """Create a copy of the network with a new S matrix.
+
+        In contrast to deepcopy, only the frequency and the parameters
+        dictionary are duplicated, the S matrix is replaced by ``s``.
+        """
+        return self._with_repr('s', s)
+
+    def _with_y(self, y):
+        """Create a copy of the network with a new Y matrix, see :meth:`_with_s`."""
+        return self._with_repr('y', y)
+
+    def _with_repr(self, name, value):
+        ntwk = copy(self)
+        ntwk.frequency = self.frequency     # the frequency setter makes a copy
+        ntwk.params = dict(self.params)
+        ntwk.file = None                    # the S matrix is no longer the file content
+        setattr(ntwk, name, value)
+        return ntwk
+
     def plot_mat(self, parameter='s', fig=None, ylim=1.1, label=None, scale=1., unit=None):
-        """Plot selected parameter (S, Y) in a 2x2 panel.
+        """Plot selected parameter (S, Y) in a PxP panel for P ports.
     
         Arguments
         ----------
@@ -155,10 +345,11 @@ class Network(skrf.Network):
         matrix = getattr(self, parameter)
         if fig is None:
             fig = plt.figure(figsize=(15.0, 10.0))
-        for i in range(2):
-            for j in range(2):
-                subplotnum = 2*i+j+1 # add_subplot needs the +1 as indexing starts with 1
-                ax = fig.add_subplot(2,2,subplotnum)
+        nports = matrix.shape[-1]
+        for i in range(nports):
+            for j in range(nports):
+                subplotnum = nports*i+j+1 # add_subplot needs the +1 as indexing starts with 1
+                ax = fig.add_subplot(nports,nports,subplotnum)
                 ax.plot(self.f/1e9, matrix[:,i,j].real/scale, label=('Re '+label if label else None))
                 ax.plot(self.f/1e9, matrix[:,i,j].imag/scale, label=('Im '+label if label else None))
                 ax.set_xlabel('f [GHz]')
@@ -173,17 +364,1062 @@ class Network(skrf.Network):
 
 # for compatibility with old name
 rfspectrum = Network
+
+
+def read_p13(filename, skip_header=False):
+    """Read a "P13 standard" spectrum file.
+
+    The file contains the columns f, Real(S11), Imag(S11), Real(S12),
+    Imag(S12), Real(S21), Imag(S21), Real(S22), Imag(S22), separated by
+    whitespace. Networks with P ports have 1+2*P^2 columns, the S matrix
+    elements being saved row by row (S11, S12, ..., S1P, S21, ...). Comment
+    lines (starting with "#") are only allowed at the beginning of the file.
+
+    The numbers are parsed in a single pass with numpy's bulk text parser and
+    the S parameters are copied directly into the memory of the complex S
+    matrix.
+
+    Arguments
+    ----------
+    filename : string
+        File name of the "P13 standard" file.
+    skip_header : bool
+        Skip the first non-comment line, which contains the column headers
+        (e.g. in Matthieu Dartiailh's ".dat" format).
+
+    Returns
+    -------
+    f : numpy array of shape (N,)
+        The frequencies.
+    s : numpy array of shape (N, P, P)
+        The S matrix.
+
+    """
+    with open(filename, 'r') as fid:
+        # skip comments and empty lines, and find the number of columns
+        line = fid.readline()
+        while line and (not line.strip() or line.lstrip().startswith('#')):
+            line = fid.readline()
+        if skip_header:
+            line = fid.readline()
+        ncols = len(line.split())
+        text = line + fid.read()
+
+    nports = _nports(ncols)
+    values = _parse_numbers(text, filename)
+    if values.size % ncols:
+        raise Exception('Invalid number of values')
+
+    data = values.reshape(-1, ncols)
+    f = data[:, 0].copy()
+    s = np.empty((len(data), nports, nports), dtype=complex)
+    # the memory layout of the complex S matrix is the same as the column
+    # order of the file: Real(S11), Imag(S11), Real(S12), ...
+    s.view(float).reshape(len(data), ncols-1)[:] = data[:, 1:]
+    return f, s
+
+
+def _nports(ncols):
+    """Number of ports of a "P13 standard" file with ncols columns."""
+    nports = int(round(np.sqrt(max(ncols-1, 0)/2.)))
+    if nports < 1 or 1+2*nports**2 != ncols:
+        raise Exception('Invalid number of columnns')
+    return nports
+
+
+_WHITESPACE = np.frombuffer(b' \t\n\r\x0b\x0c', dtype=np.uint8)
+
+def _parse_numbers(text, filename):
+    """Parse whitespace separated numbers into a flat array."""
+    # numpy stops (with a warning) at the first token it cannot parse, so the
+    # tokens are counted: changing the warning filters is not thread-safe and
+    # the files are also read by worker threads
+    chars = np.frombuffer(text.encode('latin-1', 'replace'), dtype=np.uint8)
+    space = np.isin(chars, _WHITESPACE)
+    count = int(np.count_nonzero(~space[1:] & space[:-1])) + int(len(chars) > 0 and not space[0])
+    try:
+        values = np.fromstring(text, sep=' ')
+        if count:
+            # an error in the last token does not change the number of values
+            float(text[-64:].split()[-1])
+    except (DeprecationWarning, ValueError):
+        raise Exception('Could not parse file: '+filename)
+    if len(values) != count:
+        raise Exception('Could not parse file: '+filename)
+    return values
+
+
+def read_p13_reference(filename, skip_header=False):
+    """Reference implementation of :func:`read_p13` based on
+    numpy.genfromtxt. This is slow, but it is kept for validation and
+    benchmarking."""
+    if skip_header:
+        # get rid of first row of data since it corresponds to the column headers
+        raw = np.genfromtxt(filename)[1:].T
+    else:
+        raw = np.genfromtxt(filename).T
+
+    nports = _nports(len(raw))
+    s = np.empty((len(raw[0]), nports, nports), dtype=complex)
+    for k in range(nports**2):
+        s[:, k//nports, k%nports] = raw[1+2*k] + 1j*raw[2+2*k]
+    return raw[0], s
+
+
+def user_cache_dir():
+    """Get the directory for the cache files of P13pt in the cache directory
+    of the user (e.g. ~/.cache/P13pt on Linux)."""
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), 'AppData', 'Local')
+    elif sys.platform == 'darwin':
+        base = os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'P13pt', 'spectra')
+
+
+class SidecarCache(object):
+    """Binary cache of parsed "P13 standard" spectrum files.
+
+    When a spectrum file is parsed for the first time, the frequencies and the
+    S matrix are written to a binary ".npy" sidecar file, which is memory
+    mapped the next time the same file is read. By default, sidecars are saved
+    in the cache directory of the user (see :func:`user_cache_dir`), so that
+    nothing is written to the data folders, but they can also be sent to
+    another directory or saved in a hidden ".p13cache" subfolder next to the
+    spectrum files.
+
+    The size and modification time of the source file are stored in the
+    sidecar and the sidecar is only used if they still match. To avoid caching
+    a file that is still being written (e.g. during an acquisition), the
+    source is only cached if it did not change while it was parsed and if it
+    was last modified more than ``min_age`` seconds ago. The parameters are
+    not stored, since they are always extracted from the file name.
+
+    The module-level instance ``spectrum_cache`` is used by :class:`Network`.
+    Its initial configuration is taken from the environment variable
+    P13PT_SPECTRUM_CACHE: "off" (or "0") disables the cache, "local" saves the
+    sidecars next to the spectrum files and a path sends them to that
+    directory.
+
+    Arguments
+    ---------
+    enabled : bool
+        switch the cache on or off
+    directory : string or None
+        directory for the sidecar files, None for the cache directory of the
+        user
+    local : bool
+        save the sidecar files in a subfolder next to the spectrum files
+        (directory is ignored)
+    """
+    version = 1
+    subfolder = '.p13cache'
+    min_age = 2.        # seconds
+
+    def __init__(self, enabled=True, directory=None, local=False):
+        self.enabled = enabled
+        self.directory = directory
+        self.local = local
+
+    @classmethod
+    def from_env(cls, variable='P13PT_SPECTRUM_CACHE'):
+        setting = os.environ.get(variable, '').strip()
+        if setting.lower() in ['0', 'off', 'no', 'false']:
+            return cls(enabled=False)
+        elif setting.lower() in ['', '1', 'on', 'yes', 'true']:
+            return cls()
+        elif setting.lower() == 'local':
+            return cls(local=True)
+        else:
+            return cls(directory=setting)
+
+    def path(self, filename):
+        """Get the file name of the sidecar of a spectrum file."""
+        filename = os.path.abspath(filename)
+        basename = os.path.basename(filename)
+        if self.local:
+            return os.path.join(os.path.dirname(filename), self.subfolder, basename+'.npy')
+        # files from different folders may have the same name
+        prefix = hashlib.md5(filename.encode('utf-8')).hexdigest()[:12]
+        directory = self.directory if self.directory is not None else user_cache_dir()
+        return os.path.join(directory, prefix+'_'+basename+'.npy')
+
+    def load(self, filename):
+        """Load the cached data of a spectrum file.
+
+        Returns
+        -------
+        (f, s) or None if there is no valid sidecar
+        """
+        try:
+            stat = os.stat(filename)
+            table = np.load(self.path(filename), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            header = table[0].real
+            if (header[0] != self.version or header[1] != stat.st_size or
+                    header[2] != stat.st_mtime):
+                return None
+            nports = int(round(np.sqrt(table.shape[1]-1)))
+            # copy the data, so that the memory map is released and the
+            # sidecar can be replaced (which is not possible on Windows
+            # while it is mapped)
+            f = np.array(table[1:, 0].real)
+            s = np.array(table[1:, 1:]).reshape(-1, nports, nports)
+        except (IndexError, ValueError):
+            return None
+        finally:
+            del table
+        return f, s
+
+    def store(self, filename, f, s, stat):
+        """Write the sidecar of a spectrum file.
+
+        Arguments
+        ---------
+        filename : string
+            the spectrum file
+        f, s : numpy arrays
+            the data read from the file
+        stat : os.stat_result
+            the status of the file before it was read
+
+        Returns
+        -------
+        True if the sidecar was written
+        """
+        current = os.stat(filename)
+        if ((current.st_size, current.st_mtime) != (stat.st_size, stat.st_mtime) or
+                time.time() - stat.st_mtime < self.min_age):
+            return False
+        table = np.empty((len(f)+1, 1+s.shape[1]*s.shape[2]), dtype=complex)
+        table[0] = 0.
+        table[0, :3] = self.version, stat.st_size, stat.st_mtime
+        table[1:, 0] = f
+        table[1:, 1:] = s.reshape(len(f), -1)
+        sidecar = self.path(filename)
+        try:
+            folder = os.path.dirname(sidecar)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            # write to a temporary file first, so that the sidecar is replaced
+            # atomically and never read while it is incomplete
+            fd, tmp = tempfile.mkstemp(suffix='.npy', dir=folder)
+        except (IOError, OSError):
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as fid:
+                np.save(fid, table)
+            getattr(os, 'replace', os.rename)(tmp, sidecar)   # no os.replace in python 2
+        except (IOError, OSError):
+            os.remove(tmp)
+            return False
+        return True
+
+    def read(self, filename, skip_header=False):
+        """Read a "P13 standard" file, using the sidecar if it is valid and
+        creating it otherwise. See :func:`read_p13` for the arguments."""
+        if not self.enabled:
+            return read_p13(filename, skip_header)
+        data = self.load(filename)
+        if data is None:
+            stat = os.stat(filename)
+            data = read_p13(filename, skip_header)
+            self.store(filename, data[0], data[1], stat)
+        return data
+
+
+spectrum_cache = SidecarCache.from_env()
+
+
+def grid_key(f):
+    """Hashable key identifying a frequency grid.
+
+    Frequencies are rounded to the mHz, since the values saved in different
+    file formats sometimes differ slightly.
+    """
+    f = np.round(np.asarray(f, dtype=float)*1e3).astype(np.int64)
+    return len(f), hashlib.md5(f.tobytes()).hexdigest()
+
+
+def _flat(func, m, *args):
+    """Apply a scikit-rf conversion (which expects (N,P,P) arrays) to a
+    stack of arbitrary leading shape (..., P, P)."""
+    m = np.asarray(m)
+    return func(m.reshape((-1,)+m.shape[-2:]), *args).reshape(m.shape)
+
+
+class ThruDeembedder(object):
+    """Thru de-embedding with a precomputed half-thru inverse.
+
+    The inverse of the "half thru" ABCD matrix (see
+    :meth:`Network.deembed_thru`) is calculated once on construction and can
+    then be applied to any number of DUT networks or S matrix stacks with a
+    single batched matrix multiplication.
+
+    Use :meth:`for_thru` to get an instance from a small cache keyed by the
+    thru file and its frequency grid.
+
+    Arguments
+    ---------
+    thru : Network object
+        the thru network
+    """
+    cache_size = 8
+    grid_cache_size = 8     # de-embedders for other frequency grids kept by each instance, see on_grid
+    _cache = OrderedDict()
+    _lock = threading.Lock()    # de-embedders are also requested by worker threads
+
+    def __init__(self, thru):
+        self.file = getattr(thru, 'file', None)
+        self.f = np.array(thru.f)
+        self.s = np.array(thru.s)
+        self.grid = grid_key(self.f)
+        self.half_thru_inv = np.linalg.inv(sqrtm_stack(_to_abcd(self.s)))
+        self._on_grid = OrderedDict()
+
+    @staticmethod
+    def key(thru):
+        """Cache key of a thru network, or None if it should not be cached.
+
+        Only networks that were read from a file are cached. Besides the file
+        name, its modification time, the frequency grid and a few S matrix
+        samples are part of the key, so that a rewritten or modified thru is
+        not mistaken for the cached one.
+        """
+        file = getattr(thru, 'file', None)
+        if not file:
+            return None
+        try:
+            mtime = os.path.getmtime(file)
+        except OSError:
+            return None
+        samples = thru.s[[0, len(thru.s)//2, -1]]
+        return file, mtime, grid_key(thru.f), samples.tobytes()
+
+    @classmethod
+    def for_thru(cls, thru):
+        """Get the de-embedder of a thru network, reusing a cached one if
+        the same thru was used before."""
+        key = cls.key(thru)
+        if key is None:
+            return cls(thru)
+        with cls._lock:
+            deembedder = cls._cache.pop(key, None)
+            if deembedder is None:
+                deembedder = cls(thru)
+            cls._cache[key] = deembedder        # (re-)insert as most recently used
+            while len(cls._cache) > cls.cache_size:
+                cls._cache.popitem(last=False)
+        return deembedder
+
+    @property
+    def number_of_ports(self):
+        return self.s.shape[-1]
+
+    def compatible(self, f):
+        """Check if the frequency grid f is the one of the thru."""
+        return grid_key(f) == self.grid
+
+    def on_grid(self, f, mode='magphase'):
+        """Get a de-embedder for the frequency grid f.
+
+        If f is not the grid of the thru, the thru S matrix is interpolated
+        onto f (see :class:`Resampler`). The de-embedders of the last
+        grid_cache_size grids are kept, so that all DUTs on the same grid
+        reuse them.
+        """
+        key = grid_key(f), mode
+        if key[0] == self.grid:
+            return self
+        with self._lock:
+            deembedder = self._on_grid.pop(key, None)
+            if deembedder is None:
+                resampled = Network(f=f, s=Resampler.for_grids(self.f, f)(self.s, mode=mode))
+                deembedder = ThruDeembedder(resampled)
+            self._on_grid[key] = deembedder     # (re-)insert as most recently used
+            while len(self._on_grid) > self.grid_cache_size:
+                self._on_grid.popitem(last=False)
+        return deembedder
+
+    def deembed_abcd(self, abcd):
+        """De-embed a stack of ABCD matrices of shape (..., N, P, P)."""
+        if np.shape(abcd)[-3] != len(self.f):
+            raise ValueError('Frequency grids of thru and DUT do not match')
+        return np.matmul(np.matmul(self.half_thru_inv, abcd), self.half_thru_inv)
+
+    def deembed_s(self, s):
+        """De-embed a stack of S matrices of shape (..., N, P, P)."""
+        return _from_abcd(self.deembed_abcd(_to_abcd(s)))
+
+    def deembed(self, dut):
+        """De-embed a DUT network.
+
+        Returns
+        -------
+        dut_deembedded : Network object
+            the deembedded DUT network
+        """
+        return dut._with_s(self.deembed_s(dut.s))
+
+
+class Resampler(object):
+    """Linear interpolation from one frequency grid onto another.
+
+    The interpolation indices and weights are calculated once for a pair of
+    grids and then applied to any number of spectra (S, Y or ABCD stacks of
+    arbitrary leading shape) with vectorized operations. Use
+    :meth:`for_grids` to reuse the resamplers of previously used grid pairs.
+
+    Complex values are either interpolated in real and imaginary part
+    ('ri'), or in magnitude and phase ('magphase'), which is better suited
+    for the phase rotation of transmission lines.
+
+    Arguments
+    ---------
+    f_from : numpy array
+        the source grid (in ascending order)
+    f_to : numpy array
+        the target grid, which has to lie within the source grid
+    """
+    cache_size = 16
+    tolerance = 1e-3    # Hz, c.f. grid_key
+    _cache = OrderedDict()
+    _lock = threading.Lock()    # resamplers are also requested by worker threads
+
+    def __init__(self, f_from, f_to):
+        f_from = np.asarray(f_from, dtype=float)
+        f_to = np.asarray(f_to, dtype=float)
+        if not self.covers(f_from, f_to):
+            raise ValueError('Target frequencies outside of the source frequency range')
+        index = np.clip(np.searchsorted(f_from, f_to, side='right')-1, 0, len(f_from)-2)
+        weight = (f_to-f_from[index])/(f_from[index+1]-f_from[index])
+        self.index = index
+        self.weight = np.clip(weight, 0., 1.)
+        self.n_from = len(f_from)
+
+    @classmethod
+    def covers(cls, f_from, f_to):
+        """Check if the grid f_from covers the range of f_to."""
+        return (len(f_from) > 1 and np.min(f_to) >= f_from[0]-cls.tolerance and
+                np.max(f_to) <= f_from[-1]+cls.tolerance)
+
+    @classmethod
+    def for_grids(cls, f_from, f_to):
+        """Get the resampler for a pair of grids, reusing a cached one if the
+        same pair was used before."""
+        key = grid_key(f_from), grid_key(f_to)
+        with cls._lock:
+            resampler = cls._cache.pop(key, None)
+            if resampler is None:
+                resampler = cls(f_from, f_to)
+            cls._cache[key] = resampler         # (re-)insert as most recently used
+            while len(cls._cache) > cls.cache_size:
+                cls._cache.popitem(last=False)
+        return resampler
+
+    def __call__(self, data, axis=-3, mode='ri'):
+        """Interpolate data along the frequency axis.
+
+        Arguments
+        ---------
+        data : numpy array
+            the data, e.g. of shape (N, P, P) or (M, N, P, P)
+        axis : int
+            the frequency axis of data (the default is correct for matrix
+            stacks, use -1 for vectors)
+        mode : string
+            'ri' or 'magphase'
+
+        Returns
+        -------
+        numpy array
+        """
+        data = np.asarray(data)
+        if data.shape[axis] != self.n_from:
+            raise ValueError('Data does not match the source frequency grid')
+        low = np.take(data, self.index, axis=axis)
+        high = np.take(data, self.index+1, axis=axis)
+        shape = [1]*data.ndim
+        shape[axis] = len(self.index)
+        weight = self.weight.reshape(shape)
+        if mode == 'ri':
+            return low + weight*(high-low)
+        elif mode == 'magphase':
+            magnitude = np.abs(low) + weight*(np.abs(high)-np.abs(low))
+            # the phase difference is wrapped to [-pi, pi]
+            phase = np.angle(low) + weight*np.angle(high*np.conj(low))
+            return magnitude*np.exp(1j*phase)
+        else:
+            raise ValueError('Invalid interpolation mode: '+str(mode))
+
+
+def params_array(params_list):
+    """Convert a list of parameter dictionaries (see params_from_filename)
+    to a numpy structured array.
+
+    There is one field per parameter name. Parameters whose values can all be
+    converted to float get a float field (NaN where the value is missing),
+    the timestamp gets a datetime64 field, parameters without value (flags)
+    get a boolean field that tells if the flag is set, all others get a
+    string field.
+    """
+    names = []
+    for params in params_list:
+        names += [name for name in params if name not in names]
+
+    fields = []
+    columns = []
+    for name in names:
+        values = [params.get(name) for params in params_list]
+        present = [v for v in values if v is not None]
+        if not present:
+            dtype, column = bool, [name in params for params in params_list]
+        elif name == 'timestamp':
+            dtype = 'datetime64[s]'
+            column = [np.datetime64(v, 's') if v is not None else np.datetime64('NaT') for v in values]
+        else:
+            try:
+                column = [float(v) if v is not None else np.nan for v in values]
+                dtype = float
+            except ValueError:
+                column = [str(v) if v is not None else '' for v in values]
+                dtype = 'U{}'.format(max(len(v) for v in column))
+        fields.append((str(name), dtype))
+        columns.append(column)
+
+    array = np.empty(len(params_list), dtype=fields)
+    for (name, dtype), column in zip(fields, columns):
+        array[name] = column
+    return array
+
+
+class NetworkStack(object):
+    """Stack of networks sharing the same frequency grid.
+
+    The S matrices of M networks with N frequency points and P ports are
+    held in a single (M, N, P, P) array and the parameters extracted from the
+    file names in a structured array with one entry per network (see
+    :func:`params_array`). Conversions, de-embedding and selections operate
+    on the whole stack at once.
+
+    Arguments
+    ---------
+    f : numpy array of shape (N,)
+        the frequencies shared by all networks
+    s : numpy array of shape (M, N, P, P)
+        the S matrices
+    params : numpy structured array of shape (M,) or None
+        the parameters of the networks
+    names : list of strings or None
+        the names of the networks
+    z0 : float
+        the characteristic impedance of all ports
+    """
+    def __init__(self, f, s, params=None, names=None, z0=50.):
+        self.f = np.asarray(f, dtype=float)
+        self.s = np.asanyarray(s, dtype=complex)     # keeps memory maps
+        if self.s.ndim != 4 or self.s.shape[1] != len(self.f):
+            raise ValueError('S matrix stack must have the shape (M, len(f), P, P)')
+        self.params = params if params is not None else params_array([{}]*len(self.s))
+        self.names = list(names) if names is not None else ['']*len(self.s)
+        self.z0 = z0
+
+    @classmethod
+    def from_networks(cls, networks):
+        """Create a stack from a list of networks with the same frequency grid."""
+        if not networks:
+            raise ValueError('Cannot create an empty stack')
+        grid = grid_key(networks[0].f)
+        for ntwk in networks:
+            if grid_key(ntwk.f) != grid:
+                raise ValueError('Network '+str(ntwk.name)+' is not on the same frequency grid')
+        return cls(networks[0].f, [ntwk.s for ntwk in networks],
+                   params_array([getattr(ntwk, 'params', {}) or {} for ntwk in networks]),
+                   [ntwk.name for ntwk in networks],
+                   np.asarray(networks[0].z0).flat[0].real)
+
+    @classmethod
+    def from_files(cls, files):
+        """Load a list of spectrum files.
+
+        "P13 standard" files are read directly into the stack (through the
+        sidecar cache), without creating a :class:`Network` for each file.
+        """
+        f = None
+        s = []
+        for filename in files:
+            ext = os.path.splitext(filename)[1].lower()
+            if ext in ['.txt', '.dat']:
+                f_file, s_file = spectrum_cache.read(filename, skip_header=(ext == '.dat'))
+            else:
+                ntwk = Network(filename)
+                f_file, s_file = ntwk.f, ntwk.s
+            if f is None:
+                f, grid = f_file, grid_key(f_file)
+            elif grid_key(f_file) != grid:
+                raise ValueError('File '+filename+' is not on the same frequency grid')
+            s.append(s_file)
+        if f is None:
+            raise ValueError('Cannot create an empty stack')
+        return cls(f, s, params_array([params_from_filename(filename) for filename in files]),
+                   [os.path.basename(os.path.splitext(filename)[0]) for filename in files])
+
+    @classmethod
+    def from_multi_spectrum_file(cls, filename, destination=None):
+        """Open a "P13 standard" file containing many spectra.
+
+        The file is converted to the binary layout described in
+        :func:`convert_to_stack` the first time it is opened (and whenever it
+        has changed since), which is then memory mapped. The S matrices are
+        only read from the disk when they are used, so that the file can be
+        larger than the available memory.
+
+        Arguments
+        ---------
+        filename : string
+            the multi-spectrum file
+        destination : string or None
+            the folder of the binary version, see :func:`convert_to_stack`
+        """
+        if destination is None:
+            destination = os.path.splitext(filename)[0]+STACK_EXTENSION
+        stat = os.stat(filename)
+        meta = _read_stack_meta(destination)
+        if meta is None or meta[1] != stat.st_size or meta[2] != stat.st_mtime:
+            convert_to_stack(filename, destination)
+        return cls.from_stack_folder(destination)
+
+    @classmethod
+    def from_stack_folder(cls, folder):
+        """Open the binary version of a multi-spectrum file (see
+        :func:`convert_to_stack`) with the S matrices memory mapped."""
+        meta = _read_stack_meta(folder)
+        if meta is None:
+            raise Exception('Not a valid spectrum stack: '+folder)
+        m, n, p = [int(x) for x in meta[3:6]]
+        s = np.memmap(os.path.join(folder, 's.bin'), dtype='<c16', mode='r', shape=(m, n, p, p))
+        return cls(np.load(os.path.join(folder, 'f.npy')), s,
+                   np.load(os.path.join(folder, 'params.npy')),
+                   [str(name) for name in np.load(os.path.join(folder, 'names.npy'))])
+
+    def __len__(self):
+        return len(self.s)
+
+    def __getitem__(self, index):
+        """Get a single network (integer index) or a sub-stack (slice, index
+        array or boolean mask)."""
+        if isinstance(index, (int, np.integer)):
+            return self.network(index)
+        indices = np.arange(len(self))[index]
+        # slices keep memory mapped S matrices on the disk
+        s = self.s[index] if isinstance(index, slice) else self.s[indices]
+        return NetworkStack(self.f, s, self.params[indices],
+                            [self.names[i] for i in indices], self.z0)
+
+    def crop(self, fmin=None, fmax=None):
+        """Sub-stack restricted to the frequency range fmin <= f <= fmax.
+
+        The S matrices of the result are a view of the original ones, so
+        cropping a memory mapped stack does not read anything from the disk.
+        """
+        start = 0 if fmin is None else np.searchsorted(self.f, fmin, side='left')
+        stop = len(self.f) if fmax is None else np.searchsorted(self.f, fmax, side='right')
+        return NetworkStack(self.f[start:stop], self.s[:, start:stop], self.params,
+                            self.names, self.z0)
+
+    def network(self, i):
+        """Get the i-th network of the stack as a :class:`Network`."""
+        params = dict((name, self.params[name][i]) for name in self.params.dtype.names)
+        return Network(f=self.f, s=self.s[i], z0=self.z0, name=self.names[i], params=params)
+
+    @property
+    def number_of_ports(self):
+        return self.s.shape[-1]
+
+    @property
+    def y(self):
+        """Admittance matrices, shape (M, N, P, P)."""
+        return _flat(s2y, self.s, self.z0)
+
+    @y.setter
+    def y(self, value):
+        self.s = _flat(y2s, value, self.z0)
+
+    @property
+    def z(self):
+        """Impedance matrices, shape (M, N, P, P)."""
+        return _flat(s2z, self.s, self.z0)
+
+    @z.setter
+    def z(self, value):
+        self.s = _flat(z2s, value, self.z0)
+
+    @property
+    def abcd(self):
+        """(Block) ABCD matrices, shape (M, N, P, P), see :func:`s2abcd_block`."""
+        return _to_abcd(self.s, self.z0)
+
+    @abcd.setter
+    def abcd(self, value):
+        self.s = _from_abcd(value, self.z0)
+
+    def deembed_thru(self, thru):
+        """De-embed a thru from all networks of the stack, see
+        :meth:`Network.deembed_thru`.
+
+        Arguments
+        ---------
+        thru : Network object or ThruDeembedder
+            the thru network
+
+        Returns
+        -------
+        NetworkStack
+        """
+        if not isinstance(thru, ThruDeembedder):
+            thru = ThruDeembedder.for_thru(thru)
+        return NetworkStack(self.f, thru.deembed_s(self.s), self.params.copy(), self.names, self.z0)
+
+    def resample(self, f, mode='magphase'):
+        """Interpolate all networks onto a new frequency grid, see
+        :class:`Resampler`."""
+        s = Resampler.for_grids(self.f, f)(self.s, mode=mode)
+        return NetworkStack(f, s, self.params.copy(), self.names, self.z0)
+
+    def mask(self, **conditions):
+        """Boolean mask of the networks whose parameters have the given
+        values, e.g. ``stack.mask(Vg=0.1, T=4)``. Float values are compared
+        with numpy.isclose."""
+        mask = np.ones(len(self), dtype=bool)
+        for name, value in conditions.items():
+            column = self.params[name]
+            if column.dtype.kind == 'f':
+                mask &= np.isclose(column, float(value))
+            else:
+                mask &= column == value
+        return mask
+
+    def select(self, **conditions):
+        """Sub-stack of the networks whose parameters have the given values,
+        see :meth:`mask`."""
+        return self[self.mask(**conditions)]
+
+    def sort_by(self, name):
+        """Sub-stack sorted by the parameter ``name``."""
+        return self[np.argsort(self.params[name], kind='mergesort')]
+
+
+STACK_EXTENSION = '.p13stack'
+STACK_VERSION = 1
+
+
+def _read_stack_meta(folder):
+    """Read the meta data [version, size, mtime, M, N, P] of a stack folder,
+    None if the folder does not contain a valid stack."""
+    try:
+        meta = np.load(os.path.join(folder, 'meta.npy'))
+    except (IOError, OSError, ValueError):
+        return None
+    if len(meta) != 6 or meta[0] != STACK_VERSION:
+        return None
+    return meta
+
+
+class _StackWriter(object):
+    """Split the rows of a multi-spectrum file into spectra and append their
+    S matrices to a binary file (used by :func:`convert_to_stack`)."""
+    def __init__(self, fid, filename):
+        self.fid = fid
+        self.filename = filename
+        self.ncols = None
+        self.chunks = []        # frequencies of the first spectrum
+        self.f = None           # frequency grid, once the first spectrum is complete
+        self.headers = []       # header line of every spectrum
+        self.header = None      # header line of the next spectrum
+        self.position = 0       # number of rows of the current spectrum
+        self.last_f = None
+
+    def comment(self, line):
+        # a comment after data starts a new spectrum
+        self.finish()
+        self.header = line
+
+    def data(self, lines):
+        if self.ncols is None:
+            self.ncols = len(lines[0].split())
+            _nports(self.ncols)
+        values = _parse_numbers(''.join(lines), self.filename)
+        if values.size % self.ncols:
+            raise Exception('Invalid number of values')
+        data = values.reshape(-1, self.ncols)
+        # a new spectrum starts where the frequency does not increase
+        bounds = [0] + list(np.nonzero(np.diff(data[:, 0]) <= 0)[0]+1) + [len(data)]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if start > 0 or (self.position and data[0, 0] <= self.last_f):
+                self.finish()
+            self.write(data[start:stop])
+
+    def write(self, rows):
+        if not self.position:
+            self.headers.append(self.header)
+            self.header = None
+        if self.f is None:
+            self.chunks.append(rows[:, 0].copy())
+        else:
+            reference = self.f[self.position:self.position+len(rows)]
+            if len(reference) != len(rows) or np.max(np.abs(reference-rows[:, 0])) >= 1e-3:
+                raise Exception('Spectrum {} is not on the same frequency grid'.format(len(self.headers)))
+        self.fid.write(rows[:, 1:].astype('<f8').tobytes())
+        self.position += len(rows)
+        self.last_f = rows[-1, 0]
+
+    def finish(self):
+        if not self.position:
+            return
+        if self.f is None:
+            self.f = np.concatenate(self.chunks)
+        elif self.position != len(self.f):
+            raise Exception('Spectrum {} is not on the same frequency grid'.format(len(self.headers)))
+        self.position = 0
+        self.last_f = None
+
+
+def convert_to_stack(filename, destination=None, chunksize=10000):
+    """Convert a "P13 standard" file containing many spectra to a binary
+    layout that can be memory mapped (see
+    :meth:`NetworkStack.from_multi_spectrum_file`).
+
+    The spectra follow each other in the file, a new spectrum starts where
+    the frequency does not increase or where a comment line follows data
+    rows. All spectra must have the same frequency grid. The last comment
+    line before a spectrum is its name, from which the parameters are
+    extracted in the same way as from file names (e.g.
+    "# 2018-05-02_11h26m40s_Vg=0.1"). Spectra without comment line are
+    named after the file and numbered.
+
+    The file is converted block by block, so that the memory usage does not
+    depend on the file size. The destination folder contains:
+
+    * s.bin: the S matrices as raw little-endian complex numbers, in the
+      order (M, N, P, P) for M spectra with N frequencies and P ports
+    * f.npy, names.npy, params.npy: the frequencies, the names and the
+      parameters (see :func:`params_array`)
+    * meta.npy: [version, size and modification time of the original file,
+      M, N, P]
+
+    Arguments
+    ----------
+    filename : string
+        File name of the "P13 standard" file.
+    destination : string or None
+        The folder for the binary version, by default the file name with
+        the extension ".p13stack".
+    chunksize : int
+        Number of lines converted at once.
+
+    Returns
+    -------
+    the destination folder.
+
+    """
+    if destination is None:
+        destination = os.path.splitext(filename)[0]+STACK_EXTENSION
+    destination = os.path.abspath(destination)
+    stat = os.stat(filename)
+    # write to a temporary folder first, which is renamed when complete
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(destination))
+    try:
+        with open(filename, 'r') as old_file, open(os.path.join(tmp, 's.bin'), 'wb') as fid:
+            writer = _StackWriter(fid, filename)
+            lines = []
+            for line in old_file:
+                stripped = line.strip()
+                if stripped.startswith('#'):
+                    if lines:
+                        writer.data(lines)
+                        lines = []
+                    writer.comment(stripped[1:].strip())
+                elif stripped:
+                    lines.append(line)
+                    if len(lines) >= chunksize:
+                        writer.data(lines)
+                        lines = []
+            if lines:
+                writer.data(lines)
+            writer.finish()
+        if not writer.headers:
+            raise Exception('No spectra in file: '+filename)
+
+        basename = os.path.basename(os.path.splitext(filename)[0])
+        names = [header if header else '{}_{}'.format(basename, i)
+                 for i, header in enumerate(writer.headers)]
+        nports = _nports(writer.ncols)
+        np.save(os.path.join(tmp, 'f.npy'), writer.f)
+        np.save(os.path.join(tmp, 'names.npy'), np.array(names, dtype=str))
+        np.save(os.path.join(tmp, 'params.npy'),
+                # (params_from_filename expects a file extension)
+                params_array([params_from_filename(header+'.txt') if header else {}
+                              for header in writer.headers]))
+        np.save(os.path.join(tmp, 'meta.npy'),
+                np.array([STACK_VERSION, stat.st_size, stat.st_mtime,
+                          len(names), len(writer.f), nports], dtype=float))
+        if os.path.isdir(destination):
+            shutil.rmtree(destination)
+        os.rename(tmp, destination)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return destination
+
+
+def s2abcd_block(s, z0=50.):
+    """Convert S matrices of networks with P = 2n ports to block ABCD
+    matrices.
+
+    The first n ports are on the input side and the last n ports on the
+    output side, so that the block ABCD matrix relates the voltage and
+    current vectors of both sides in the same way as the ABCD matrix of a
+    2-port network: [V1, I1] = [[A, B], [C, D]] [V2, -I2], where A, B, C
+    and D are nxn matrices. The conversion goes through the wave transfer
+    matrix and therefore requires S21 to be invertible (which is the case
+    for thru structures). All ports have the same real reference impedance
+    z0.
+
+    Arguments
+    ----------
+    s : numpy array of shape (..., P, P)
+        The S matrices.
+    z0 : float
+        The reference impedance.
+
+    Returns
+    -------
+    numpy array of shape (..., P, P)
+
+    """
+    s = np.asarray(s, dtype=complex)
+    n = s.shape[-1]//2
+    if s.shape[-1] != 2*n:
+        raise ValueError('Block ABCD matrices require an even number of ports')
+    s11, s12, s21, s22 = s[..., :n, :n], s[..., :n, n:], s[..., n:, :n], s[..., n:, n:]
+    # wave transfer matrix: [b1, a1] = [[t11, t12], [t21, t22]] [a2, b2]
+    t22 = np.linalg.inv(s21)
+    t12 = np.matmul(s11, t22)
+    t21 = -np.matmul(t22, s22)
+    t11 = s12 + np.matmul(s11, t21)
+    abcd = np.empty_like(s)
+    abcd[..., :n, :n] = (t11 + t12 + t21 + t22)/2.
+    abcd[..., :n, n:] = z0*(t12 + t22 - t11 - t21)/2.
+    abcd[..., n:, :n] = (t21 + t22 - t11 - t12)/(2.*z0)
+    abcd[..., n:, n:] = (t11 + t22 - t12 - t21)/2.
+    return abcd
+
+
+def abcd2s_block(abcd, z0=50.):
+    """Convert block ABCD matrices to S matrices, inverse of
+    :func:`s2abcd_block`."""
+    abcd = np.asarray(abcd, dtype=complex)
+    n = abcd.shape[-1]//2
+    a, b, c, d = abcd[..., :n, :n], abcd[..., :n, n:], abcd[..., n:, :n], abcd[..., n:, n:]
+    t11 = (a + d - b/z0 - c*z0)/2.
+    t12 = (a - d + b/z0 - c*z0)/2.
+    t21 = (a - d - b/z0 + c*z0)/2.
+    t22 = (a + d + b/z0 + c*z0)/2.
+    s = np.empty_like(abcd)
+    s21 = np.linalg.inv(t22)
+    s11 = np.matmul(t12, s21)
+    s[..., :n, :n] = s11
+    s[..., :n, n:] = t11 - np.matmul(s11, t21)
+    s[..., n:, :n] = s21
+    s[..., n:, n:] = -np.matmul(s21, t21)
+    return s
+
+
+def _to_abcd(s, z0=50.):
+    """Stack of S matrices (..., P, P) to (block) ABCD matrices; 2-port
+    networks are converted by scikit-rf."""
+    if np.shape(s)[-1] == 2:
+        return _flat(s2abcd, s, z0)
+    return s2abcd_block(s, z0)
+
+
+def _from_abcd(abcd, z0=50.):
+    """Inverse of :func:`_to_abcd`."""
+    if np.shape(abcd)[-1] == 2:
+        return _flat(abcd2s, abcd, z0)
+    return abcd2s_block(abcd, z0)
+
+
+def sqrtm_stack(m):
+    """Principal square root of a stack of matrices of shape (..., P, P).
+
+    2x2 matrices are treated in closed form (see :func:`sqrtm_2x2`), larger
+    ones by a batched eigendecomposition M = V diag(w) V^-1, so that
+    sqrt(M) = V diag(sqrt(w)) V^-1. The latter requires the matrices to be
+    diagonalizable, which is the case for the block ABCD matrices of thru
+    structures.
+    """
+    m = np.asarray(m, dtype=complex)
+    if m.shape[-1] == 2:
+        return sqrtm_2x2(m)
+    w, v = np.linalg.eig(m)
+    return np.matmul(v*np.sqrt(w)[..., None, :], np.linalg.inv(v))
+
+
+def sqrtm_2x2(m):
+    """Principal square root of a stack of 2x2 matrices.
+
+    Uses the closed form sqrt(M) = (M + s*I)/t with s = sqrt(det(M)) and
+    t = sqrt(tr(M) + 2*s). This coincides with the principal square root
+    (as returned by scipy.linalg.sqrtm) as long as the principal square
+    roots of the eigenvalues multiply to sqrt(det(M)), which is the case for
+    the ABCD matrices of passive reciprocal networks (det(M) = 1).
+
+    Arguments
+    ----------
+    m : numpy array of shape (..., 2, 2)
+        The matrices, e.g. an ABCD matrix for each frequency point.
+
+    Returns
+    -------
+    numpy array of the same shape as m
+
+    """
+    m = np.asarray(m, dtype=complex)
+    a, b, c, d = m[..., 0, 0], m[..., 0, 1], m[..., 1, 0], m[..., 1, 1]
+    s = np.sqrt(a*d - b*c)
+    t = np.sqrt(a + d + 2.*s)
+    root = np.empty_like(m)
+    root[..., 0, 0] = (a + s)/t
+    root[..., 0, 1] = b/t
+    root[..., 1, 0] = c/t
+    root[..., 1, 1] = (d + s)/t
+    return root
     
 
-def convert_to_touchstone(filename, newfilename):
-    """Convert a "P13 standard" file to a touchstone file (.s2p)
+def convert_to_touchstone(filename, newfilename, chunksize=10000):
+    """Convert a "P13 standard" file to a touchstone file (.sNp)
+
+    The file is converted block by block, so that the memory usage does not
+    depend on the file size. Comment lines at the beginning of the file are
+    kept as touchstone comments, blank lines are skipped.
+
+    For networks with more than 2 ports, each row of the S matrix is
+    written on a separate line (with at most 4 values per line), as
+    required by the touchstone format. The values are written exactly as
+    they are in the original file.
 
     Arguments
     ----------
     filename : string
         File name of the "P13 standard" file.
     newfilename : string
-        File name of the new (.s2p) file
+        File name of the new (.sNp) file
+    chunksize : int
+        Number of lines converted at once.
 
     Returns
     -------
@@ -192,20 +1428,105 @@ def convert_to_touchstone(filename, newfilename):
     """
     
     # see also http://na.support.keysight.com/plts/help/WebHelp/FilePrint/SnP_File_Format.htm    
-    
-    # read data
+
     with open(filename, 'r') as old_file: 
-        # create new file with '.s2p' extension
+        # create new file with '.sNp' extension
         with open(newfilename, 'w') as new_file:
-            new_file.write('# hz s ri r 50\n')
-            for line in old_file.readlines():
-                values = line.strip().split(' ')
-                if not len(values) == 9:    # 1 for freq, 2x4 for S parameters
-                    raise Exception('Invalid number of columns')
+            # next() and not readline(): the file is also read with islice,
+            # and python 2 does not allow mixing readline with iteration
+            line = next(old_file, '')
+            while line and (not line.strip() or line.lstrip().startswith('#')):
+                if line.strip():
+                    new_file.write('!'+line.lstrip()[1:])
+                line = next(old_file, '')
+            nports = _nports(len(line.split()))
+            if nports == 2:
                 # in old format we have f, S11, S12, S21, S22
                 # in touchstone we need f, S11, S21, S12, S22
                 new_order = [0, 1, 2, 5, 6, 3, 4, 7, 8]
-                values = [values[i] for i in new_order]
-                line = ' '.join(values)
-                new_file.write(line+'\n')
-        
+                row_format = ' '.join(['%s']*len(new_order))+'\n'
+            else:
+                # same order, but one line per matrix row and 4 values per line
+                new_order = list(range(1+2*nports**2))
+                pairs = ['%s %s']*nports
+                lines = [' '.join(pairs[k:k+4]) for k in range(0, nports, 4)]
+                row_format = '%s '+'\n'.join(lines*nports)+'\n'
+            new_file.write('# hz s ri r 50\n')
+            while line:
+                text = line + ''.join(islice(old_file, chunksize))
+                # the numbers are only parsed to check the file, the original
+                # tokens are written (no rounding, no longer representations)
+                _parse_numbers(text, filename)
+                block = np.array(text.split())
+                if block.size % len(new_order):    # 1 for freq, 2xP^2 for S parameters
+                    raise Exception('Invalid number of columns')
+                block = block.reshape(-1, len(new_order))[:, new_order]
+                new_file.write(row_format*len(block) % tuple(block.ravel()))
+                line = next(old_file, '')
+
+
+def p13_nports(filename):
+    """Number of ports of a "P13 standard" file, from its first data line."""
+    with open(filename, 'r') as fid:
+        line = fid.readline()
+        while line and (not line.strip() or line.lstrip().startswith('#')):
+            line = fid.readline()
+    return _nports(len(line.split()))
+
+
+def _convert_to_touchstone_job(args):
+    convert_to_touchstone(*args)
+    return args[1]
+
+
+def convert_folder_to_touchstone(folder, destination=None, processes=None, overwrite=False,
+                                 extensions=('.txt',)):
+    """Convert all "P13 standard" files in a folder to touchstone files.
+
+    The files are converted in parallel by a pool of processes. Files whose
+    touchstone version exists and is newer than the original are skipped.
+
+    Arguments
+    ----------
+    folder : string
+        The folder containing the "P13 standard" files.
+    destination : string or None
+        The folder for the touchstone files (same as folder if None).
+    processes : int or None
+        Number of processes (number of CPUs if None).
+    overwrite : bool
+        Convert files even if they are up to date.
+    extensions : list of strings
+        File extensions of the "P13 standard" files.
+
+    Returns
+    -------
+    list of the converted touchstone files.
+
+    """
+    from multiprocessing import Pool
+
+    destination = folder if destination is None else destination
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+
+    jobs = []
+    for filename in sorted(os.listdir(folder)):
+        basename, ext = os.path.splitext(filename)
+        if ext.lower() not in extensions:
+            continue
+        filename = os.path.join(folder, filename)
+        newfilename = os.path.join(destination, basename+'.s{}p'.format(p13_nports(filename)))
+        if (not overwrite and os.path.exists(newfilename) and
+                os.path.getmtime(newfilename) >= os.path.getmtime(filename)):
+            continue
+        jobs.append((filename, newfilename))
+
+    if len(jobs) < 2 or processes == 1:
+        return [_convert_to_touchstone_job(job) for job in jobs]
+    pool = Pool(processes)
+    try:
+        return pool.map(_convert_to_touchstone_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
@@ -1,3 +1,33 @@
+import inspect
+import numpy as np
+from lmfit import Parameters, minimize
+
+
+def line_admittance(z, c, w):
+    """Admittance of a distributed line shorted at its end, with the total
+    series impedance z and the total capacitance c, and its derivatives.
+
+    With u = sqrt(1j*z*c*w), the admittance is u*tanh(u)/z (even in u, so
+    that the branch of the square root does not matter).
+
+    Returns
+    -------
+    (tlm, dtlm_dz, dtlm_dc)
+    """
+    u = np.sqrt(1j*z*c*w)
+    th = np.tanh(u)
+    tlm = u*th/z
+    # d(u*tanh(u))/du * u/2 is the derivative with respect to log(z) or log(c)
+    h = 0.5*u*(th + u*(1. - th*th))
+    return tlm, (h/z - tlm)/z, h/(z*c)
+
+
+def _arguments(func):
+    # names of the parameters of a model function func(w, a, b, ...)
+    getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec   # Python 2
+    return tuple(getargspec(func).args[2:])
+
+
 class BaseModel(object):
     # dictionary of the model's parameters
     # for each parameter, we store the minimum and maximum value,
@@ -5,6 +35,13 @@ class BaseModel(object):
     params = {}
     func = None    # this is where the fitter will memorize which model function is active
     infowidget = None
+    fitted_func = None  # name of the model function fitted by objective if none is selected in func
+                        # (default: the first func_*)
+    analytic_jacobian = True    # use the grad_* function of the fitted function if there is one
+    evaluate_block = 16384      # number of points evaluated at once by evaluate
+    grid_density = 8            # number of values of each parameter in grid_search
+    grid_max_sets = 100000      # the density is reduced for grids with more sets of parameters
+    grid_refine = 2             # number of refinements of the grid around its best point
 
     def __init__(self):
         self.values = {}            # this is where the fitter will store the values
@@ -18,4 +55,304 @@ class BaseModel(object):
             self.values[p] = self.params[p][2]*self.params[p][3]
 
     def update_infowidget(self):
-        pass
\ No newline at end of file
+        pass
+
+    def fitted_function(self):
+        """Get the model function fitted by objective and the names of its
+        parameters (in the order of its arguments after w).
+
+        This is the model function selected in the fitter (func), else the
+        one named by fitted_func, else the first func_*.
+        """
+        func = self.func
+        if func is None:
+            name = self.fitted_func or sorted(n[5:] for n in dir(type(self)) if n.startswith('func_'))[0]
+            func = getattr(self, 'func_' + name)
+        # the argument names are looked up once per model function
+        arguments = self.__dict__.setdefault('_arguments', {})
+        if func.__name__ not in arguments:
+            arguments[func.__name__] = _arguments(func)
+        return func, arguments[func.__name__]
+
+    def evaluate(self, w, values, func=None):
+        """Evaluate a model function for M sets of parameters at once.
+
+        The parameters are passed to the model function as arrays of shape
+        (M, 1) and the pulsations as an array of shape (1, N), so that a
+        model function written with numpy operations computes all sets in
+        one pass. Model functions that do not broadcast are evaluated for
+        one set of parameters after the other.
+
+        Parameters
+        ----------
+        w : np.array
+            pulsations, shape (N,)
+        values : dict
+            the values of the parameters, each one an array of shape (M,)
+            or a scalar (the same for all sets)
+        func : string or None
+            the model function (without 'func_', default: the one fitted by
+            objective, see fitted_function)
+
+        Returns
+        -------
+        np.array of shape (M, N)
+        """
+        if func is None:
+            func, args = self.fitted_function()
+        else:
+            func = getattr(self, 'func_' + func)
+            args = _arguments(func)
+        columns = [np.asarray(values[p], dtype=float) for p in args]
+        count = max([c.size for c in columns if c.ndim] or [1])
+        columns = [c.reshape(-1, 1) if c.ndim else c.item() for c in columns]
+        w = np.asarray(w, dtype=float).reshape(1, -1)
+        shape = (count, w.shape[1])
+        # in blocks of rows, so that the temporary arrays of the model
+        # function stay in the processor cache
+        rows = max(1, self.evaluate_block//shape[1])
+        computed = None
+        for k in range(0, count, rows):
+            block = [c if np.ndim(c) == 0 else c[k:k+rows] for c in columns]
+            result = self._evaluate(func, w, block, min(rows, count-k))
+            if count <= rows:
+                return result
+            if computed is None:
+                computed = np.empty(shape, dtype=result.dtype)
+            computed[k:k+rows] = result
+        return computed
+
+    @staticmethod
+    def _evaluate(func, w, columns, count):
+        shape = (count, w.shape[1])
+        try:
+            computed = func(w, *columns)
+        except ValueError:
+            # e.g. the model function tests the value of a parameter
+            computed = np.array([func(w[0], *[c if np.ndim(c) == 0 else c[m, 0] for c in columns])
+                                 for m in range(count)])
+        if np.shape(computed) != shape:
+            computed = np.broadcast_to(computed, shape).copy()
+        return computed
+
+    def grid(self, p, density, interval=(0., 1.)):
+        """Values of a parameter in grid_search: the centers of density
+        intervals of the range of its slider, logarithmic for ranges of
+        positive values spanning more than a decade and for ranges from zero
+        (then over the three decades below the maximum).
+
+        The values are strictly within the range: the fits can not start at
+        a bound (lmfit would not move the parameter).
+
+        interval : (float, float)
+            part of the range (0: minimum, 1: maximum) to use
+        """
+        lo, hi = self.params[p][0]*self.params[p][3], self.params[p][1]*self.params[p][3]
+        if density < 2 or lo == hi:
+            return np.array([float(self.values[p])])
+        u = interval[0] + (interval[1] - interval[0])*(np.arange(density) + 0.5)/density
+        if lo == 0. and hi > 0.:
+            lo = 1e-3*hi
+        if lo > 0. and hi >= 10.*lo:
+            return lo*(hi/lo)**u
+        return lo + (hi - lo)*u
+
+    def grid_search(self, f, y, params=None, density=None, part=2, points=101, refine=None):
+        """Find initial values for a fit on a coarse grid of parameters.
+
+        The fitted model function (see fitted_function) is evaluated for all
+        the sets of parameters of the grid (see grid and evaluate), the other
+        parameters keep their current values. The grid is then refined
+        around its best point.
+
+        Parameters
+        ----------
+        f : np.array
+            frequencies
+        y : np.array
+            the data to fit
+        params : list of strings or None
+            the parameters of the grid (default: all parameters of the model
+            function)
+        density : int or None
+            the number of values of each parameter (default: grid_density),
+            reduced so that there are at most grid_max_sets sets
+        part : int
+            0: real, 1: imaginary, 2: both (see objective)
+        points : int
+            the number of frequencies used (evenly spaced in the data)
+        refine : int or None
+            the number of refinements: grids over the cells next to the
+            best point (default: grid_refine)
+
+        Returns
+        -------
+        dict: the values, with the parameters of the grid point with the
+        smallest residual
+        """
+        func, args = self.fitted_function()
+        params = [p for p in args if params is None or p in params]
+        if not params:
+            return dict(self.values)
+        density = min(density or self.grid_density, int(np.floor(self.grid_max_sets**(1./len(params)) + 1e-9)))
+        refine = self.grid_refine if refine is None else refine
+
+        index = np.unique(np.linspace(0, len(f)-1, min(points, len(f))).astype(int))
+        w = 2.*np.pi*np.asarray(f)[index]
+        y = np.nan_to_num(np.asarray(y)[index])
+        intervals = [(0., 1.)]*len(params)
+        for level in range(refine + 1):
+            grids = [self.grid(p, density, i) for p, i in zip(params, intervals)]
+            shape = tuple(len(g) for g in grids)
+            best = np.unravel_index(self._grid_best(w, y, params, grids, part), shape)
+            # the next grid covers the cells next to the best one
+            intervals = [(max(a, a + (b - a)*(k - 1.)/density), min(b, a + (b - a)*(k + 2.)/density))
+                         for (a, b), k in zip(intervals, best)]
+
+        values = dict(self.values)
+        for p, g, k in zip(params, grids, best):
+            values[p] = float(g[k])
+        return values
+
+    def _grid_best(self, w, y, params, grids, part):
+        # index of the set of parameters of the grid with the smallest residual
+        shape = tuple(len(g) for g in grids)
+        sets = int(np.prod(shape))
+        values = dict(self.values)
+        best, best_cost = 0, np.inf
+        block = max(1, self.evaluate_block//len(w))
+        for start in range(0, sets, block):
+            k = np.arange(start, min(start+block, sets))
+            for p, g, i in zip(params, grids, np.unravel_index(k, shape)):
+                values[p] = g[i]
+            diff = y - np.nan_to_num(self.evaluate(w, values))
+            if part == 0:
+                cost = np.sum(diff.real**2, axis=1)
+            elif part == 1:
+                cost = np.sum(diff.imag**2, axis=1)
+            else:
+                cost = np.sum(diff.real**2 + diff.imag**2, axis=1)
+            if cost.min() < best_cost:
+                best, best_cost = k[np.argmin(cost)], cost.min()
+        return best
+
+    def fit_grid(self, f, y, checkboxes):
+        """Fit the checked parameters, starting from the best point of a
+        grid search over them (see grid_search)."""
+        func, args = self.fitted_function()
+        varied = [p for p in args if checkboxes[p].isChecked()]
+        if not varied:
+            raise Exception('Please check the parameters to fit.')
+        self.values.update(self.grid_search(f, y, varied))
+
+        params = Parameters()
+        for p in args:
+            params.add(p, value=self.values[p], min=self.params[p][0]*self.params[p][3],
+                       max=self.params[p][1]*self.params[p][3], vary=p in varied)
+        res = self.minimize(params, 2.*np.pi*f, y)
+        for p in args:
+            self.values[p] = res.params[p].value
+
+    def crossover(self, f, y, params, threshold=5e-5):
+        """Crossover frequency of the data: the first frequency where its
+        real and imaginary parts differ by less than threshold.
+
+        If there is none, the values are set to the best point of a grid
+        search over params (see grid_search) and the crossover of the model
+        is returned instead.
+        """
+        f_below_thresh = f[np.abs(y.real-y.imag) < threshold]
+        if len(f_below_thresh):
+            return f_below_thresh[0]
+        print("Threshold detection did not work, using a grid search")
+        self.values.update(self.grid_search(f, y, params))
+        model_y = self.evaluate(2.*np.pi*f, self.values)[0]
+        return f[np.argmin(np.abs(model_y.real-model_y.imag))]
+
+    def objective(self, params, w, y, part=2):
+        """Error function minimized during the fitting procedure.
+
+        We perform the optimization on both the real and imaginary part of
+        the model function (see fitted_function). The points where the model
+        function is not a number are compared to zero.
+
+        The residual is written directly into the returned array, without
+        temporary arrays (the optimizers keep references to the returned
+        arrays, so it cannot be a buffer that is reused).
+
+        Parameters
+        ----------
+        params : lmfit.Parameters
+            the parameters of the model function
+        w : np.array
+            pulsations
+        y : np.array
+            the data to fit
+
+        part : int
+            0: real
+            1: imaginary
+            2: both
+        """
+        func, args = self.fitted_function()
+        computed = func(w, *[params[p].value for p in args])
+        if not np.isfinite(np.sum(computed)):     # one pass over the data in the usual case
+            np.nan_to_num(computed, copy=False)
+        res = np.empty((2, len(y)))
+        np.subtract(y.real, computed.real, out=res[0])
+        np.subtract(y.imag, computed.imag, out=res[1])
+        if part == 2:
+            return res.reshape(-1)
+        else:
+            return res[part]
+
+    def gradient(self):
+        """Get the function that returns the derivatives of the fitted model
+        function with respect to each of its parameters (None if the model
+        does not define it).
+
+        For a model function func_xyz(w, a, b, ...), the model can define
+        grad_xyz(w, a, b, ...) returning a list of arrays [dfunc/da,
+        dfunc/db, ...].
+        """
+        func, args = self.fitted_function()
+        if not self.analytic_jacobian:
+            return None
+        return getattr(self, 'grad_' + func.__name__[5:], None)
+
+    def jacobian(self, params, w, y, part=2):
+        """Jacobian of the objective function with respect to the varied
+        parameters (one row per parameter, i.e. for col_deriv=1)."""
+        func, args = self.fitted_function()
+        values = dict((p, params[p].value) for p in args)
+        derivatives = dict(zip(args, self.gradient()(w, *[values[p] for p in args])))
+        varied = [p for p in params if params[p].vary]
+        jac = np.empty((len(varied), 2, len(w)))
+        for i, p in enumerate(varied):
+            # derivatives can be scalars, e.g. zero where a parameter drops out
+            d = derivatives.get(p, 0.)
+            jac[i, 0] = -np.real(d)
+            jac[i, 1] = -np.imag(d)
+        if not np.isfinite(np.sum(jac)):
+            np.nan_to_num(jac, copy=False)
+        if part == 2:
+            return jac.reshape(len(varied), -1)
+        else:
+            return jac[:, part]
+
+    def minimize(self, params, w, y, part=2, **kws):
+        """Fit the model to the data y with lmfit.minimize (see objective),
+        using the analytic Jacobian if the model defines the gradient of the
+        model function and more than one parameter is varied.
+
+        Returns
+        -------
+        lmfit.MinimizerResult
+        """
+        # with a single varied parameter, finite differences cost one more
+        # evaluation of the model function, which is cheaper than the gradient
+        varied = sum(1 for p in params if params[p].vary)
+        if varied > 1 and self.gradient() is not None and kws.get('method', 'leastsq') == 'leastsq':
+            kws.setdefault('Dfun', self.jacobian)
+            kws.setdefault('col_deriv', 1)
+        return minimize(self.objective, params, args=(w, y, part), **kws)
@@ -0,0 +1,379 @@
+"""
+Fitting of many spectra in a pool of worker processes.
+
+The workers do not create any Qt widgets: the models are instantiated without
+calling their own __init__ (which typically sets up the info widget) and the
+check boxes of the parameters are replaced by their state. The functions in
+this module can thus be used without a QApplication.
+
+In a sweep (e.g. of the gate voltage), neighbouring spectra have nearly the
+same parameters. With warm start, the spectra are ordered by a parameter in
+their file name and each one is fitted starting from the values of the
+previous one, instead of running the (cold start) fit method of the model.
+
+With a fit cache (see fitcache), the spectra that were already fitted with the
+same inputs are not fitted again.
+"""
+import os
+import imp
+import inspect
+import traceback
+import multiprocessing
+from collections import namedtuple
+
+import numpy as np
+from lmfit import Parameters, minimize
+
+from P13pt.spectrumfitter.basemodel import BaseModel
+from P13pt.spectrumfitter.fitcache import fit_key
+from P13pt.params_from_filename import params_from_filename
+
+
+def parse_fitted_param_str(s):
+    sign = -1. if s[0] == '-' else +1
+    param = s[1]
+    i = int(s[2]) - 1
+    j = int(s[3]) - 1
+    return sign, param, i, j
+
+def create_fitted_param_str(sign, param, i, j, unit=False):
+    unit_string = ' [mS]' if param.lower() == 'y' else ''
+    return ('+' if sign > 0 else '-') + \
+        param + \
+        str(i + 1) + \
+        str(j + 1) + \
+        (unit_string if unit else '')
+
+def fitted_data(network, fitted_param):
+    """Get the fitted parameter (e.g. '-Y12') of a network as an array."""
+    sign, param, i, j = parse_fitted_param_str(fitted_param)
+    return sign*(network.y[:, i, j] if param == 'Y' else network.s[:, i, j])
+
+
+def load_model_class(filename):
+    """Load the Model class from a model file."""
+    mod_name, file_ext = os.path.splitext(os.path.split(filename)[-1])
+    mod = imp.load_source(mod_name, filename)
+    if not hasattr(mod, 'Model'):
+        raise Exception('Could not get correct class from file.')
+    return getattr(mod, 'Model')
+
+def new_model(cls):
+    """Create a model without its info widget.
+
+    The __init__ of the model class is skipped, only the one of BaseModel is
+    called (this is where the values are set up).
+    """
+    model = cls.__new__(cls)
+    BaseModel.__init__(model)
+    return model
+
+def model_methods(cls, prefix):
+    """Names of the model functions (prefix 'func_') or fit methods (prefix
+    'fit_') of a model class, without the prefix."""
+    return [name[len(prefix):] for name in sorted(dir(cls))
+            if name.startswith(prefix) and callable(getattr(cls, name))]
+
+def takes_checkboxes(fit_method):
+    """Fit methods with the signature fit_*(self, f, y, checkboxes) only vary
+    the parameters whose check box is checked."""
+    getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec   # Python 2
+    return len(getargspec(fit_method).args) == 4
+
+
+class CheckState(object):
+    """Stands in for the QCheckBox of a parameter in the workers."""
+    def __init__(self, checked):
+        self.checked = bool(checked)
+
+    def isChecked(self):
+        return self.checked
+
+
+# one spectrum to fit: the fitted parameter (see fitted_data) as a function of
+# the frequency f, the initial values of the model (None for the defaults),
+# the states of the check boxes (None if the fit method does not take them)
+# and the name of the model function (None: see BaseModel.fitted_function)
+FitJob = namedtuple('FitJob', ['filename', 'f', 'y', 'model_file', 'fit_method', 'checkboxes', 'values',
+                               'model_func'])
+FitJob.__new__.__defaults__ = (None,)
+
+# the result of a fit: the values (None if the fit failed, the traceback is then
+# in error), the number of evaluations of the objective function and how the fit
+# was started: 'cold' (fit method of the model), 'warm' (from the values of the
+# previous spectrum), 'fallback' (warm start diverged, then cold start) or
+# 'cached' (not fitted, the values are from the fit cache)
+FitResult = namedtuple('FitResult', ['filename', 'values', 'error', 'nfev', 'start'])
+
+
+class ObjectiveMonitor(object):
+    """Wraps the objective function of a model, objective(params, w, y), to
+    count its evaluations and to record which parameters and which range of
+    pulsations w the fit method uses."""
+    def __init__(self, objective):
+        self.objective = objective
+        self.reset()
+
+    def reset(self):
+        self.nfev = 0
+        self.varied = set()
+        self.wmin = np.inf
+        self.wmax = -np.inf
+
+    def __call__(self, params, w, y, *args, **kwargs):
+        self.nfev += 1
+        self.varied.update(p for p in params if params[p].vary)
+        self.wmin = min(self.wmin, np.min(w))
+        self.wmax = max(self.wmax, np.max(w))
+        return self.objective(params, w, y, *args, **kwargs)
+
+
+_models = {}    # model file -> model, in each worker process
+
+def get_model(model_file):
+    if model_file not in _models:
+        model = new_model(load_model_class(model_file))
+        if hasattr(model, 'objective'):
+            # the fit methods call self.objective, i.e. the monitor
+            model.objective = ObjectiveMonitor(model.objective)
+        _models[model_file] = model
+    return _models[model_file]
+
+def _fit_parameters(model, values, varied=()):
+    params = Parameters()
+    for p in model.params:
+        lo, hi = model.params[p][0]*model.params[p][3], model.params[p][1]*model.params[p][3]
+        params.add(p, value=min(max(values[p], lo), hi), min=lo, max=hi, vary=p in varied)
+    return params
+
+def _residual(model, values, w, y):
+    # relative norm of the residual of the objective function (not counted)
+    return np.linalg.norm(model.objective.objective(_fit_parameters(model, values), w, y))/np.linalg.norm(y)
+
+def fit_spectrum(job, previous=None, divergence=2.):
+    """Fit one spectrum (this runs in the worker processes).
+
+    Arguments
+    ---------
+    job : FitJob
+        the spectrum
+    previous : dict or None
+        for warm start, the state returned for the previous spectrum of the
+        sweep
+    divergence : float
+        the warm start is considered to have diverged (and the cold start is
+        used) if the residual is larger than divergence times the one of
+        the last cold start, or if it needs more function evaluations than
+        the last cold start
+
+    Returns
+    -------
+    (FitResult, state): the state to pass for the next spectrum
+    """
+    try:
+        model = get_model(job.model_file)
+        if isinstance(model, BaseModel):
+            # the model function that is fitted
+            model.func = getattr(model, 'func_' + job.model_func) if job.model_func else None
+        monitor = getattr(model, 'objective', None)
+        if not isinstance(monitor, ObjectiveMonitor):
+            monitor = None      # warm start is not possible
+        start = 'cold'
+        nfev = 0
+        if previous is not None and monitor is not None:
+            # warm start: a single least squares fit of the parameters that
+            # the fit method varies, in the frequency range that it uses
+            w = 2.*np.pi*job.f
+            mask = np.logical_and(w >= previous['wmin'], w <= previous['wmax'])
+            monitor.reset()
+            # a warm start that needs more evaluations than the cold start
+            # is not worth it
+            params = _fit_parameters(model, previous['values'], previous['varied'])
+            if isinstance(model, BaseModel):
+                # with the analytic Jacobian if the model has one
+                res = model.minimize(params, w[mask], job.y[mask], max_nfev=previous['nfev'])
+            else:
+                res = minimize(monitor, params, args=(w[mask], job.y[mask]), max_nfev=previous['nfev'])
+            nfev = monitor.nfev
+            values = dict((p, res.params[p].value) for p in model.params)
+            if res.success and _residual(model, values, w[mask], job.y[mask]) <= divergence*previous['residual']:
+                state = dict(previous, values=values)
+                return FitResult(job.filename, values, None, nfev, 'warm'), state
+            start = 'fallback'
+
+        model.reset_values()
+        if job.values is not None:
+            model.values.update(job.values)
+        if monitor is not None:
+            monitor.reset()
+        fit_method = getattr(model, 'fit_' + job.fit_method)
+        if job.checkboxes is not None:
+            fit_method(job.f, job.y, dict((p, CheckState(job.checkboxes[p])) for p in job.checkboxes))
+        else:
+            fit_method(job.f, job.y)
+        values = dict(model.values)
+
+        state = None
+        if monitor is not None and monitor.nfev:
+            nfev += monitor.nfev
+            w = 2.*np.pi*job.f
+            mask = np.logical_and(w >= monitor.wmin, w <= monitor.wmax)
+            state = dict(values=values, varied=monitor.varied, wmin=monitor.wmin, wmax=monitor.wmax, nfev=monitor.nfev,
+                         residual=_residual(model, values, w[mask], job.y[mask]))
+        return FitResult(job.filename, values, None, nfev, start), state
+    except Exception:
+        return FitResult(job.filename, None, traceback.format_exc(), 0, 'cold'), None
+
+def _fit_one(job):
+    return fit_spectrum(job)[0]
+
+def fit_sweep(jobs, divergence=2.):
+    """Fit a sweep of spectra in order with warm start (the first one, and
+    those after a failed fit, with cold start).
+
+    Returns
+    -------
+    list of FitResult
+    """
+    results = []
+    state = None
+    for job in jobs:
+        result, state = fit_spectrum(job, state, divergence)
+        results.append(result)
+    return results
+
+
+def sweep_order(jobs, param):
+    """Sort the jobs by a parameter in the file names (numbers numerically)."""
+    def key(job):
+        value = params_from_filename(job.filename).get(param)
+        try:
+            return (0, float(value), '')
+        except (TypeError, ValueError):
+            return (1, 0., str(value))
+    return sorted(jobs, key=key)
+
+def warm_start_stats(results):
+    """Summarize the results of a fit with warm start.
+
+    The number of evaluations saved is estimated with the average number of
+    evaluations of the cold starts.
+
+    Returns
+    -------
+    dict with the number of 'cold', 'warm', 'fallback' and 'cached' fits,
+    the total number of evaluations 'nfev' and 'nfev_saved'
+    """
+    results = [r for r in results if r.error is None]
+    stats = dict((start, sum(1 for r in results if r.start == start))
+                 for start in ['cold', 'warm', 'fallback', 'cached'])
+    stats['nfev'] = sum(r.nfev for r in results)
+    cold = [r.nfev for r in results if r.start == 'cold']
+    mean_cold = float(sum(cold))/len(cold) if cold else 0.
+    stats['nfev_saved'] = int(round(sum(mean_cold - r.nfev for r in results if r.start != 'cold')))
+    return stats
+
+
+def fit_spectra(jobs, processes=None, poll=None, interval=0.05, warm_start=None, divergence=2., cache=None,
+                model_func=None, window=None):
+    """Fit spectra in a pool of processes.
+
+    Arguments
+    ---------
+    jobs : iterable of FitJob
+        the spectra to fit, e.g. a generator preparing the spectra one after
+        the other: the jobs are only taken when there is room in the window,
+        so that the spectra are prepared while the previous ones are fitted
+        (with warm start, all jobs are taken before the fits start)
+    processes : int or None
+        the number of worker processes (default: number of CPUs)
+    poll : function or None
+        called regularly while taking the jobs and waiting for the results
+        (e.g. to process GUI events), the fit is cancelled if it returns False
+    interval : float
+        the time in seconds between two calls of poll while waiting
+    warm_start : string or None
+        the file name parameter of the sweep (e.g. 'Vg') for warm start: the
+        sorted spectra are split into one sweep per process (see fit_sweep)
+        and the results of a sweep arrive together
+    divergence : float
+        see fit_spectrum
+    cache : FitCache or None
+        the jobs that are in the cache are not fitted, their results are
+        yielded when the jobs are taken; the new results are added to the
+        cache (the caller saves it)
+    model_func : string or None
+        the name of the model function of the jobs that do not give one (see
+        FitJob)
+    window : int or None
+        the maximum number of spectra waiting for a worker or being fitted
+        (default: 4 per process)
+
+    Returns
+    -------
+    generator of FitResult in the order in which the fits complete; closing
+    the generator cancels the remaining fits
+    """
+    processes = processes or multiprocessing.cpu_count()
+    window = window or 4*processes
+    if model_func is not None:
+        jobs = (job._replace(model_func=model_func) if job.model_func is None else job for job in jobs)
+    jobs = iter(jobs)
+    keys = {}
+    sweep = []          # the jobs to fit with warm start
+    pending = []        # the results of the fits (or sweeps) running
+    pool = None
+
+    def store(result):
+        if cache is not None and result.error is None:
+            cache.put(keys[result.filename], result.values)
+        return result
+
+    try:
+        while True:
+            # take jobs until the window is full (with warm start, all of them)
+            while jobs is not None and (warm_start or len(pending) < window):
+                if poll is not None and poll() is False:
+                    return
+                job = next(jobs, None)
+                if job is None:
+                    jobs = None
+                    break
+                if cache is not None:
+                    keys[job.filename] = fit_key(job, warm_start, divergence)
+                    values = cache.get(keys[job.filename])
+                    if values is not None:
+                        yield FitResult(job.filename, values, None, 0, 'cached')
+                        continue
+                if warm_start:
+                    sweep.append(job)
+                    continue
+                if pool is None:
+                    pool = multiprocessing.Pool(processes)
+                pending.append(pool.apply_async(_fit_one, (job,)))
+            if sweep:
+                sweep = sweep_order(sweep, warm_start)
+                size = -(-len(sweep)//processes)
+                pool = multiprocessing.Pool(min(processes, len(sweep)))
+                pending = [pool.apply_async(fit_sweep, (sweep[k:k+size], divergence))
+                           for k in range(0, len(sweep), size)]
+                sweep = []
+            if not pending:
+                return
+            if poll is not None and poll() is False:
+                return
+            done = [r for r in pending if r.ready()]
+            if not done:
+                pending[0].wait(interval)
+            for r in done:
+                pending.remove(r)
+                if warm_start:
+                    for result in r.get():
+                        yield store(result)
+                else:
+                    yield store(r.get())
+    finally:
+        # kills the workers if the fit was cancelled
+        if pool is not None:
+            pool.terminate()
+            pool.join()
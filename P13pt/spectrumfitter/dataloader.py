@@ -1,26 +1,58 @@
 import os
-from glob import glob
+import threading
+from functools import partial
 import numpy as np
 from matplotlib import pyplot as plt
-from P13pt.rfspectrum import Network
-from PyQt5.QtCore import QSignalMapper, pyqtSignal, pyqtSlot, QTimer
+from P13pt.rfspectrum import Network, NetworkStack, ThruDeembedder, STACK_EXTENSION
+from P13pt.spectrumfitter.preparation import (check_deembedding_compatibility, check_resampling_compatibility,
+                                              DeembeddingError, run_stages, SpectrumCache, SpectrumPipeline,
+                                              spectra_files)
+from PyQt5.QtCore import QSignalMapper, pyqtSignal, pyqtSlot, QTimer, QThreadPool, QRunnable
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLineEdit, QLabel,
-                             QFileDialog, QMessageBox, QDialog)
+                             QFileDialog, QMessageBox, QDialog, QSpinBox)
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 
-def check_deembedding_compatibility(ntwk1, ntwk2):
-    # TODO: careful when de-embedding thru from thru
-    return ntwk1.number_of_ports == ntwk2.number_of_ports and len(ntwk1.f) == len(ntwk2.f) and np.max(np.abs(ntwk1.f - ntwk2.f)) < 1e-3
+class SpectrumJob(QRunnable):
+    # loads and prepares a spectrum in a worker thread (see DataLoader.prefetch),
+    # starting from the latest stage that was cached when the job was created
+    def __init__(self, filename, load, start, dut, settings, generation, notify):
+        super(SpectrumJob, self).__init__()
+        self.setAutoDelete(False)       # the data loader keeps the job to get the results
+        self.filename = filename
+        self.load = load
+        self.start = start
+        self.dut = dut
+        self.settings = settings
+        self.generation = generation
+        self.notify = notify
+        self.results = []               # (stage, network) as in SpectrumPipeline.store
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            dut = self.dut
+            if dut is None:
+                dut = self.load()
+                self.results.append(('raw', dut))
+            run_stages(dut, self.settings, self.start, self.results)
+        except Exception:
+            # the failing stage will be run again (with warnings) when the spectrum is selected
+            pass
+        self.done.set()
+        self.notify.emit(self)
 
 class DataLoader(QWidget):
     dataset_changed = pyqtSignal()
     new_file_in_dataset = pyqtSignal(str)
     deembedding_changed = pyqtSignal()
+    cache_changed = pyqtSignal()
+    spectrum_prepared = pyqtSignal(object)
     dut_folder = None
     dut_files = None
+    dut_stack = None
     dummy_raw = None
     dummy_deem = None
     dummy = None
@@ -28,9 +60,13 @@ class DataLoader(QWidget):
     dummy_toggle_status = True
     thru = None
     thru_file = None
+    thru_deembedder = None
     thru_toggle_status = True
     ra = None
-    duts = {}
+    duts = None             # cache of the spectra by (stage, file name), see SpectrumPipeline
+    cache_budget = 512      # MB
+    pipeline = None
+    prefetch_count = 2      # number of spectra prepared in advance on each side of the selection
 
     def __init__(self, parent=None):
         super(QWidget, self).__init__(parent)
@@ -69,6 +105,12 @@ class DataLoader(QWidget):
 
         self.btn_load = QPushButton('Load dataset')
         self.txt_ra = QLineEdit()
+        self.spn_cache = QSpinBox()
+        self.spn_cache.setRange(16, 1024*1024)
+        self.spn_cache.setSuffix(' MB')
+        self.spn_cache.setValue(self.cache_budget)
+        self.spn_cache.setToolTip('Memory used to keep prepared spectra')
+        self.lbl_cache = QLabel()
 
         l = QVBoxLayout()
         for field in [[QLabel('DUT:'), self.txt_dut, self.btn_browsedut_file, self.btn_browsedut_folder],
@@ -84,11 +126,27 @@ class DataLoader(QWidget):
         for w in [QLabel('Contact resistance:'), self.txt_ra, self.btn_load]:
             hl.addWidget(w)
         l.addLayout(hl)
+        hl = QHBoxLayout()
+        for w in [QLabel('Cache:'), self.spn_cache, self.lbl_cache]:
+            hl.addWidget(w)
+        hl.addStretch()
+        l.addLayout(hl)
         self.setLayout(l)
 
+        # set up spectrum cache
+        self.duts = SpectrumCache(self.cache_budget*1024**2)
+        self.pipeline = SpectrumPipeline(self.duts)
+        self.pending = {}       # prefetch jobs by file name
+        self.update_cache_stats()
+
         # initialise data loader
         self.clear()
 
+        # set up worker threads for prefetching
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(2)
+        self.spectrum_prepared.connect(self.prefetch_done)
+
         # set up folder watcher
         self.timer = QTimer()
         self.timer.setInterval(1000)       # check for changes every second
@@ -107,6 +165,8 @@ class DataLoader(QWidget):
         self.btn_plotdummy.clicked.connect(self.plot_dummy)
         self.btn_plotthru.clicked.connect(self.plot_thru)
         self.btn_load.clicked.connect(self.load_dataset)
+        self.txt_ra.editingFinished.connect(self.ra_changed)
+        self.spn_cache.valueChanged.connect(self.set_cache_budget)
 
     def browse(self, x):
         # open browser and update the text field
@@ -121,24 +181,7 @@ class DataLoader(QWidget):
                 self.__dict__['txt_'+field].setText(filename)
 
     def get_spectra_files(self, path, tellmeifitsafolder=False):
-        supported_exts = ['.txt', '.s2p', '.dat']
-        folder = None
-        files = []
-        itsafolder = False
-
-        if os.path.isdir(path):
-            folder = path
-            for ext in supported_exts:
-                files += [os.path.basename(x) for x in sorted(glob(os.path.join(folder, '*'+ext)))]
-            itsafolder = True
-        elif os.path.isfile(path):
-            basename, ext = os.path.splitext(path)
-            if ext.lower() in supported_exts:
-                folder = os.path.dirname(path)
-                files += [path]
-        else:
-            pass
-
+        folder, files, itsafolder = spectra_files(path)
         if tellmeifitsafolder:
             return folder, files, itsafolder
         else:
@@ -154,8 +197,10 @@ class DataLoader(QWidget):
         self.empty_cache()
         self.dut_folder = None
         self.dut_files = None
+        self.dut_stack = None
         self.thru_file = None
         self.thru = None
+        self.thru_deembedder = None
         self.dummy_file = None
         self.dummy_raw = None
         self.dummy_deem = None
@@ -182,6 +227,11 @@ class DataLoader(QWidget):
         if not self.dut_files:
             QMessageBox.warning(self, 'Warning', 'Please select a valid DUT folder or file')
 
+        if self.dut_files and self.dut_folder.rstrip('/\\').endswith(STACK_EXTENSION):
+            # the spectra are memory mapped and only read when they are used
+            self.dut_stack = NetworkStack.from_stack_folder(self.dut_folder)
+            itsafolder = False
+
         # if the user loaded a folder, switch on the folder watcher
         if itsafolder:
             self.timer.start()
@@ -204,99 +254,185 @@ class DataLoader(QWidget):
         if self.dummy_file:
             try:
                 self.dummy_raw = Network(self.dummy_file)
-                assert self.dummy_raw.number_of_ports == 2
                 self.btn_toggledummy.setEnabled(True)
                 self.btn_plotdummy.setEnabled(True)
             except Exception as e:
                 QMessageBox.warning(self, 'Warning',
-                                    'File: ' + self.dummy_file + ' is not a valid 2-port RF spectrum file.')
+                                    'File: ' + self.dummy_file + ' is not a valid RF spectrum file.')
                 self.dummy_raw = None
 
         if self.thru_file:
             try:
                 self.thru = Network(self.thru_file)
-                assert self.thru.number_of_ports == 2
+                # the ports are split into an input and an output side
+                assert self.thru.number_of_ports % 2 == 0
+                self.thru_deembedder = ThruDeembedder.for_thru(self.thru)
                 self.btn_togglethru.setEnabled(True)
                 self.btn_plotthru.setEnabled(True)
             except Exception as e:
                 QMessageBox.warning(self, 'Warning',
-                                    'File: ' + self.thru_file + ' is not a valid 2-port RF spectrum file.')
+                                    'File: ' + self.thru_file + ' is not a valid RF spectrum file '
+                                    '(with an even number of ports).')
                 self.thru = None
+                self.thru_deembedder = None
 
         self.dummy_deem = None
         if self.dummy_raw and self.thru:
             # check for mHz deviation, since sometimes the frequency value saved is
             # not 100% equal when importing from different file formats...
-            if not check_deembedding_compatibility(self.dummy_raw, self.thru):
+            if check_deembedding_compatibility(self.dummy_raw, self.thru):
+                self.dummy_deem = self.thru_deembedder.deembed(self.dummy_raw)
+            elif check_resampling_compatibility(self.dummy_raw, self.thru):
+                # the thru is interpolated onto the frequency grid of the dummy
+                self.dummy_deem = self.thru_deembedder.on_grid(self.dummy_raw.f).deembed(self.dummy_raw)
+            else:
                 QMessageBox.warning(self, 'Warning', 'Dummy and thru are not compatible')
                 self.dummy_raw = None
                 self.thru = None
+                self.thru_deembedder = None
                 for w in [self.btn_toggledummy, self.btn_togglethru, self.btn_plotdummy, self.btn_plotthru]:
                     w.setEnabled(False)
-            else:
-                self.dummy_deem = self.dummy_raw.deembed_thru(self.thru)
 
         self.dummy = self.dummy_deem if (self.thru_toggle_status and self.thru) else self.dummy_raw
 
         self.dataset_changed.emit()
 
+    def load_raw(self, index):
+        # get a function that loads the raw spectrum (to be called in any thread)
+        if self.dut_stack is not None:
+            return partial(self.dut_stack.network, index)
+        return partial(Network, os.path.join(self.dut_folder, self.dut_files[index]))
+
+    def deembedding_settings(self):
+        # the current de-embedding settings (see SpectrumPipeline)
+        try:
+            ra = float(self.txt_ra.text())
+        except ValueError:
+            ra = 0.
+        return dict(thru=self.thru_deembedder if self.thru and self.thru_toggle_status else None,
+                    dummy=self.dummy if self.dummy and self.dummy_toggle_status else None,
+                    ra=ra)
+
+    def update_pipeline(self):
+        # pass the current settings to the pipeline, which drops the results of the stages
+        # that changed (and of the ones after them)
+        changed = self.pipeline.configure(**self.deembedding_settings())
+        if changed is not None:
+            self.cancel_prefetch()
+            self.update_cache_stats()
+        return changed
+
     def get_spectrum(self, index):
-        # check if the spectrum is already prepared
         filename = self.dut_files[index]
-        if filename in self.duts:
-            return self.duts[filename]
-        else:
-            # try to load spectrum and check its compatibility
+        self.update_pipeline()
+
+        # check if it is being prefetched
+        job = self.pending.pop(filename, None)
+        if job is not None and not self.pool.tryTake(job):
+            # the job is already running, wait for it
+            job.done.wait()
+            self.pipeline.store(filename, job.results)
+
+        try:
+            float(self.txt_ra.text())
+        except ValueError:
+            QMessageBox.warning(self, 'Warning', 'Invalid value for contact resistance. Using zero.')
+        while True:
             try:
-                dut = Network(os.path.join(self.dut_folder, filename))
-            except Exception:
-                QMessageBox.warning(self, 'Warning', 'File: ' + filename + ' is not a valid RF spectrum file.')
-                return None
-            if self.thru and self.thru_toggle_status:
-                if check_deembedding_compatibility(dut, self.thru):
-                    dut = dut.deembed_thru(self.thru)
-                else:
-                    QMessageBox.warning(self, 'Warning', 'Could not deembed thru.')
+                # only the stages that are not cached are run
+                dut = self.pipeline.prepare(filename, self.load_raw(index))
+                break
+            except DeembeddingError as e:
+                QMessageBox.warning(self, 'Warning', str(e))
+                if e.stage == 'thru':
                     self.thru_toggle_status = False
                     self.btn_togglethru.setIcon(self.toggleoff_icon)
-            if self.dummy and self.dummy_toggle_status:
-                if check_deembedding_compatibility(dut, self.dummy):
-                    dut.y -= self.dummy.y
                 else:
-                    QMessageBox.warning(self, 'Warning', 'Could not deembed dummy.')
                     self.dummy_toggle_status = False
                     self.btn_toggledummy.setIcon(self.toggleoff_icon)
-            try:
-                ra = float(self.txt_ra.text())
-            except:
-                QMessageBox.warning(self, 'Warning', 'Invalid value for contact resistance. Using zero.')
-                ra = 0.
-            if not ra == 0:
-                y = np.zeros(dut.y.shape, dtype=complex)
-                y[:, 0, 0] = 1. / (1. / dut.y[:, 0, 0] - ra)
-                y[:, 0, 1] = 1. / (1. / dut.y[:, 0, 1] + ra)
-                y[:, 1, 0] = 1. / (1. / dut.y[:, 1, 0] + ra)
-                y[:, 1, 1] = 1. / (1. / dut.y[:, 1, 1] - ra)
-                dut.y = y
-            self.duts[filename] = dut
-            return dut
+                self.update_pipeline()
+            except Exception:
+                QMessageBox.warning(self, 'Warning', 'File: ' + filename + ' is not a valid RF spectrum file.')
+                dut = None
+                break
+        self.update_cache_stats()
+        return dut
+
+    def prefetch(self, index):
+        # prepare the spectra around index in worker threads
+        if not self.dut_files:
+            return
+        self.update_pipeline()
+        wanted = []     # closest first
+        for offset in range(1, self.prefetch_count+1):
+            wanted += [i for i in [index+offset, index-offset] if 0 <= i < len(self.dut_files)]
+        filenames = [self.dut_files[i] for i in wanted]
+
+        # drop queued jobs that are no longer close to the selection
+        for filename, job in list(self.pending.items()):
+            if filename not in filenames and self.pool.tryTake(job):
+                del self.pending[filename]
+
+        prepared = set(self.pipeline.prepared())
+        for i, filename in zip(wanted, filenames):
+            if filename in prepared or filename in self.pending:
+                continue
+            start, dut = self.pipeline.lookup(filename)
+            job = SpectrumJob(filename, self.load_raw(i), start, dut, dict(self.pipeline.settings),
+                              self.pipeline.generation, self.spectrum_prepared)
+            self.pending[filename] = job
+            self.pool.start(job)
+
+    def prefetch_done(self, job):
+        if self.pending.get(job.filename) is job:
+            del self.pending[job.filename]
+        # results obtained with outdated settings are discarded
+        if job.generation == self.pipeline.generation and job.results:
+            self.pipeline.store(job.filename, job.results)
+            self.update_cache_stats()
+
+    def cancel_prefetch(self):
+        # running jobs cannot be interrupted, but their results will be discarded (the pipeline
+        # generation changes whenever cached results are dropped)
+        for job in self.pending.values():
+            self.pool.tryTake(job)
+        self.pending = {}
 
     def empty_cache(self):
-        self.duts = {}          # empty the DUT dictionary
+        self.cancel_prefetch()
+        self.pipeline.invalidate()      # empty the DUT cache
+        self.update_cache_stats()
+
+    def set_cache_budget(self, megabytes):
+        self.cache_budget = megabytes
+        self.duts.set_budget(megabytes*1024**2)
+        self.update_cache_stats()
+
+    def update_cache_stats(self):
+        stats = self.duts.stats()
+        self.lbl_cache.setText('{} spectra, {:.1f} MB used, {} hits, {} misses, {} evictions'.format(
+            len(self.pipeline.prepared()), stats['nbytes']/1024.**2, stats['hits'], stats['misses'],
+            stats['evictions']))
+        self.cache_changed.emit()
 
     def toggle_thru(self):
-        self.empty_cache()
         self.thru_toggle_status = not self.thru_toggle_status
         self.btn_togglethru.setIcon(self.toggleon_icon if self.thru_toggle_status else self.toggleoff_icon)
         self.dummy = self.dummy_deem if (self.thru_toggle_status and self.thru) else self.dummy_raw
+        self.update_pipeline()
         self.deembedding_changed.emit()
 
     def toggle_dummy(self):
-        self.empty_cache()
         self.dummy_toggle_status = not self.dummy_toggle_status
         self.btn_toggledummy.setIcon(self.toggleon_icon if self.dummy_toggle_status else self.toggleoff_icon)
+        self.update_pipeline()
         self.deembedding_changed.emit()
 
+    def ra_changed(self):
+        # only the contact resistance correction is redone (if the value changed)
+        if self.dut_files and self.update_pipeline() is not None:
+            self.deembedding_changed.emit()
+
     def plot_dummy(self):
         dialog = QDialog(self)
         dialog.setWindowTitle('Dummy'+(' (deembedded thru)' if self.thru and self.thru_toggle_status else ''))
@@ -0,0 +1,110 @@
+"""
+Persistent cache of fit results.
+
+A fit result is stored under a hash of everything the fit depends on: the
+fitted data (after de-embedding) and its frequencies, the source of the model
+file, the model function, the fit method, the states of the check boxes, the
+initial values and the warm start settings. Fitting a spectrum again with the same inputs returns the
+cached values without running the fit.
+"""
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+_sources = {}   # model file -> (modification time, size, hash of the contents)
+
+
+def _model_hash(model_file):
+    stat = os.stat(model_file)
+    if model_file not in _sources or _sources[model_file][:2] != (stat.st_mtime, stat.st_size):
+        with open(model_file, 'rb') as f:
+            _sources[model_file] = (stat.st_mtime, stat.st_size, hashlib.sha1(f.read()).hexdigest())
+    return _sources[model_file][2]
+
+
+def fit_key(job, warm_start=None, divergence=None):
+    """Get the key of a fit (see batchfit.FitJob) in the cache.
+
+    Arguments
+    ---------
+    job : FitJob
+        the fit
+    warm_start, divergence :
+        the warm start settings of the fit (see batchfit.fit_spectra)
+
+    Returns
+    -------
+    string
+    """
+    h = hashlib.sha1()
+    for a in [job.f, job.y]:
+        h.update(np.ascontiguousarray(a, dtype=np.complex128 if np.iscomplexobj(a) else np.float64).tobytes())
+    values = None if job.values is None else sorted((p, repr(float(v))) for p, v in job.values.items())
+    checkboxes = None if job.checkboxes is None else sorted((p, bool(c)) for p, c in job.checkboxes.items())
+    divergence = None if divergence is None else repr(float(divergence))
+    h.update(json.dumps([_model_hash(job.model_file), job.model_func, job.fit_method, checkboxes, values,
+                         warm_start, divergence]).encode())
+    return h.hexdigest()
+
+
+class FitCache(object):
+    """Fit results by key (see fit_key), saved in a JSON file.
+
+    Arguments
+    ---------
+    filename : string or None
+        the cache file (None: the cache is not saved)
+    max_entries : int
+        the least recently stored entries are dropped when the cache has more
+        entries
+    """
+    def __init__(self, filename=None, max_entries=100000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.results = OrderedDict()    # from the oldest to the newest entry
+        self.modified = False
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    entries = json.load(f)
+                for key, values in entries:
+                    self.put(key, values)
+            except (ValueError, TypeError):
+                self.results = OrderedDict()    # the file is broken, start again
+            self.modified = False
+
+    def __len__(self):
+        return len(self.results)
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def get(self, key):
+        """Get the fitted values of a key (None if not in the cache)."""
+        values = self.results.get(key)
+        return None if values is None else dict(values)
+
+    def put(self, key, values):
+        # (re-)insert as the newest entry
+        self.results.pop(key, None)
+        self.results[key] = dict(values)
+        while len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+        self.modified = True
+
+    def clear(self):
+        self.results = OrderedDict()
+        self.modified = True
+
+    def save(self):
+        if not self.filename or not self.modified:
+            return
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(self.filename, 'w') as f:
+            json.dump(list(self.results.items()), f)
+        self.modified = False
@@ -0,0 +1,153 @@
+"""Fit all spectra of a session without the GUI (e.g. on a compute server).
+
+Usage: p13pt-fit [-h] [-o OUTPUT] [-m MODELS] [-j PROCESSES] [--fit-method FIT_METHOD]
+                 [--fixed PARAM [PARAM ...]] [-w PARAM] [--cache CACHE] session
+
+The session file (as saved by the spectrum fitter) provides the dataset (dut,
+thru, dummy, ra), the fitted parameter, the model and the fit method. The
+fitted values of the session are used as initial values and the results are
+written in the same format, by default to the session file itself.
+"""
+from __future__ import print_function
+import os
+import sys
+import argparse
+
+from P13pt.spectrumfitter.preparation import Dataset
+from P13pt.spectrumfitter.load_fitresults import load_fitresults, save_fitresults, values_from_fitresults
+from P13pt.spectrumfitter.fitcache import FitCache
+from P13pt.spectrumfitter.batchfit import (FitJob, fit_spectra, fitted_data, load_model_class, model_methods,
+                                           takes_checkboxes, warm_start_stats)
+
+builtin_models_dir = os.path.join(os.path.dirname(__file__), 'models')
+models_dir = os.path.join(os.path.expanduser('~'), 'SpectrumFitterModels')     # see Fitter
+
+
+def find_model(name, folders):
+    for folder in folders:
+        filename = os.path.join(folder, name)
+        if os.path.isfile(filename):
+            return filename
+    raise Exception('Could not find model ' + name + ' in: ' + ', '.join(folders))
+
+
+def fit_session(session_file, output=None, models=None, processes=None, fit_method=None, fixed=(), warm_start=None,
+                cache=None, log=print):
+    """Fit all spectra of a session and save the results.
+
+    Arguments
+    ---------
+    session_file : string
+        the results file of the session
+    output : string or None
+        the results file to write (default: the session file)
+    models : string or None
+        the folder with the model files (default: ~/SpectrumFitterModels,
+        the built-in models are used if the model is not found there)
+    processes : int or None
+        number of worker processes (default: number of CPUs)
+    fit_method : string or None
+        the fit method (default: the one of the session, or the first one
+        of the model)
+    fixed : list of strings
+        parameters that are not varied by fit methods with check boxes (all
+        the others are)
+    warm_start : string or None
+        the file name parameter of the sweep for warm start (see
+        batchfit.fit_spectra)
+    cache : string or None
+        the fit cache file (see fitcache), the spectra that were fitted
+        with the same inputs are not fitted again
+    log : function
+        prints the progress
+
+    Returns
+    -------
+    dict of the fitted values by file name (the spectra that could not be
+    fitted are left out)
+    """
+    res_folder = os.path.dirname(os.path.abspath(session_file))
+    data, dut, thru, dummy, ra, fitter_info = load_fitresults(session_file, readfilenameparams=False, extrainfo=True)
+    if not dut:
+        raise Exception('No DUT in session file: ' + session_file)
+    if 'model' not in fitter_info:
+        raise Exception('No model in session file: ' + session_file)
+
+    # using os.path.realpath to get rid of relative path remainders ("..")
+    path = lambda p: os.path.realpath(os.path.join(res_folder, p)) if p else None
+    dataset = Dataset(path(dut), path(thru), path(dummy), ra if ra else 0.)
+
+    model_file = find_model(fitter_info['model'], [models or models_dir, builtin_models_dir])
+    model_class = load_model_class(model_file)
+    fit_method = fit_method or fitter_info.get('fit_method') or model_methods(model_class, 'fit_')[0]
+    model_func = fitter_info.get('model_func') or model_methods(model_class, 'func_')[0]
+    fitted_param = fitter_info.get('fitted_param', '-Y12')
+    if takes_checkboxes(getattr(model_class, 'fit_' + fit_method)):
+        checkboxes = dict((p, p not in fixed) for p in model_class.params)
+    else:
+        checkboxes = None
+    model_params = values_from_fitresults(data) if data else {}
+
+    jobs = []
+    for i, filename in enumerate(dataset.files):
+        try:
+            network = dataset.get_spectrum(i)
+        except Exception as e:
+            log(filename + ': could not prepare spectrum: ' + str(e))
+            continue
+        jobs.append(FitJob(filename, network.f, fitted_data(network, fitted_param), model_file, fit_method,
+                           checkboxes, model_params.get(filename), model_func))
+
+    fit_cache = FitCache(cache) if cache else None
+    results = {}
+    fits = []
+    for k, fit in enumerate(fit_spectra(jobs, processes, warm_start=warm_start, cache=fit_cache,
+                                        model_func=model_func)):
+        fits.append(fit)
+        if fit.error is None:
+            results[fit.filename] = fit.values
+            log('[{}/{}] {} ({} start)'.format(k+1, len(jobs), fit.filename, fit.start))
+        else:
+            log('[{}/{}] {}: error during fit:\n{}'.format(k+1, len(jobs), fit.filename, fit.error))
+    stats = warm_start_stats(fits)
+    if warm_start:
+        log('Warm start: {warm} warm, {fallback} fallback and {cold} cold start(s), '
+            '{nfev} function evaluations, about {nfev_saved} saved'.format(**stats))
+    if fit_cache is not None:
+        fit_cache.save()
+        log('{} of {} fit results from the fit cache'.format(stats['cached'], len(fits)))
+
+    # the single file or the folder, like the spectrum fitter
+    dut = os.path.join(dataset.folder, dataset.files[0]) if len(dataset.files) == 1 else dataset.folder
+    model_params.update(results)
+    save_fitresults(output or session_file, dut, dataset.files, path(thru), path(dummy), dataset.ra, fitted_param,
+                    model_file, model_func, fit_method, list(model_class.params), model_params)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit all spectra of a spectrum fitter session.')
+    parser.add_argument('session', help='session (fit results) file')
+    parser.add_argument('-o', '--output', help='results file (default: overwrite the session file)')
+    parser.add_argument('-m', '--models', help='model folder (default: ~/SpectrumFitterModels)')
+    parser.add_argument('-j', '--processes', type=int, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--fit-method', help='fit method (default: the one of the session)')
+    parser.add_argument('--fixed', nargs='+', default=[], metavar='PARAM',
+                        help='parameters that are not varied by fit methods with check boxes')
+    parser.add_argument('-w', '--warm-start', metavar='PARAM',
+                        help='fit the sweep of this file name parameter (e.g. Vg) in order, starting each '
+                             'fit from the values of the previous spectrum')
+    parser.add_argument('--cache', help='fit cache file, the spectra that were fitted with the same inputs '
+                                        'are not fitted again')
+    args = parser.parse_args()
+
+    try:
+        fit_session(args.session, args.output, args.models, args.processes, args.fit_method, args.fixed,
+                    args.warm_start, args.cache)
+    except Exception as e:
+        print('Error:', e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
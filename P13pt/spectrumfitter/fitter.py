@@ -10,6 +10,10 @@ from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QCo
                              QLineEdit, QFileDialog, QWidgetItem, QMessageBox, QCheckBox,
                              QSlider, QSpinBox, QLabel)
 
+from P13pt.spectrumfitter.batchfit import (parse_fitted_param_str, create_fitted_param_str, fitted_data,
+                                           takes_checkboxes, FitJob)
+from P13pt.spectrumfitter.load_fitresults import values_from_fitresults
+
 def clearLayout(layout):
     for i in reversed(range(layout.count())):
         item = layout.itemAt(i)
@@ -19,21 +23,6 @@ def clearLayout(layout):
             clearLayout(item.layout())
         layout.removeItem(item)
 
-def parse_fitted_param_str(s):
-    sign = -1. if s[0] == '-' else +1
-    param = s[1]
-    i = int(s[2]) - 1
-    j = int(s[3]) - 1
-    return sign, param, i, j
-
-def create_fitted_param_str(sign, param, i, j, unit=False):
-    unit_string = ' [mS]' if param.lower() == 'y' else ''
-    return ('+' if sign > 0 else '-') + \
-        param + \
-        str(i + 1) + \
-        str(j + 1) + \
-        (unit_string if unit else '')
-
 class Fitter(QWidget):
     filename = None
     network = None
@@ -41,6 +30,7 @@ class Fitter(QWidget):
     model_file = None
     sliders = {}
     checkboxes = {}
+    fit_modes = {}
     fit_changed = pyqtSignal()
     fitted_param_changed = pyqtSignal(str)
     _fitted_param = None       # default value
@@ -78,8 +68,15 @@ class Fitter(QWidget):
         self.btn_browsemodel = QPushButton(browse_icon, '')
         self.cmb_modelfunc = QComboBox()
         self.cmb_fitmethod = QComboBox()
+        self.cmb_warmstart = QComboBox()
+        self.cmb_warmstart.addItem('Off')
+        self.cmb_warmstart.setToolTip('Fit all: fit the spectra in the order of this file name parameter, '
+                                      'starting from the values of the previous spectrum')
         self.btn_fit = QPushButton('Fit')
         self.btn_fitall = QPushButton('Fit all')
+        self.btn_globalfit = QPushButton('Global fit')
+        self.btn_globalfit.setToolTip('Fit all spectra together, with the shared parameters '
+                                      'the same for all of them')
         self.sliderwidget = QWidget()
 
         # layouts
@@ -97,12 +94,16 @@ class Fitter(QWidget):
         l4 = QHBoxLayout()
         for w in [QLabel('Fit method:'), self.cmb_fitmethod]:
             l4.addWidget(w)
+        l5 = QHBoxLayout()
+        for w in [QLabel('Warm start:'), self.cmb_warmstart]:
+            l5.addWidget(w)
         l = QVBoxLayout()
         l.addLayout(l1)
         l.addLayout(l2)
         l.addLayout(l3)
         l.addLayout(l4)
-        for w in [self.btn_fit, self.btn_fitall, self.sliderwidget]:
+        l.addLayout(l5)
+        for w in [self.btn_fit, self.btn_fitall, self.btn_globalfit, self.sliderwidget]:
             l.addWidget(w)
         self.setLayout(l)
 
@@ -116,6 +117,7 @@ class Fitter(QWidget):
         # disable buttons while no model is loaded
         self.btn_fit.setEnabled(False)
         self.btn_fitall.setEnabled(False)
+        self.btn_globalfit.setEnabled(False)
 
     @property
     def fitted_param(self):
@@ -160,11 +162,13 @@ class Fitter(QWidget):
         self.empty_cache()
         self.sliders = {}
         self.checkboxes = {}
+        self.fit_modes = {}
         clearLayout(self.sl_layout)
         self.cmb_fitmethod.clear()
         self.cmb_modelfunc.clear()
         self.btn_fit.setEnabled(False)
         self.btn_fitall.setEnabled(False)
+        self.btn_globalfit.setEnabled(False)
 
     def update_network(self, network, filename):
         self.network = network
@@ -177,6 +181,18 @@ class Fitter(QWidget):
     def empty_cache(self):
         self.model_params = {}
 
+    def update_sweep_params(self, params):
+        # file name parameters that can be used for warm start
+        current = self.cmb_warmstart.currentText()
+        self.cmb_warmstart.clear()
+        self.cmb_warmstart.addItem('Off')
+        for p in sorted(params):
+            self.cmb_warmstart.addItem(p)
+        self.cmb_warmstart.setCurrentText(current)
+
+    def warm_start_param(self):
+        return self.cmb_warmstart.currentText() if self.cmb_warmstart.currentIndex() > 0 else None
+
     @pyqtSlot()
     def load_model(self, filename=None, info={}, data=None):
         # unload previous model
@@ -225,10 +241,7 @@ class Fitter(QWidget):
         for member in inspect.getmembers(self.model, predicate=inspect.ismethod):
             if member[0].startswith('fit_'):
                 # check if for this function we want to show checkboxes or not
-                if len(inspect.getargspec(member[1]).args) == 4:
-                    enable_checkboxes = True
-                else:
-                    enable_checkboxes = False
+                enable_checkboxes = takes_checkboxes(member[1])
                 # add fit method to drop down list and put the enable_checkboxes value in the item data
                 self.cmb_fitmethod.addItem(member[0][4:], enable_checkboxes)
 
@@ -242,22 +255,29 @@ class Fitter(QWidget):
             sl = QSlider(Qt.Horizontal)
             self.sliders[p] = sl
             sl.id = p
-            sl.setMinimum(self.model.params[p][0])
-            sl.setMaximum(self.model.params[p][1])
+            sl.setMinimum(int(self.model.params[p][0]))
+            sl.setMaximum(int(self.model.params[p][1]))
             sb = QSpinBox()
-            sb.setMinimum(self.model.params[p][0])
-            sb.setMaximum(self.model.params[p][1])
+            sb.setMinimum(int(self.model.params[p][0]))
+            sb.setMaximum(int(self.model.params[p][1]))
             cb = QCheckBox()
             self.checkboxes[p] = cb
+            cmb = QComboBox()
+            for mode in ['per spectrum', 'shared', 'fixed']:
+                cmb.addItem(mode)
+            cmb.setToolTip('Global fit: the parameter is fitted for each spectrum, '
+                           'is the same for all spectra or is not varied')
+            self.fit_modes[p] = cmb
             sl.valueChanged[int].connect(sb.setValue)
             sb.valueChanged[int].connect(sl.setValue)
-            sl.setValue(self.model.params[p][2])
+            sl.setValue(int(self.model.params[p][2]))
             sl.valueChanged.connect(self.slider_value_changed)
             l = QHBoxLayout()
             l.addWidget(label)
             l.addWidget(sl)
             l.addWidget(sb)
             l.addWidget(cb)
+            l.addWidget(cmb)
             self.sl_layout.addLayout(l)
 
         # set up the info widget if it exists
@@ -272,34 +292,25 @@ class Fitter(QWidget):
             self.btn_fitall.setEnabled(True)
         else:
             self.cmb_fitmethod.addItem('No fit methods found')
+        # the global fit only needs the model function
+        self.btn_globalfit.setEnabled(True)
 
         # if data was provided, evaluate it
         if data:
-            # get a list of parameter names
-            params = [p for p in data]
-            unusable = []
-            # now check float conversion compatibility of the data columns, removing the ones that we cannot use
-            for p in params:
-                try:
-                    data[p] = [float(x) for x in data[p]]
-                except ValueError:
-                    unusable.append(p)
-            for p in unusable:
-                params.remove(p)
-
-            for i, f in enumerate(data['filename']):
-                values = [float(data[p][i]) for p in params]
-                self.model_params[f] = dict(zip(params, values))
+            self.model_params.update(values_from_fitresults(data))
 
         return True
 
     def slider_value_changed(self):
+        if not self.manual_mode:
+            # the sliders are set from the values (see update_values), which
+            # must not be rounded to the resolution of the sliders
+            return
         slider = self.sender()
         self.model.values[slider.id] = slider.value() * self.model.params[slider.id][3]
         self.model_params[self.filename] = copy(self.model.values)
         self.model.update_infowidget()
-        if self.manual_mode:
-            self.fit_changed.emit()
+        self.fit_changed.emit()
 
     def enable_checkboxes(self, b=True):
         for p in self.checkboxes:
@@ -316,7 +327,8 @@ class Fitter(QWidget):
         else:
             self.model.values.update(values)
         for p in self.model.values:
-            self.sliders[p].setValue(self.model.values[p] / self.model.params[p][3])
+            self.sliders[p].setValue(int(round(self.model.values[p] / self.model.params[p][3])))
+        self.model.update_infowidget()
         self.manual_mode = True
         self.fit_changed.emit()
 
@@ -325,19 +337,48 @@ class Fitter(QWidget):
             QMessageBox.warning(self, 'Warning', 'Please load some data first.')
             return
 
-        sign, param, i, j = parse_fitted_param_str(self.fitted_param)
-
-        param = self.network.y[:,i,j] if param == 'Y' \
-            else self.network.s[:,i,j]
+        param = fitted_data(self.network, self.fitted_param)
 
         fit_method = getattr(self.model, 'fit_' + str(self.cmb_fitmethod.currentText()))
         try:
             if self.cmb_fitmethod.itemData(self.cmb_fitmethod.currentIndex()):
-                fit_method(self.network.f, sign*param, self.checkboxes)
+                fit_method(self.network.f, param, self.checkboxes)
             else:
-                fit_method(self.network.f, sign*param)
+                fit_method(self.network.f, param)
         except Exception:
             QMessageBox.critical(self, "Error", "Error during fit: " + traceback.format_exc())
             return
 
-        self.update_values(self.model.values)
\ No newline at end of file
+        self.model_params[self.filename] = copy(self.model.values)
+        self.update_values(self.model.values)
+
+    def fit_job(self, network, filename):
+        """Describe the fit of a spectrum for the worker processes of
+        fit_spectra, with the current fit method and check boxes."""
+        if self.cmb_fitmethod.itemData(self.cmb_fitmethod.currentIndex()):
+            checkboxes = dict((p, self.checkboxes[p].isChecked()) for p in self.checkboxes)
+        else:
+            checkboxes = None
+        return FitJob(filename, network.f, fitted_data(network, self.fitted_param), self.model_file,
+                      str(self.cmb_fitmethod.currentText()), checkboxes, self.model_params.get(filename),
+                      str(self.cmb_modelfunc.currentText()))
+
+    def global_fit_params(self):
+        """Get the shared and the fixed parameters of the global fit."""
+        shared = [p for p in self.fit_modes if self.fit_modes[p].currentText() == 'shared']
+        fixed = [p for p in self.fit_modes if self.fit_modes[p].currentText() == 'fixed']
+        return shared, fixed
+
+    def initial_values(self, filename):
+        """Get the values of a spectrum (the default values if it was not
+        fitted yet)."""
+        if filename in self.model_params:
+            return self.model_params[filename]
+        return dict((p, self.model.params[p][2]*self.model.params[p][3]) for p in self.model.params)
+
+    def store_fit(self, filename, values):
+        """Store the result of a fit done in a worker process, the sliders
+        and the plot are only updated for the spectrum on screen."""
+        self.model_params[filename] = values
+        if filename == self.filename:
+            self.update_values(values)
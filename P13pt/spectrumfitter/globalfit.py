@@ -0,0 +1,153 @@
+"""
+Global fit of the spectra of a sweep with shared parameters.
+
+Some parameters (e.g. a contact resistance or the inductance of the line) are
+physically the same for all spectra of a sweep. In a global fit, these shared
+parameters and the per-spectrum parameters of all spectra are fitted together
+in a single least squares problem. The spectra are stacked in an (M, N) array
+(M spectra on the same grid of N frequencies) and the model function is
+evaluated for all of them at once (see BaseModel.evaluate).
+
+Each per-spectrum parameter only acts on the residual of its own spectrum,
+so the Jacobian is sparse: the finite differences only need one evaluation
+per parameter name (and not per spectrum), and the trust region solver works
+with the sparse matrix.
+"""
+from collections import namedtuple
+
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.sparse import coo_matrix
+
+from P13pt.spectrumfitter.basemodel import _arguments
+
+# the fitted values (one dictionary per spectrum) and the state of the solver
+GlobalFitResult = namedtuple('GlobalFitResult', ['values', 'success', 'message', 'nfev', 'cost'])
+
+
+def _column(values):
+    # the value of a parameter for all spectra: a scalar if it is the same
+    # for all of them
+    values = np.asarray(values, dtype=float)
+    if np.all(values == values[0]):
+        return values[0]
+    return values
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def global_fit(model, f, y, initial, shared=(), fixed=(), part=2, func=None, poll=None, **kws):
+    """Fit the model function to a stack of spectra with shared parameters.
+
+    The parameters are fitted in the units of the sliders (see the params of
+    the model) and within their ranges. The parameters whose range is a
+    single value are not varied.
+
+    Arguments
+    ---------
+    model : BaseModel
+        the model
+    f : np.array
+        the frequencies, shape (N,)
+    y : np.array
+        the fitted parameter of the spectra (see batchfit.fitted_data),
+        shape (M, N)
+    initial : list of dict
+        the initial values of the parameters for each spectrum, the initial
+        value of a shared parameter is the median over the spectra
+    shared : list of strings
+        the parameters that are the same for all spectra
+    fixed : list of strings
+        the parameters that are not varied
+    part : int
+        0: fit the real part, 1: the imaginary part, 2: both (see objective)
+    func : string or None
+        the model function (without 'func_', default: the one fitted by
+        objective, see fitted_function)
+    poll : function or None
+        called at each evaluation of the model (e.g. to process GUI events),
+        the fit is cancelled if it returns False
+    kws :
+        passed to scipy.optimize.least_squares (e.g. max_nfev)
+
+    Returns
+    -------
+    GlobalFitResult or None if the fit was cancelled
+    """
+    if func is None:
+        args = model.fitted_function()[1]
+    else:
+        args = _arguments(getattr(model, 'func_' + func))
+    y = np.nan_to_num(np.atleast_2d(y))
+    count, points = y.shape
+    if len(initial) != count:
+        raise Exception('Expected initial values for {} spectra, got {}.'.format(count, len(initial)))
+    if len(f) != points:
+        raise Exception('The spectra do not have the same number of points as the frequencies.')
+    w = 2.*np.pi*np.asarray(f, dtype=float)
+    # least_squares needs lower < upper for the varied parameters
+    fixed = [p for p in args if p in fixed or model.params[p][0] >= model.params[p][1]]
+    shared = [p for p in args if p in shared and p not in fixed]
+    local = [p for p in args if p not in shared and p not in fixed]
+    if not shared and not local:
+        raise Exception('All parameters are fixed.')
+    scale = dict((p, model.params[p][3]) for p in args)
+    start = dict((p, np.array([values[p] for values in initial], dtype=float)/scale[p]) for p in args)
+    for p in fixed:
+        if model.params[p][0] == model.params[p][1]:
+            start[p][:] = model.params[p][0]
+
+    # x = [shared parameters, first local parameter for all spectra, ...]
+    x0 = np.concatenate([[np.median(start[p])] for p in shared] + [start[p] for p in local])
+    lower = np.concatenate([[model.params[p][0]] for p in shared] + [np.full(count, model.params[p][0]) for p in local])
+    upper = np.concatenate([[model.params[p][1]] for p in shared] + [np.full(count, model.params[p][1]) for p in local])
+    x0 = np.clip(x0, lower, upper)
+
+    def columns(x):
+        values = dict((p, _column(start[p]*scale[p])) for p in fixed)
+        values.update((p, x[k]*scale[p]) for k, p in enumerate(shared))
+        for k, p in enumerate(local):
+            values[p] = x[len(shared)+k*count:len(shared)+(k+1)*count]*scale[p]
+        return values
+
+    parts = [0, 1] if part == 2 else [part]
+
+    def residual(x):
+        if poll is not None and poll() is False:
+            raise _Cancelled()
+        computed = model.evaluate(w, columns(x), func)
+        if not np.isfinite(np.sum(computed)):
+            computed = np.nan_to_num(computed)
+        res = np.empty((len(parts), count, points))
+        for k, i in enumerate(parts):
+            np.subtract(y.real if i == 0 else y.imag, computed.real if i == 0 else computed.imag, out=res[k])
+        return res.reshape(-1)
+
+    # the residual of spectrum m only depends on the shared parameters and
+    # on its own per-spectrum parameters
+    rows = np.arange(len(parts)*count*points).reshape(len(parts), count, points)
+    rows = rows.transpose(1, 0, 2).reshape(count, -1)       # the rows of each spectrum
+    cols = len(shared) + np.arange(len(local)*count).reshape(len(local), count, 1)
+    local_rows = np.broadcast_to(rows, (len(local),) + rows.shape).reshape(-1)
+    local_cols = np.broadcast_to(cols, (len(local),) + rows.shape).reshape(-1)
+    shared_rows = np.tile(rows.reshape(-1), len(shared))
+    shared_cols = np.repeat(np.arange(len(shared)), rows.size)
+    sparsity = coo_matrix((np.ones(len(shared_rows) + len(local_rows), dtype=np.int8),
+                           (np.concatenate([shared_rows, local_rows]), np.concatenate([shared_cols, local_cols]))),
+                          shape=(rows.size, len(x0)))
+    kws.setdefault('x_scale', 'jac')
+    try:
+        res = least_squares(residual, x0, jac_sparsity=sparsity, bounds=(lower, upper), **kws)
+    except _Cancelled:
+        return None
+
+    fitted = columns(res.x)
+    values = []
+    for m in range(count):
+        v = dict(initial[m])
+        for p in args:
+            v[p] = float(fitted[p] if np.ndim(fitted[p]) == 0 else fitted[p][m])
+        values.append(v)
+    return GlobalFitResult(values, res.success, res.message, res.nfev, res.cost)
@@ -0,0 +1,270 @@
+"""
+Export of the plots of many spectra as images in a pool of worker processes.
+
+The figures are drawn with the Agg backend of matplotlib, without pyplot and
+without any Qt widgets, from the prepared (de-embedded) data of the spectra
+and the fitted values of the model. They look like the figures of the
+Plotter.
+
+A manifest in the output folder records a hash of everything an image
+depends on, the images that are up to date are not drawn again.
+"""
+import os
+import json
+import hashlib
+import traceback
+import multiprocessing
+from collections import namedtuple
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from P13pt.spectrumfitter.batchfit import get_model, parse_fitted_param_str
+from P13pt.spectrumfitter.fitcache import _model_hash
+
+MANIFEST = '.spectrumfitter_images.json'
+FORMATS = ['png', 'jpg', 'pdf', 'svg', 'eps']
+
+# one image: the output file, the frequencies f and the S and Y parameters of
+# the spectrum (shape (N, 2, 2)), the title, the figure ('fit': fitted
+# parameter and model, 'y': all Y parameters, 's': all S parameters), the
+# display style ('RI' or 'MP') and the fitted parameter (e.g. '-Y12'), the
+# model file, model function and values (None: no model curve) and the size
+# of the figure in inches and its resolution
+ExportJob = namedtuple('ExportJob', ['filename', 'f', 's', 'y', 'title', 'figure', 'display_style', 'fitted_param',
+                                     'model_file', 'model_func', 'values', 'size', 'dpi'])
+
+# the result of an export: the error (traceback) if the image could not be
+# drawn and whether it was skipped because it was up to date
+ExportResult = namedtuple('ExportResult', ['filename', 'error', 'skipped'])
+
+
+def curves(z, display_style, mult=1.):
+    """The two curves of a complex quantity: real and imaginary part (times
+    mult) for the display style 'RI', magnitude in dB and phase in degrees
+    for 'MP'."""
+    if display_style == 'RI':
+        return z.real*mult, z.imag*mult
+    return 20.*np.log10(np.abs(z)), np.angle(z, deg=True)
+
+def fitted_param_label(s):
+    """Axis label of a fitted parameter (e.g. '-Y12')."""
+    sign, param, i, j = parse_fitted_param_str(s)
+    unit = r'\/\mathrm{[mS]}' if param == 'Y' else ''
+    return '$' + ('+' if sign > 0 else '-') + param + '_{' + str(i+1) + str(j+1) + '}' + unit + '$'
+
+
+def matrix_labels(figure, nports):
+    """Axis labels of the panels of the 'y' or 's' figure, one per element of
+    the matrix (row by row)."""
+    quantity, unit = ('Y', ' [mS]') if figure == 'y' else ('S', '')
+    return [r'$' + quantity + '_{' + str(k//nports+1) + str(k%nports+1) + '}' + unit + '$'
+            for k in range(nports**2)]
+
+
+def export_key(job):
+    """Hash of everything an image depends on (see ExportJob)."""
+    h = hashlib.sha1()
+    for a in [job.f, job.s, job.y]:
+        h.update(np.ascontiguousarray(a).tobytes())
+    values = None if job.values is None else sorted((p, repr(float(v))) for p, v in job.values.items())
+    model = _model_hash(job.model_file) if job.values is not None else None
+    h.update(json.dumps([os.path.splitext(job.filename)[1], job.title, job.figure, job.display_style,
+                         job.fitted_param, model, job.model_func, values,
+                         [float(x) for x in job.size], float(job.dpi)]).encode())
+    return h.hexdigest()
+
+
+_figures = {}   # layout -> (figure, lines), in each worker process
+
+def get_figure(job):
+    """Get the figure of a job, with its axes and lines for the data of the
+    spectrum and the model.
+
+    The figures are reused for the jobs with the same layout (figure, number
+    of ports, display style, fitted parameter, model curve or not, size and
+    resolution): the lines only get new data.
+
+    Returns
+    -------
+    (figure, panels, created): panels is a list of (ax, ax2, lines,
+    model_lines, z, mult), with the quantity z of the panel in the job
+    (model_lines is empty without model curve)
+    """
+    nports = job.s.shape[1]
+    layout = (job.figure, nports, job.display_style, job.fitted_param, job.values is not None, tuple(job.size), job.dpi)
+    created = layout not in _figures
+    if created:
+        figure = Figure(figsize=job.size, dpi=job.dpi)
+        FigureCanvasAgg(figure)
+        if job.figure == 'fit':
+            labels = [fitted_param_label(job.fitted_param)]
+            ax_list = [figure.add_subplot(111)]
+        else:
+            labels = matrix_labels(job.figure, nports)
+            ax_list = [figure.add_subplot(nports, nports, k+1) for k in range(nports**2)]
+        lines = []
+        for k, (ax, label) in enumerate(zip(ax_list, labels)):
+            ax2 = ax.twinx()
+            ax.set_xlabel('f [GHz]')
+            ax.set_ylabel(label)
+            if job.display_style == 'RI':
+                ax2.get_yaxis().set_visible(False)
+                ln1, = ax.plot([], [], label='Re')
+                ln2, = ax.plot([], [], label='Im')
+            else:
+                ax2.set_ylabel('Phase [deg]', color='red')
+                ln1, = ax.plot([], [], label='Mag')
+                ln2, = ax2.plot([], [], 'r', label='Phase')
+            if not k:
+                ax.legend([ln1, ln2], [ln1.get_label(), ln2.get_label()])
+            model_lines = []
+            if job.figure == 'fit' and job.values is not None:
+                model_lines = [ax.plot([], [], '-.', color='C2')[0],
+                               (ax if job.display_style == 'RI' else ax2).plot([], [], '-.', color='C3')[0]]
+            lines.append((ax, ax2, [ln1, ln2], model_lines))
+        _figures[layout] = figure, lines
+    figure, lines = _figures[layout]
+
+    if job.figure == 'fit':
+        sign, param, i, j = parse_fitted_param_str(job.fitted_param)
+        data = [(sign*(job.y if param == 'Y' else job.s)[:, i, j], 1e3 if param == 'Y' else 1)]
+    else:
+        z, mult = (job.y, 1e3) if job.figure == 'y' else (job.s, 1)
+        data = [(z[:, k//nports, k%nports], mult) for k in range(nports**2)]
+    return figure, [l + d for l, d in zip(lines, data)], created
+
+def draw_spectrum(job):
+    """Draw the plot of a spectrum (see ExportJob), returns the figure."""
+    figure, panels, created = get_figure(job)
+    f = np.asarray(job.f)/1e9
+    for ax, ax2, lines, model_lines, z, mult in panels:
+        for ln, curve in zip(lines, curves(z, job.display_style, mult)):
+            ln.set_data(f, curve)
+        if model_lines:
+            model = get_model(job.model_file)
+            computed = getattr(model, 'func_' + job.model_func)(2.*np.pi*np.asarray(job.f), **job.values)
+            for ln, curve in zip(model_lines, curves(computed, job.display_style, mult)):
+                ln.set_data(f, curve)
+        for a in [ax, ax2]:
+            a.relim()
+            a.autoscale_view()
+
+    if created:
+        # as in the Plotter, the layout is only computed once
+        figure.tight_layout()
+        if job.figure != 'fit':
+            figure.subplots_adjust(top=0.9)
+    if job.figure == 'fit':
+        panels[0][0].set_title(job.title)
+    else:
+        figure.suptitle(job.title)
+    return figure
+
+def export_image(job):
+    """Draw and save the image of a spectrum (this runs in the worker
+    processes).
+
+    Returns
+    -------
+    ExportResult
+    """
+    try:
+        draw_spectrum(job).savefig(job.filename)
+        return ExportResult(job.filename, None, False)
+    except Exception:
+        return ExportResult(job.filename, traceback.format_exc(), False)
+
+
+def export_images(jobs, processes=None, poll=None, interval=0.05, force=False, window=None):
+    """Export the images of spectra in a pool of processes.
+
+    The images that are up to date according to the manifest of their folder
+    are skipped, the manifests are updated when the export ends (also when it
+    is cancelled).
+
+    Arguments
+    ---------
+    jobs : iterable of ExportJob
+        the images to draw, e.g. a generator preparing the spectra one after
+        the other: the jobs are only taken when there is room in the window,
+        so that the data of all spectra is never in memory at once
+    processes : int or None
+        the number of worker processes (default: number of CPUs)
+    poll : function or None
+        called regularly while waiting for the images (e.g. to process GUI
+        events), the export is cancelled if it returns False
+    interval : float
+        the time in seconds between two calls of poll
+    force : bool
+        draw all images, even those that are up to date
+    window : int or None
+        the maximum number of images waiting for a worker or being drawn
+        (default: 4 per process)
+
+    Returns
+    -------
+    generator of ExportResult in the order in which the images are saved;
+    closing the generator cancels the remaining images
+    """
+    processes = processes or multiprocessing.cpu_count()
+    window = window or 4*processes
+    manifests = {}      # folder -> {image file name: key}
+    keys = {}
+    jobs = iter(jobs)
+    pending = []        # the results of the images being drawn
+    pool = None
+
+    def store(result):
+        folder, name = os.path.split(os.path.abspath(result.filename))
+        if result.error is None:
+            manifests[folder][name] = keys[result.filename]
+        else:
+            manifests[folder].pop(name, None)
+        return result
+
+    try:
+        while True:
+            # take jobs until the window is full
+            while jobs is not None and len(pending) < window:
+                job = next(jobs, None)
+                if job is None:
+                    jobs = None
+                    break
+                folder, name = os.path.split(os.path.abspath(job.filename))
+                if folder not in manifests:
+                    manifests[folder] = {}
+                    try:
+                        with open(os.path.join(folder, MANIFEST), 'r') as f:
+                            manifests[folder] = dict(json.load(f))
+                    except (IOError, OSError, ValueError):
+                        pass    # no manifest, or it is broken: export everything
+                keys[job.filename] = key = export_key(job)
+                if not force and manifests[folder].get(name) == key and os.path.exists(job.filename):
+                    yield ExportResult(job.filename, None, True)
+                    continue
+                if pool is None:
+                    pool = multiprocessing.Pool(processes)
+                pending.append(pool.apply_async(export_image, (job,)))
+            if not pending:
+                return
+            if poll is not None and poll() is False:
+                return
+            done = [r for r in pending if r.ready()]
+            if not done:
+                pending[0].wait(interval)
+            for r in done:
+                pending.remove(r)
+                yield store(r.get())
+    finally:
+        # kills the workers if the export was cancelled
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for folder in manifests:
+            try:
+                with open(os.path.join(folder, MANIFEST), 'w') as f:
+                    json.dump(manifests[folder], f)
+            except (IOError, OSError):
+                pass    # the images will be exported again next time
@@ -1,3 +1,4 @@
+import os
 from P13pt.params_from_filename import params_from_filename
 
 def load_fitresults(filename, readfilenameparams=True, extrainfo=False):
@@ -64,3 +65,84 @@ def load_fitresults(filename, readfilenameparams=True, extrainfo=False):
         return data
     else:
         return data, dut, thru, dummy, ra, fitter_info
+
+
+def save_fitresults(filename, dut, dut_files, thru=None, dummy=None, ra=0., fitted_param='-Y12',
+                    model_file=None, model_func=None, fit_method=None, params=None, model_params=None):
+    """Write a results file that can be read by load_fitresults.
+
+    Arguments
+    ---------
+    filename : string
+        the results file
+    dut, thru, dummy : string or None
+        the DUT folder or file and the thru and dummy files (they are
+        written relative to the folder of the results file)
+    dut_files : list of strings
+        the DUT spectra (the parameters in the name of the first one are
+        written as columns)
+    ra : float
+        the contact resistance
+    fitted_param : string
+        the fitted parameter, e.g. '-Y12'
+    model_file, model_func, fit_method : string or None
+        the model (no results are written if it is None), its active
+        function and the fit method
+    params : list of strings
+        the names of the model parameters (in the order of the columns)
+    model_params : dict
+        the model parameters by DUT file name
+    """
+    res_folder = os.path.dirname(filename)
+
+    with open(filename, 'w') as f:
+        # write the header
+        f.write('# fitting results generated by P13pt spectrum fitter\n')
+        f.write('# dut: ' + os.path.relpath(dut, res_folder).replace('\\', '/') + '\n')
+        if thru:
+            f.write('# thru: ' + os.path.relpath(thru, res_folder).replace('\\', '/') + '\n')
+        if dummy:
+            f.write('# dummy: ' + os.path.relpath(dummy, res_folder).replace('\\', '/') + '\n')
+        f.write('# fitted_param: ' + fitted_param + '\n')
+        if not ra == 0:
+            f.write('# ra: ' + str(ra) + '\n')
+        if model_file:
+            f.write('# model: ' + os.path.basename(model_file).replace('\\', '/') + '\n')
+            f.write('# model_func: ' + model_func + '\n')
+            if fit_method:
+                f.write('# fit_method: ' + fit_method + '\n')
+            # determine columns
+            f.write('# filename\t')
+            for p in params_from_filename(dut_files[0]):
+                f.write(p + '\t')
+            f.write('\t'.join([p for p in params]))
+            f.write('\n')
+
+            # write data
+            filelist = sorted([filename for filename in model_params])
+            for filename in filelist:
+                f.write(filename + '\t')
+                # TODO: what if some filenames do not contain all parameters? should catch exceptions
+                for p in params_from_filename(dut_files[0]):
+                    f.write(str(params_from_filename(filename)[p]) + '\t')
+                f.write('\t'.join([str(model_params[filename][p]) for p in params]))
+                f.write('\n')
+
+
+def values_from_fitresults(data):
+    """Get the model parameters by file name from the data returned by
+    load_fitresults (the columns that are not numbers are skipped)."""
+    # get a list of parameter names
+    params = [p for p in data if p != 'filename']
+    unusable = []
+    columns = {}
+    # now check float conversion compatibility of the data columns, removing the ones that we cannot use
+    for p in params:
+        try:
+            columns[p] = [float(x) for x in data[p]]
+        except ValueError:
+            unusable.append(p)
+    for p in unusable:
+        params.remove(p)
+
+    return dict((f, dict((p, columns[p][i]) for p in params)) for i, f in enumerate(data['filename']))
@@ -1,8 +1,8 @@
 from __future__ import print_function
 import numpy as np
-from lmfit import Parameters, minimize
+from lmfit import Parameters
 from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QLabel, QWidget, QLineEdit
-from P13pt.spectrumfitter.basemodel import BaseModel
+from P13pt.spectrumfitter.basemodel import BaseModel, line_admittance
 
 class Model(BaseModel):
     params = {
@@ -41,30 +41,17 @@ class Model(BaseModel):
         adm = 1./(1./tlm + rcont)
         return adm
 
-    def objective(self, params, x_data, y_data, part=2):
-        """Error function function minimized during the fitting procedure.
-
-        We perform the optimization on both the real and imaginary part.
-        
-        Parameters
-        ----------
-        
-        part : int
-            0: real
-            1: imaginary
-            2: both
-        """
-        c, fres, q, rcont = (params['c'].value, params['fres'].value,
-                             params['q'].value, params['rcont'].value) 
-        computed_admittance = self.func_admittance(x_data, c, fres, q, rcont)
-        np.nan_to_num(computed_admittance)
-        res = np.empty((2, len(y_data)))
-        res[0] = y_data.real - computed_admittance.real
-        res[1] = y_data.imag - computed_admittance.imag
-        if part == 2:
-            return np.ravel(res)
-        else:
-            return res[part]
+    def grad_admittance(self, w, c, fres, q, rcont):
+        """Derivatives of func_admittance with respect to c, fres, q and rcont"""
+        w0 = fres*4.
+        r = 1./(w0*c*q)
+        l = 1./(w0**2*c)
+        z = r + 1j*l*w
+        tlm, dtlm_dz, dtlm_dc = line_admittance(z, c, w)
+        adm = 1./(1./tlm + rcont)
+        a = adm*adm/(tlm*tlm)
+        # r and l are proportional to 1/c, r to 1/fres and 1/q, l to 1/fres**2
+        return [a*(dtlm_dc - dtlm_dz*z/c), -a*dtlm_dz*(r + 2j*l*w)/fres, -a*dtlm_dz*r/q, -adm*adm]
 
     def update_info_widget(self):
         try:
@@ -93,13 +80,8 @@ class Model(BaseModel):
         # get crossover frequency
         # avoid detecting the crossover associated with the possible leak
         mask = base_f > 2e8
-        # try to detect crossover using threshold
-        f_below_thresh = base_f[mask][np.abs(base_y[mask].real-base_y[mask].imag)<5e-5]
-        if len(f_below_thresh):
-            fc = f_below_thresh[0]
-        else:
-            print("Threshold detection did not work")
-            fc = base_f[mask][np.argmin(np.abs(base_y[mask].real-base_y[mask].imag))]
+        # try to detect crossover using threshold, else start from a grid search
+        fc = self.crossover(base_f[mask], base_y[mask], ['c', 'fres', 'q'])
         
         print("Detected fc:", fc/1e9, "GHz")
         
@@ -121,8 +103,8 @@ class Model(BaseModel):
             # execute fit
             if i in []:
                 # fit only imaginary part
-                res = minimize(self.objective, params, args=(w, y, 1))
+                res = self.minimize(params, w, y, part=1)
             else:
-                res = minimize(self.objective, params, args=(w, y))
+                res = self.minimize(params, w, y)
             for p in self.values:
                 self.values[p] = res.params[p].value
@@ -1,7 +1,8 @@
 import numpy as np
-from lmfit import Parameters, minimize
+from lmfit import Parameters
+from P13pt.spectrumfitter.basemodel import BaseModel, line_admittance
 
-class Model:
+class Model(BaseModel):
     # dictionary of the model's parameters
     # for each parameter, we store the minimum and maximum value,
     # an initial value, a multiplier value and a unit
@@ -15,16 +16,7 @@ class Model:
         'rasup': [0, 1000, 0., 1, 'Ohm']
     }
 
-    values = {}    # this is where the fitter will store the values
-
-    def __init__(self):
-        self.reset_values()
-
-    def reset_values(self):
-        for p in self.params:
-            self.values[p] = self.params[p][2]*self.params[p][3]
-
-    def admittance(self, w, r, c, l, gl, ra, ca, rasup):
+    def func_admittance(self, w, r, c, l, gl, ra, ca, rasup):
         """Admittance of a Field Effect Capacitor
 
         Parameters
@@ -61,31 +53,30 @@ class Model:
         r = r + 1j*l*w
         k = np.sqrt(-1j*r*c*w)
         tlm = (1j*k/r) * np.tanh(1j*k) + gl
-        if ra == 0.:
-            adm_a = 1j*w*ca
-        else:
-            adm_a = 1j*w*ca + 1./ra
-        if ra == 0. and ca == 0.:
-            adm = 1./(1./tlm + rasup)
-        else:
-            adm = 1./(1./tlm + 1./adm_a + rasup)
+        # ra = 0 leaves out the access resistance and ra = ca = 0 the access
+        # admittance (the parameters can be arrays, see BaseModel.evaluate)
+        ra = np.asarray(ra, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            adm_a = 1j*w*ca + np.where(ra == 0., 0., 1./ra)
+            za = np.where(np.logical_and(ra == 0., ca == 0.), 0., 1./adm_a)
+        adm = 1./(1./tlm + za + rasup)
         return adm
 
-    def objective(self, params, x_data, y_data):
-        """Error function function minimized during the fitting procedure.
-
-        We perform the optimization on both the real and imaginary part.
-        """
-        r, c, l, gl, ra, ca, rasup = (params['r'].value, params['c'].value,
-                                      params['l'].value, params['gl'].value,
-                                      params['ra'].value, params['ca'].value,
-                                      params['rasup'].value)
-        computed_admittance = self.admittance(x_data, r, c, l, gl, ra, ca, rasup)
-        np.nan_to_num(computed_admittance)
-        res = np.empty((2, len(y_data)))
-        res[0] = y_data.real - computed_admittance.real
-        res[1] = y_data.imag - computed_admittance.imag
-        return np.ravel(res)
+    def grad_admittance(self, w, r, c, l, gl, ra, ca, rasup):
+        """Derivatives of func_admittance with respect to r, c, l, gl, ra, ca
+        and rasup (zero for ra and ca where the access admittance is left
+        out)"""
+        tlm, dtlm_dz, dtlm_dc = line_admittance(r + 1j*l*w, c, w)
+        tlm = tlm + gl
+        ra = np.asarray(ra, dtype=float)
+        none = np.logical_and(ra == 0., ca == 0.)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            adm_a = 1j*w*ca + np.where(ra == 0., 0., 1./ra)
+            adm = 1./(1./tlm + np.where(none, 0., 1./adm_a) + rasup)
+            da = np.where(none, 0., adm*adm/(adm_a*adm_a))
+            dra = np.where(ra == 0., 0., -da/(ra*ra))
+        a = adm*adm/(tlm*tlm)
+        return [a*dtlm_dz, a*dtlm_dc, a*dtlm_dz*1j*w, a, dra, da*1j*w, -adm*adm]
 
     def fit_default(self, f, y, checkboxes):
         w = 2.*np.pi*f
@@ -101,7 +92,7 @@ class Model:
         params.add('gl', value=self.values['gl'], min=1e-5, max=1e-3, vary=checkboxes['gl'].isChecked())
 
         # execute fit
-        res = minimize(self.objective, params, args=(w, y))
+        res = self.minimize(params, w, y)
         for p in self.values:
             self.values[p] = res.params[p].value
 
@@ -126,7 +117,7 @@ class Model:
             params.add('gl', value=self.values['gl'], min=1e-5, max=1e-3, vary=True if i in [] else False)
 
             # execute fit
-            res = minimize(self.objective, params, args=(w, y))
+            res = self.minimize(params, w, y)
             for p in self.values:
                 self.values[p] = res.params[p].value
 
@@ -184,7 +175,7 @@ class Model:
             params.add('rasup', value=self.values['rasup'], min=0., max=10e3, vary=False)
 
             # execute fit
-            res = minimize(self.objective, params, args=(w, y))
+            res = self.minimize(params, w, y)
             for p in self.values:
                 self.values[p] = res.params[p].value
                 
@@ -221,7 +212,7 @@ class Model:
             params.add('rasup', value=self.values['rasup'], min=0., max=10e3, vary=False)
 
             # execute fit
-            res = minimize(self.objective, params, args=(w, y))
+            res = self.minimize(params, w, y)
             for p in self.values:
                 self.values[p] = res.params[p].value
                 
@@ -254,7 +245,7 @@ class Model:
             params.add('rasup', value=self.values['rasup'], min=0., max=10e3, vary=False)
 
             # execute fit
-            res = minimize(self.objective, params, args=(w, y))
+            res = self.minimize(params, w, y)
             for p in self.values:
                 self.values[p] = res.params[p].value
 
@@ -283,7 +274,7 @@ class Model:
             params.add('rasup', value=self.values['rasup'], min=0., max=10e3, vary=False)
 
             # execute fit
-            res = minimize(self.objective, params, args=(w, y))
+            res = self.minimize(params, w, y)
             for p in self.values:
                 self.values[p] = res.params[p].value
 
@@ -1,8 +1,8 @@
 from __future__ import print_function
 import numpy as np
-from lmfit import Parameters, minimize
+from lmfit import Parameters
 from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QLabel, QWidget, QLineEdit
-from P13pt.spectrumfitter.basemodel import BaseModel
+from P13pt.spectrumfitter.basemodel import BaseModel, line_admittance
 
 class Model(BaseModel):
     # dictionary of the model's parameters
@@ -72,30 +72,13 @@ class Model(BaseModel):
         adm = 1./(1./tlm + rcont)
         return adm
 
-    def objective(self, params, x_data, y_data, part=2):
-        """Error function function minimized during the fitting procedure.
-
-        We perform the optimization on both the real and imaginary part.
-        
-        Parameters
-        ----------
-        
-        part : int
-            0: real
-            1: imaginary
-            2: both
-        """
-        r, c, l, rlo = (params['r'].value, params['c'].value,
-                        params['l'].value, params['rlo'].value) 
-        computed_admittance = self.func_admittance(x_data, r, c, l, rlo)
-        np.nan_to_num(computed_admittance)
-        res = np.empty((2, len(y_data)))
-        res[0] = y_data.real - computed_admittance.real
-        res[1] = y_data.imag - computed_admittance.imag
-        if part == 2:
-            return np.ravel(res)
-        else:
-            return res[part]
+    def grad_admittance(self, w, r, c, l, rlo):
+        """Derivatives of func_admittance with respect to r, c, l and rlo"""
+        rcont = rlo - r/3.
+        tlm, dtlm_dz, dtlm_dc = line_admittance(r + 1j*l*w, c, w)
+        adm = 1./(1./tlm + rcont)
+        a = adm*adm/(tlm*tlm)
+        return [a*dtlm_dz + adm*adm/3., a*dtlm_dc, a*dtlm_dz*1j*w, -adm*adm]
 
     def update_info_widget(self):
         try:
@@ -125,13 +108,8 @@ class Model(BaseModel):
         # get crossover frequency
         # avoid detecting the crossover associated with the leak or associated to high frequency weirdness
         mask = np.logical_and(base_f > 2e8, base_f < 25e9)
-        # try to detect crossover using threshold
-        f_below_thresh = base_f[mask][np.abs(base_y[mask].real-base_y[mask].imag)<5e-5]
-        if len(f_below_thresh):
-            fc = f_below_thresh[0]
-        else:
-            print("Threshold detection did not work")
-            fc = base_f[mask][np.argmin(np.abs(base_y[mask].real-base_y[mask].imag))]
+        # try to detect crossover using threshold, else start from a grid search
+        fc = self.crossover(base_f[mask], base_y[mask], ['r', 'c', 'rlo'])
         
         print("Detected fc:", fc/1e9, "GHz")
         #if fc < 3.1e8: fc = 1e9
@@ -168,9 +146,9 @@ class Model(BaseModel):
             # execute fit
             if i in []:
                 # fit only imaginary part
-                res = minimize(self.objective, params, args=(w, y, 1))
+                res = self.minimize(params, w, y, part=1)
             else:
-                res = minimize(self.objective, params, args=(w, y))
+                res = self.minimize(params, w, y)
             for p in self.values:
                 self.values[p] = res.params[p].value
 
@@ -184,13 +162,8 @@ class Model(BaseModel):
         # get crossover frequency
         # avoid detecting the crossover associated with the leak or associated to high frequency weirdness
         mask = np.logical_and(base_f > 2e8, base_f < 12e9)
-        # try to detect crossover using threshold
-        f_below_thresh = base_f[mask][np.abs(base_y[mask].real-base_y[mask].imag)<5e-5]
-        if len(f_below_thresh):
-            fc = f_below_thresh[0]
-        else:
-            print("Threshold detection did not work")
-            fc = base_f[mask][np.argmin(np.abs(base_y[mask].real-base_y[mask].imag))]
+        # try to detect crossover using threshold, else start from a grid search
+        fc = self.crossover(base_f[mask], base_y[mask], ['r', 'c', 'rlo'])
         
         print("Detected fc:", fc/1e9, "GHz")
         #if fc < 3.1e8: fc = 1e9
@@ -227,9 +200,9 @@ class Model(BaseModel):
             # execute fit
             if i in []:
                 # fit only imaginary part
-                res = minimize(self.objective, params, args=(w, y, 1))
+                res = self.minimize(params, w, y, part=1)
             else:
-                res = minimize(self.objective, params, args=(w, y))
+                res = self.minimize(params, w, y)
             for p in self.values:
                 self.values[p] = res.params[p].value
 
@@ -243,13 +216,8 @@ class Model(BaseModel):
         # get crossover frequency
         # avoid detecting the crossover associated with the leak or associated to high frequency weirdness
         mask = np.logical_and(base_f > 2e8, base_f < 25e9)
-        # try to detect crossover using threshold
-        f_below_thresh = base_f[mask][np.abs(base_y[mask].real-base_y[mask].imag)<5e-5]
-        if len(f_below_thresh):
-            fc = f_below_thresh[0]
-        else:
-            print("Threshold detection did not work")
-            fc = base_f[mask][np.argmin(np.abs(base_y[mask].real-base_y[mask].imag))]
+        # try to detect crossover using threshold, else start from a grid search
+        fc = self.crossover(base_f[mask], base_y[mask], ['r', 'c', 'rlo'])
         
         print("Detected fc:", fc/1e9, "GHz")
         #if fc < 3.1e8: fc = 1e9
@@ -286,9 +254,9 @@ class Model(BaseModel):
             # execute fit
             if i in []:
                 # fit only imaginary part
-                res = minimize(self.objective, params, args=(w, y, 1))
+                res = self.minimize(params, w, y, part=1)
             else:
-                res = minimize(self.objective, params, args=(w, y))
+                res = self.minimize(params, w, y)
             for p in self.values:
                 self.values[p] = res.params[p].value
 
@@ -302,13 +270,8 @@ class Model(BaseModel):
         # get crossover frequency
         # avoid detecting the crossover associated with the leak
         mask = base_f > 2e8
-        # try to detect crossover using threshold
-        f_below_thresh = base_f[mask][np.abs(base_y[mask].real-base_y[mask].imag)<5e-5]
-        if len(f_below_thresh):
-            fc = f_below_thresh[0]
-        else:
-            print("Threshold detection did not work")
-            fc = base_f[mask][np.argmin(np.abs(base_y[mask].real-base_y[mask].imag))]
+        # try to detect crossover using threshold, else start from a grid search
+        fc = self.crossover(base_f[mask], base_y[mask], ['r', 'c', 'rlo'])
         
         print("Detected fc:", fc/1e9, "GHz")
         
@@ -332,8 +295,8 @@ class Model(BaseModel):
             # execute fit
             if i in []:
                 # fit only imaginary part
-                res = minimize(self.objective, params, args=(w, y, 1))
+                res = self.minimize(params, w, y, part=1)
             else:
-                res = minimize(self.objective, params, args=(w, y))
+                res = self.minimize(params, w, y)
             for p in self.values:
                 self.values[p] = res.params[p].value
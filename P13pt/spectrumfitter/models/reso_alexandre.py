@@ -1,6 +1,13 @@
 import numpy as np
 from P13pt.spectrumfitter.basemodel import BaseModel
 
+
+def matrix(a, b, c, d):
+    # 2x2 matrices [[a, b], [c, d]] in the last two axes
+    a, b, c, d = np.broadcast_arrays(a, b, c, d)
+    return np.stack([np.stack([a, b], axis=-1), np.stack([c, d], axis=-1)], axis=-2)
+
+
 class Model(BaseModel):
     params = {
         'r':      [500, 20000, 1000, 1,     'Ohm'],
@@ -14,26 +21,32 @@ class Model(BaseModel):
     Z0 = 50.
 
     def abcd(self, w, r, l, c, tau, ra, length):
+        """ABCD parameters of the resonator: the RLC line, with the access
+        resistance ra and the delay tau on both sides
+
+        The arguments can be arrays that broadcast together, e.g. the
+        pulsations with shape (N,) and the parameters with shape (M, 1) give
+        ABCD parameters with shape (M, N) (see BaseModel.evaluate).
+
+        Returns
+        -------
+        (a, b, c, d)
+        """
         gamma = np.sqrt((r+1j*l*w)*1j*c*w)
         Z1 = (r+1j*l*w)/gamma
 
-        abcd1 = np.asarray([[np.cosh(gamma*length), Z1*np.sinh(gamma*length)],
-                            [1./Z1*np.sinh(gamma*length), np.cosh(gamma*length)]])
-        abcd0 = np.asarray([[np.cos(w*tau), 1j*self.Z0*np.sin(w*tau)],
-                            [1j/self.Z0*np.sin(w*tau), np.cos(w*tau)]])
-        abcda = np.asarray([[1, ra],
-                            [0, 1]])
-
-        # TODO: this puts the frequency axis first, there might be a more elegant way to do this
-        abcd0 = np.swapaxes(np.swapaxes(abcd0, 1, 2), 0, 1)
-        abcd1 = np.swapaxes(np.swapaxes(abcd1, 1, 2), 0, 1)
+        abcd1 = matrix(np.cosh(gamma*length), Z1*np.sinh(gamma*length),
+                       1./Z1*np.sinh(gamma*length), np.cosh(gamma*length))
+        abcd0 = matrix(np.cos(w*tau), 1j*self.Z0*np.sin(w*tau),
+                       1j/self.Z0*np.sin(w*tau), np.cos(w*tau))
+        abcda = matrix(1., ra, 0., 1.)
 
         abcd_tot = np.matmul(np.matmul(np.matmul(np.matmul(abcd0, abcda), abcd1), abcda), abcd0)
 
-        a = abcd_tot[:, 0, 0]
-        b = abcd_tot[:, 0, 1]
-        c = abcd_tot[:, 1, 0]
-        d = abcd_tot[:, 1, 1]
+        a = abcd_tot[..., 0, 0]
+        b = abcd_tot[..., 0, 1]
+        c = abcd_tot[..., 1, 0]
+        d = abcd_tot[..., 1, 1]
 
         return a, b, c, d
 
@@ -1,9 +1,11 @@
-from PyQt5.QtCore import pyqtSignal, pyqtSlot
+from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QWidget, QPushButton, QListWidget, QVBoxLayout, QHBoxLayout, QCheckBox
 
 class Navigator(QWidget):
     selection_changed = pyqtSignal(int)
+    cached = set()      # files that are shown as cached
+    fit_cached = set()  # files whose fit results are shown as coming from the fit cache
 
     def __init__(self, parent=None):
         super(QWidget, self).__init__(parent)
@@ -30,6 +32,8 @@ class Navigator(QWidget):
         self.file_list.currentRowChanged.connect(self.selection_changed)
 
     def update_file_list(self, flist):
+        self.cached = set()
+        self.fit_cached = set()
         self.file_list.clear()
         for f in flist:
             self.file_list.addItem(f)
@@ -55,5 +59,36 @@ class Navigator(QWidget):
         else:
             self.file_list.setCurrentRow(i)
 
+    def update_item(self, filename):
+        tooltip = []
+        if filename in self.cached:
+            tooltip.append('Cached')
+        if filename in self.fit_cached:
+            tooltip.append('Fit results from the fit cache')
+        for item in self.file_list.findItems(filename, Qt.MatchExactly):
+            font = item.font()
+            font.setBold(filename in self.cached)
+            font.setItalic(filename in self.fit_cached)
+            item.setFont(font)
+            item.setToolTip('\n'.join(tooltip))
+
+    def mark_cached(self, filenames):
+        # show the files whose prepared spectra are in the cache in bold
+        filenames = set(filenames)
+        changed = self.cached ^ filenames
+        self.cached = filenames
+        for filename in changed:
+            self.update_item(filename)
+
+    def mark_fit_cached(self, filenames):
+        # show the files whose fit results come from the fit cache in italics
+        filenames = set(filenames)
+        changed = self.fit_cached ^ filenames
+        self.fit_cached = filenames
+        for filename in changed:
+            self.update_item(filename)
+
     def clear(self):
+        self.cached = set()
+        self.fit_cached = set()
         self.file_list.clear()
\ No newline at end of file
@@ -1,4 +1,6 @@
-from PyQt5.QtCore import pyqtSlot
+import time
+
+from PyQt5.QtCore import pyqtSignal, pyqtSlot
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QTabWidget, QMessageBox)
 
 import numpy as np
@@ -7,6 +9,11 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 
 from .fitter import parse_fitted_param_str
+from .imageexport import curves, fitted_param_label, matrix_labels
+
+perf_counter = getattr(time, 'perf_counter', time.time)     # Python 2
+
+FIGURES = ['fit', 'y', 's']     # the figures in the order of the tabs
 
 class Plotter(QTabWidget):
     network = None
@@ -15,6 +22,8 @@ class Plotter(QTabWidget):
     line_i = None               # matplotlib line for imag part of model plot
     fitted_param = None
     display_style = 'MP'        # RI: real/imaginary, MP: magnitude/phase
+    nports = None               # number of ports of the panels of the Y and S figures
+    frame_drawn = pyqtSignal(str, float)    # figure ('fit', 'y' or 's') and time in seconds of each redraw
 
     def __init__(self, parent=None):
         super(QTabWidget, self).__init__(parent)
@@ -39,129 +48,166 @@ class Plotter(QTabWidget):
             l.addWidget(w)
         self.plotting_yandfit.setLayout(l)
 
-        # set up plotting of all Y parameters
+        # set up plotting of all Y parameters (the axes are created in setup_axes)
         self.figure_y = plt.figure()
-        self.ax_y_list = [self.figure_y.add_subplot(221+i) for i in range(4)]
-        self.ax2_y_list = [ax.twinx() for ax in self.ax_y_list]
-        for i, ax in enumerate(self.ax_y_list):
-            ax.set_xlabel(r'$f [GHz]$')
-            ax.set_ylabel(r'$Y_{'+['11', '12', '21', '22'][i]+r'} [mS]$')
         self.canvas_y = FigureCanvas(self.figure_y)
         self.toolbar_y = NavigationToolbar(self.canvas_y, self.plotting_y)
         l = QVBoxLayout()
         for w in [self.toolbar_y, self.canvas_y]:
             l.addWidget(w)
         self.plotting_y.setLayout(l)
-        self.figure_y.tight_layout()
 
         # set up plotting of all S parameters
         self.figure_s = plt.figure()
-        self.ax_s_list = [self.figure_s.add_subplot(221+i) for i in range(4)]
-        self.ax2_s_list = [ax.twinx() for ax in self.ax_s_list]
-        for i, ax in enumerate(self.ax_s_list):
-            ax.set_xlabel(r'$f [GHz]$')
-            ax.set_ylabel(r'$S_{'+['11', '12', '21', '22'][i]+r'}$')
         self.canvas_s = FigureCanvas(self.figure_s)
         self.toolbar_s = NavigationToolbar(self.canvas_s, self.plotting_s)
         l = QVBoxLayout()
         for w in [self.toolbar_s, self.canvas_s]:
             l.addWidget(w)
         self.plotting_s.setLayout(l)
-        self.figure_s.tight_layout()
 
-    def plot(self, network, params):
-        self.clear()
+        self.figures = dict(zip(FIGURES, [self.figure, self.figure_y, self.figure_s]))
+        self.canvases = dict(zip(FIGURES, [self.canvas, self.canvas_y, self.canvas_s]))
+        self.axes = {'fit': [(self.ax, self.ax2)]}
+
+        # the lines are created once (see setup_lines) and only get new data,
+        # the figures are only redrawn when they are visible (see update_figure)
+        self.lines = {}
+        self.line_style = None      # display style of the lines
+        self.dirty = set(FIGURES)   # figures that need to be redrawn when they are shown
+        self.background = None      # fitting figure without the model lines, for blitting
+        self.background_bounds = None   # size of the figure when the background was taken
+        self.saving = False
+        self.setup_axes(2)
+        self.canvas.mpl_connect('draw_event', self.fit_figure_drawn)
+        self.currentChanged.connect(self.tab_changed)
+
+    def setup_axes(self, nports):
+        # one panel per element of the Y and S matrices, then the lines
+        self.nports = nports
+        for name, figure in [('y', self.figure_y), ('s', self.figure_s)]:
+            figure.clear()
+            self.axes[name] = []
+            for k, label in enumerate(matrix_labels(name, nports)):
+                ax = figure.add_subplot(nports, nports, k+1)
+                ax.set_xlabel(r'$f [GHz]$')
+                ax.set_ylabel(label)
+                self.axes[name].append((ax, ax.twinx()))
+        self.setup_lines()
+
+    def setup_lines(self):
+        # create the lines for the current display style
+        for name in FIGURES:
+            for ax, ax2 in self.axes[name]:
+                for a in [ax, ax2]:
+                    for artist in list(a.lines) + list(a.collections):
+                        artist.remove()
+                    a.set_prop_cycle(None)
+                if self.display_style == 'RI':
+                    ax2.get_yaxis().set_visible(False)
+                else:
+                    ax2.get_yaxis().set_visible(True)
+                    ax2.set_ylabel('Phase [deg]', color='red')
+            self.lines[name] = []
+            for k, (ax, ax2) in enumerate(self.axes[name]):
+                if self.display_style == 'RI':
+                    ln1, = ax.plot([], [], label='Re')
+                    ln2, = ax.plot([], [], label='Im')
+                else:
+                    ln1, = ax.plot([], [], label='Mag')
+                    ln2, = ax2.plot([], [], 'r', label='Phase')
+                if not k:
+                    lns = [ln1, ln2]
+                    ax.legend(lns, [l.get_label() for l in lns])
+                self.lines[name].append((ln1, ln2))
+
+        # the model lines are drawn on top of the figure (see plot_fit)
+        self.line_r, = self.ax.plot([], [], '-.', color='C2', animated=True)
+        self.line_i, = (self.ax if self.display_style == 'RI' else self.ax2).plot([], [], '-.', color='C3',
+                                                                                  animated=True)
+        self.line_style = self.display_style
+
+        self.figure.tight_layout()
+        for fig in [self.figure_y, self.figure_s]:
+            fig.tight_layout()
+            fig.subplots_adjust(top=0.9)
+        self.dirty = set(FIGURES)
 
+    def curves(self, z, mult=1.):
+        # the two curves of a complex quantity in the current display style
+        return curves(z, self.display_style, mult)
+
+    def plot(self, network, params):
         self.network = network
         self.params = params
         self.f = self.network.f[:]
         self.s = self.network.s[:,:,:]
         self.y = self.network.y[:,:,:]
 
-        sign, param, i, j = parse_fitted_param_str(self.fitted_param)
+        if self.s.shape[1] != self.nports:
+            self.setup_axes(self.s.shape[1])
+        elif self.display_style != self.line_style:
+            self.setup_lines()
+        self.dirty = set(FIGURES)
+        self.update_figure(FIGURES[self.currentIndex()])
 
-        if self.display_style == 'RI':
-            for ax2 in [self.ax2] + self.ax2_s_list + self.ax2_y_list:
-                ax2.get_yaxis().set_visible(False)
-        else:
-            for ax2 in [self.ax2] + self.ax2_s_list + self.ax2_y_list:
-                ax2.get_yaxis().set_visible(True)
-                ax2.set_ylabel('Phase [deg]', color='red')
-
-        # plot parameter to be fitted
-        if param == 'Y':
-            if self.display_style == 'RI':
-                ln1, = self.ax.plot(self.f/1e9, sign*self.y[:,i,j].real*1e3, label='Re')
-                ln2, = self.ax.plot(self.f/1e9, sign*self.y[:,i,j].imag*1e3, label='Im')
-            else:
-                ln1, = self.ax.plot(self.f/1e9, 20.*np.log10(np.abs(self.y[:,i,j])), label='Mag')
-                ln2, = self.ax2.plot(self.f/1e9, np.angle(self.y[:,i,j], deg=True), 'r', label='Phase')
+    def update_figure(self, name):
+        """Put the data of the spectrum in the lines of a figure (computing
+        only the curves of this figure) and redraw it."""
+        start = perf_counter()
+        # the quantity of each panel and its multiplier (Y in mS)
+        if self.network is None:
+            data = [(None, 1)]*len(self.lines[name])
+        elif name == 'fit':
+            sign, param, i, j = parse_fitted_param_str(self.fitted_param)
+            data = [(sign*(self.y if param == 'Y' else self.s)[:,i,j], 1e3 if param == 'Y' else 1)]
+        elif name == 'y':
+            data = [(self.y[:,i//self.nports,i%self.nports], 1e3) for i in range(self.nports**2)]
         else:
-            if self.display_style == 'RI':
-                ln1, = self.ax.plot(self.f/1e9, sign*self.s[:,i,j].real, label='Re')
-                ln2, = self.ax.plot(self.f/1e9, sign*self.s[:,i,j].imag, label='Im')
+            data = [(self.s[:,i//self.nports,i%self.nports], 1) for i in range(self.nports**2)]
+
+        for (ln1, ln2), (ax, ax2), (z, mult) in zip(self.lines[name], self.axes[name], data):
+            if z is None:
+                for ln in [ln1, ln2]:
+                    ln.set_data([], [])
             else:
-                ln1, = self.ax.plot(self.f/1e9, 20.*np.log10(np.abs(self.s[:,i,j])), label='Mag')
-                ln2, = self.ax2.plot(self.f/1e9, np.angle(self.s[:,i,j], deg=True), 'r', label='Phase')
-
-        lns = [ln1, ln2]
-        self.ax.legend(lns, [l.get_label() for l in lns])
-
-        # plot all Y parameters
-        if self.display_style == 'RI':
-            for i,ax in enumerate(self.ax_y_list):
-                ln1, = ax.plot(self.f/1e9, self.y[:,i//2,i%2].real*1e3, label='Re')
-                ln2, = ax.plot(self.f/1e9, self.y[:,i//2,i%2].imag*1e3, label='Im')
-                if not i:
-                    lns = [ln1, ln2]
-                    ax.legend(lns, [l.get_label() for l in lns])
-        else:
-            for i,ax in enumerate(self.ax_y_list):
-                ax2 = self.ax2_y_list[i]
-                ln1, = ax.plot(self.f/1e9, 20.*np.log10(np.abs(self.y[:,i//2,i%2])), label='Mag')
-                ln2, = ax2.plot(self.f/1e9, np.angle(self.y[:,i//2,i%2], deg=True), 'r', label='Phase')
-                if not i:
-                    lns = [ln1, ln2]
-                    ax.legend(lns, [l.get_label() for l in lns])
+                for ln, curve in zip([ln1, ln2], self.curves(z, mult)):
+                    ln.set_data(self.f/1e9, curve)
+            for a in [ax, ax2]:
+                a.relim()
+                a.autoscale_view()
 
-        # plot all S parameters
-        if self.display_style == 'RI':
-            for i,ax in enumerate(self.ax_s_list):
-                ln1, = ax.plot(self.f/1e9, self.s[:,i//2,i%2].real, label='Re')
-                ln2, = ax.plot(self.f/1e9, self.s[:,i//2,i%2].imag, label='Im')
-                if not i:
-                    lns = [ln1, ln2]
-                    ax.legend(lns, [l.get_label() for l in lns])
+        # update titles
+        title = ', '.join([key + '=' + str(self.params[key]) for key in self.params]) if self.network else ''
+        if name == 'fit':
+            self.ax.set_title(title)
+            if self.network is None:
+                for line in [self.line_r, self.line_i]:
+                    line.set_data([], [])
         else:
-            for i,ax in enumerate(self.ax_s_list):
-                ax2 = self.ax2_s_list[i]
-                ln1, = ax.plot(self.f/1e9, 20.*np.log10(np.abs(self.s[:,i//2,i%2])), label='Mag')
-                ln2, = ax2.plot(self.f/1e9, np.angle(self.s[:,i//2,i%2], deg=True), 'r', label='Phase')
-                if not i:
-                    lns = [ln1, ln2]
-                    ax.legend(lns, [l.get_label() for l in lns])
-        
-        for fig in [self.figure, self.figure_y, self.figure_s]:
-            fig.tight_layout()
+            self.figures[name].suptitle(title)
 
-        # update titles
-        title = ', '.join([key + '=' + str(params[key]) for key in params])
-        self.ax.set_title(title)
-        for fig in [self.figure_y, self.figure_s]:
-            fig.suptitle(title)
-            fig.subplots_adjust(top=0.9)
+        self.canvases[name].draw()
+        self.dirty.discard(name)
+        self.frame_drawn.emit(name, perf_counter() - start)
 
-        # TODO: check if this is still important
-        # if first_load:
-        #     for ax in [self.ax]+self.ax_y_list+self.ax_s_list:
-        #         ax.set_xlim([min(self.dut.f/1e9), max(self.dut.f/1e9)])
-        #     for toolbar in [self.toolbar, self.toolbar_y, self.toolbar_s]:
-        #         toolbar.update()
-        #         toolbar.push_current()
+    @pyqtSlot(int)
+    def tab_changed(self, index):
+        if index != 0:
+            # the fitting figure may be resized while it is hidden
+            self.background = None
+        if 0 <= index < len(FIGURES) and FIGURES[index] in self.dirty:
+            self.update_figure(FIGURES[index])
 
-        # update canvas
-        for canvas in [self.canvas, self.canvas_y, self.canvas_s]:
-            canvas.draw()
+    def fit_figure_drawn(self, event):
+        # after a full redraw of the fitting figure, keep it as the background
+        # for blitting and draw the model lines on it
+        if self.saving:
+            return
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.background_bounds = self.figure.bbox.bounds
+        for line in [self.line_r, self.line_i]:
+            line.axes.draw_artist(line)
 
     def plot_fit(self, model):
         # TODO: this should be in fitter.py
@@ -175,60 +221,59 @@ class Plotter(QTabWidget):
         try:
             y = model.func(2.*np.pi*self.f, **model.values)
         except Exception as e:
-            QMessageBox.critical(self, "Error", "Could not evaluate model function: " + str(e.message))
+            QMessageBox.critical(self, "Error", "Could not evaluate model function: " + str(e))
             return
 
-        if self.line_r:
-            if self.display_style == 'RI':
-                self.line_r.set_ydata(y.real*mult)
-                self.line_i.set_ydata(y.imag*mult)
-            else:
-                self.line_r.set_ydata(20.*np.log10(np.abs(y)))
-                self.line_i.set_ydata(np.angle(y, deg=True))
-        else:
-            if self.display_style == 'RI':
-                self.line_r, = self.ax.plot(self.f/1e9, y.real*mult, '-.')
-                self.line_i, = self.ax.plot(self.f/1e9, y.imag*mult, '-.')
-            else:
-                self.line_r, = self.ax.plot(self.f/1e9, 20.*np.log10(np.abs(y)), '-.')
-                self.line_i, = self.ax.plot(self.f/1e9, np.angle(y, deg=True), '-.')
-        self.canvas.draw()
+        for line, curve in zip([self.line_r, self.line_i], self.curves(y, mult)):
+            line.set_data(self.f/1e9, curve)
+
+        if self.currentIndex() != 0:
+            return      # drawn when the figure is shown
+        if 'fit' in self.dirty or self.background is None or self.figure.bbox.bounds != self.background_bounds:
+            # (the background is outdated when the canvas was resized)
+            self.update_figure('fit')
+            return
+        # only the model lines changed: draw them on the background
+        start = perf_counter()
+        self.canvas.restore_region(self.background)
+        for line in [self.line_r, self.line_i]:
+            line.axes.draw_artist(line)
+        self.canvas.blit(self.figure.bbox)
+        self.frame_drawn.emit('fit', perf_counter() - start)
 
     def save_fig(self, filename):
         # determine active figure
-        # TODO: could probably do this better with a dictionary or by creating subwidgets with figure property
-        if self.currentIndex() == 0:     # fitting
-            figure = self.figure
-        elif self.currentIndex() == 1:   # all Y
-            figure = self.figure_y
-        elif self.currentIndex() == 2:   # all S
-            figure = self.figure_s
-        else:
+        name = FIGURES[self.currentIndex()] if 0 <= self.currentIndex() < len(FIGURES) else None
+        if name is None:
             return
-        figure.savefig(filename)
+        if name in self.dirty:
+            self.update_figure(name)
+        # the model lines are only drawn by blitting on screen
+        self.saving = True
+        try:
+            for line in [self.line_r, self.line_i]:
+                line.set_animated(False)
+            self.figures[name].savefig(filename)
+        finally:
+            for line in [self.line_r, self.line_i]:
+                line.set_animated(True)
+            self.saving = False
 
     def clear(self):
-        for ax in [self.ax, self.ax2] + self.ax_y_list + self.ax2_y_list + self.ax_s_list + self.ax2_s_list:
-            for artist in ax.lines + ax.collections:
-                artist.remove()
-            ax.set_prop_cycle(None)
-            ax.set_title('')
-        for canvas in [self.canvas, self.canvas_y, self.canvas_s]:
-            canvas.draw()
-        self.line_r = None
-        self.line_i = None
+        self.network = None
+        self.params = None
+        if self.display_style != self.line_style:
+            self.setup_lines()
+        self.dirty = set(FIGURES)
+        self.update_figure(FIGURES[self.currentIndex()])
 
     @pyqtSlot(str)
     def fitted_param_changed(self, s):
         self.fitted_param = s
-        sign, param, i, j = parse_fitted_param_str(s)
-        unit = r'\/\mathrm{[mS]}' if param == 'Y' else ''
-        self.ax.set_ylabel('$' +
-                           ('+' if sign > 0 else '-') +
-                           param +
-                           '_{' + str(i+1) + str(j+1) + '}' +
-                           unit +
-                           '$')
+        self.ax.set_ylabel(fitted_param_label(s))
         if self.network:
             self.plot(self.network, self.params)
-        self.canvas.draw()
+        else:
+            self.dirty.add('fit')
+            if self.currentIndex() == 0:
+                self.update_figure('fit')
@@ -0,0 +1,436 @@
+"""
+Preparation of DUT spectra for fitting: thru de-embedding, dummy subtraction
+and contact resistance correction, as a pipeline of stages whose results
+are cached (SpectrumPipeline).
+
+The functions in this module do not interact with the GUI, so that they can
+run in worker threads (see DataLoader.prefetch) and without Qt.
+"""
+import os
+from glob import glob
+from functools import partial
+from collections import OrderedDict
+import numpy as np
+from P13pt.rfspectrum import Network, NetworkStack, ThruDeembedder, Resampler, STACK_EXTENSION
+
+SUPPORTED_EXTENSIONS = ['.txt', '.s2p', '.dat']
+
+
+def check_deembedding_compatibility(ntwk1, ntwk2):
+    # TODO: careful when de-embedding thru from thru
+    return ntwk1.number_of_ports == ntwk2.number_of_ports and len(ntwk1.f) == len(ntwk2.f) and np.max(np.abs(ntwk1.f - ntwk2.f)) < 1e-3
+
+def check_resampling_compatibility(ntwk, reference):
+    # check if reference can be interpolated onto the frequency grid of ntwk
+    return ntwk.number_of_ports == reference.number_of_ports and Resampler.covers(reference.f, ntwk.f)
+
+
+def spectra_files(path):
+    """List the spectra in a folder, a file or a multi-spectrum file folder.
+
+    Returns
+    -------
+    (folder, files, itsafolder): files is empty if there are no spectra,
+    itsafolder is True for ordinary folders (which can get new files)
+    """
+    folder = None
+    files = []
+    itsafolder = False
+
+    if os.path.isdir(path) and path.rstrip('/\\').endswith(STACK_EXTENSION):
+        # binary version of a multi-spectrum file, the spectra are listed
+        # like files (with an extension, which params_from_filename strips)
+        try:
+            files = [name+'.txt' for name in NetworkStack.from_stack_folder(path).names]
+            folder = path
+        except Exception:
+            pass
+    elif os.path.isdir(path):
+        folder = path
+        for ext in SUPPORTED_EXTENSIONS:
+            files += [os.path.basename(x) for x in sorted(glob(os.path.join(folder, '*'+ext)))]
+        itsafolder = True
+    elif os.path.isfile(path):
+        basename, ext = os.path.splitext(path)
+        if ext.lower() in SUPPORTED_EXTENSIONS:
+            folder = os.path.dirname(path)
+            files += [path]
+
+    return folder, files, itsafolder
+
+
+class DeembeddingError(Exception):
+    """Raised by prepare_spectrum if a de-embedding stage ('thru' or
+    'dummy') is not compatible with the DUT."""
+    def __init__(self, stage, message):
+        super(DeembeddingError, self).__init__(message)
+        self.stage = stage
+
+
+def deembed_thru(dut, thru_deembedder):
+    """De-embed a thru (interpolated onto the frequency grid of the DUT if
+    necessary)."""
+    if check_deembedding_compatibility(dut, thru_deembedder):
+        return thru_deembedder.deembed(dut)
+    elif check_resampling_compatibility(dut, thru_deembedder):
+        return thru_deembedder.on_grid(dut.f).deembed(dut)
+    raise DeembeddingError('thru', 'Could not deembed thru.')
+
+
+def subtract_dummy(dut, dummy):
+    """Subtract the admittance of a dummy (interpolated onto the frequency
+    grid of the DUT if necessary)."""
+    if check_deembedding_compatibility(dut, dummy):
+        return dut._with_y(dut.y - dummy.y)
+    elif check_resampling_compatibility(dut, dummy):
+        return dut._with_y(dut.y - Resampler.for_grids(dummy.f, dut.f)(dummy.y))
+    raise DeembeddingError('dummy', 'Could not deembed dummy.')
+
+
+def correct_ra(dut, ra):
+    """Remove the contact resistance ra from the admittance matrix."""
+    # -ra for the diagonal elements, +ra for the others
+    sign = 1. - 2.*np.eye(dut.number_of_ports)
+    return dut._with_y(1. / (1. / dut.y + sign*ra))
+
+
+# processing stages after loading the raw spectrum, with the function and the
+# value of the setting that switches the stage off
+STAGES = [('thru', deembed_thru, None),
+          ('dummy', subtract_dummy, None),
+          ('ra', correct_ra, 0.)]
+
+
+def _is_off(setting, off):
+    return setting is off or (off is not None and setting == off)
+
+
+def run_stages(dut, settings, start=0, results=None):
+    """Apply the processing stages from STAGES[start] on.
+
+    Arguments
+    ---------
+    dut : Network object
+        the output of the stage before STAGES[start]
+    settings : dict
+        the thru de-embedder, dummy and contact resistance (None or 0 to
+        skip a stage)
+    start : int
+        the index of the first stage to apply
+    results : list or None
+        (stage name, Network object) tuples are appended for every stage
+        that was applied; the list is also complete up to the failing stage
+        if an exception is raised
+
+    Returns
+    -------
+    Network object
+    """
+    for name, func, off in STAGES[start:]:
+        setting = settings.get(name, off)
+        if _is_off(setting, off):
+            continue
+        dut = func(dut, setting)
+        if results is not None:
+            results.append((name, dut))
+    return dut
+
+
+def prepare_spectrum(dut, thru_deembedder=None, dummy=None, ra=0.):
+    """De-embed and correct a DUT spectrum.
+
+    The input network is not modified.
+
+    Arguments
+    ---------
+    dut : Network object
+        the raw DUT spectrum
+    thru_deembedder : ThruDeembedder or None
+        the thru to de-embed (if it is measured on a different frequency
+        grid, it is interpolated onto the one of the DUT)
+    dummy : Network object or None
+        the dummy whose admittance is subtracted (likewise interpolated if
+        necessary)
+    ra : float
+        the contact resistance
+
+    Returns
+    -------
+    Network object
+
+    Raises
+    ------
+    DeembeddingError if the thru or the dummy cannot be de-embedded
+    """
+    return run_stages(dut, dict(thru=thru_deembedder, dummy=dummy, ra=ra))
+
+
+class SpectrumPipeline(object):
+    """Preparation of spectra with a cache for the output of each stage:
+    raw -> thru de-embedded -> dummy subtracted -> contact resistance
+    corrected.
+
+    Changing the setting of a stage (see :meth:`configure`) only drops the
+    cached results of this stage and of the ones after it, so that e.g. a
+    new contact resistance is applied to the cached dummy subtracted
+    spectra without reading the files or de-embedding the thru again.
+    Stages that are switched off do not store anything.
+
+    The results are kept in a :class:`SpectrumCache` with keys
+    (stage, filename), stage being 'raw' or one of the names in STAGES, so
+    that all stages share the same memory budget.
+
+    Arguments
+    ---------
+    cache : SpectrumCache or None
+        the cache for the results
+    """
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else SpectrumCache()
+        self.settings = dict((name, off) for name, func, off in STAGES)
+        self.generation = 0     # incremented whenever cached results are dropped
+
+    def active_stages(self):
+        """Names of the stages that are applied, starting with 'raw'."""
+        return ['raw'] + [name for name, func, off in STAGES if not _is_off(self.settings[name], off)]
+
+    def configure(self, **settings):
+        """Change the settings of some stages.
+
+        Returns
+        -------
+        the name of the first stage whose setting changed (None if nothing
+        changed)
+        """
+        first = None
+        for name, func, off in STAGES:
+            if name not in settings:
+                continue
+            new, old = settings[name], self.settings[name]
+            # objects (thru, dummy) are compared by identity, numbers by value
+            if new is old or (name == 'ra' and new == old):
+                continue
+            self.settings[name] = new
+            if first is None:
+                first = name
+        if first is not None:
+            self.invalidate(first)
+        return first
+
+    def invalidate(self, stage='raw'):
+        """Drop the cached results of a stage and of all following ones."""
+        names = ['raw'] + [name for name, func, off in STAGES]
+        dropped = names[names.index(stage):]
+        for key in self.cache.keys():
+            if key[0] in dropped:
+                self.cache.pop(key)
+        self.generation += 1
+
+    def lookup(self, filename):
+        """Find the latest cached result for a spectrum.
+
+        Returns
+        -------
+        (start, dut): the index in STAGES of the next stage to apply and the
+        cached network, or (0, None) if nothing is cached
+        """
+        names = [name for name, func, off in STAGES]
+        stages = self.active_stages()
+        # the final result is looked up first, so that the cache statistics
+        # count it as a hit or a miss
+        dut = self.cache.get((stages[-1], filename))
+        if dut is not None:
+            return len(STAGES), dut
+        for name in reversed(stages[:-1]):
+            if (name, filename) in self.cache:
+                return (names.index(name)+1 if name != 'raw' else 0), self.cache.get((name, filename))
+        return 0, None
+
+    def store(self, filename, results):
+        """Store the (stage, Network object) results of run_stages."""
+        for name, dut in results:
+            self.cache.put((name, filename), dut)
+
+    def prepare(self, filename, load):
+        """Get the prepared spectrum, applying only the stages that are not
+        cached.
+
+        Arguments
+        ---------
+        filename : string
+            the key of the spectrum
+        load : function
+            loads the raw spectrum (only called if it is not cached)
+        """
+        start, dut = self.lookup(filename)
+        if start == len(STAGES):
+            return dut
+        results = []
+        if dut is None:
+            dut = load()
+            results.append(('raw', dut))
+        try:
+            return run_stages(dut, self.settings, start, results)
+        finally:
+            self.store(filename, results)
+
+    def prepared(self):
+        """File names of the spectra whose final result is cached."""
+        final = self.active_stages()[-1]
+        return [key[1] for key in self.cache.keys() if key[0] == final]
+
+    def peek(self, filename):
+        """Get the prepared spectrum if it is cached (None otherwise),
+        without counting it in the statistics of the cache."""
+        return self.cache.peek((self.active_stages()[-1], filename))
+
+
+def network_nbytes(ntwk):
+    """Memory used by the arrays of a network: frequencies, port impedances
+    and the S, Y and Z matrices that are currently held (see the memoized
+    representations of P13pt.rfspectrum.Network)."""
+    arrays = [ntwk.f, ntwk.z0] + list(ntwk.__dict__.get('_reprs', {}).values())
+    return sum(np.asarray(a).nbytes for a in arrays)
+
+
+class SpectrumCache(object):
+    """Least recently used cache of prepared spectra with a byte budget.
+
+    When the total size of the cached spectra (see :func:`network_nbytes`)
+    exceeds the budget, the least recently used ones are evicted (the most
+    recent one is always kept). Since a spectrum may grow after it was
+    cached (e.g. when its Y matrix is calculated for plotting), its size is
+    measured again on every access.
+
+    Arguments
+    ---------
+    budget : int
+        the maximum size in bytes
+    """
+    def __init__(self, budget=512*1024**2):
+        self.budget = budget
+        self._items = OrderedDict()     # key -> (value, size)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        # does not count as an access
+        return key in self._items
+
+    def keys(self):
+        return list(self._items.keys())
+
+    def get(self, key):
+        """Get a cached spectrum (None if it is not cached) and mark it as
+        most recently used."""
+        if key not in self._items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value, size = self._items.pop(key)
+        self._insert(key, value, size)
+        return value
+
+    def peek(self, key):
+        """Get a cached spectrum (None if it is not cached), this does not
+        count as an access."""
+        item = self._items.get(key)
+        return None if item is None else item[0]
+
+    def put(self, key, value):
+        """Add a spectrum, evicting the least recently used ones if needed."""
+        if key in self._items:
+            self.nbytes -= self._items.pop(key)[1]
+        self._insert(key, value, 0)
+
+    def _insert(self, key, value, size):
+        new_size = network_nbytes(value)
+        self._items[key] = (value, new_size)
+        self.nbytes += new_size - size
+        while self.nbytes > self.budget and len(self._items) > 1:
+            self.nbytes -= self._items.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def set_budget(self, budget):
+        self.budget = budget
+        if self._items:
+            # re-inserting the most recent spectrum triggers the eviction
+            key = next(reversed(self._items))
+            value, size = self._items.pop(key)
+            self._insert(key, value, size)
+
+    def pop(self, key):
+        value, size = self._items.pop(key)
+        self.nbytes -= size
+        return value
+
+    def clear(self):
+        """Remove all spectra (the statistics are kept)."""
+        self._items.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return dict(count=len(self._items), nbytes=self.nbytes, budget=self.budget,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+class Dataset(object):
+    """The DUT spectra with the thru, dummy and contact resistance to
+    de-embed, as set up by the DataLoader, but without the GUI (e.g. for
+    fitting on a machine without display).
+
+    Arguments
+    ---------
+    dut : string
+        a folder, a spectrum file or a multi-spectrum file folder
+    thru, dummy : string or None
+        the spectrum files of the thru and the dummy
+    ra : float
+        the contact resistance
+    cache : SpectrumCache or None
+        the cache of the pipeline
+
+    Raises
+    ------
+    Exception if there are no DUT spectra or if the thru and the dummy are
+    not compatible
+    """
+    def __init__(self, dut, thru=None, dummy=None, ra=0., cache=None):
+        self.folder, self.files, itsafolder = spectra_files(dut)
+        if not self.files:
+            raise Exception('No spectra found in: ' + dut)
+        self.stack = None
+        if self.folder.rstrip('/\\').endswith(STACK_EXTENSION):
+            self.stack = NetworkStack.from_stack_folder(self.folder)
+        self.thru = Network(thru) if thru else None
+        self.thru_deembedder = ThruDeembedder.for_thru(self.thru) if self.thru else None
+        self.dummy = Network(dummy) if dummy else None
+        if self.dummy and self.thru:
+            # the dummy is measured with the same access lines as the DUT
+            self.dummy = deembed_thru(self.dummy, self.thru_deembedder)
+        self.ra = ra
+        self.pipeline = SpectrumPipeline(cache)
+        self.pipeline.configure(thru=self.thru_deembedder, dummy=self.dummy, ra=ra)
+
+    def __len__(self):
+        return len(self.files)
+
+    def load_raw(self, index):
+        """Get a function that loads the raw spectrum."""
+        if self.stack is not None:
+            return partial(self.stack.network, index)
+        return partial(Network, os.path.join(self.folder, self.files[index]))
+
+    def get_spectrum(self, index):
+        """Get the prepared spectrum.
+
+        Raises
+        ------
+        DeembeddingError if the thru or the dummy cannot be de-embedded
+        """
+        return self.pipeline.prepare(self.files[index], self.load_raw(index))
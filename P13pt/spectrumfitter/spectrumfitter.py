@@ -2,29 +2,43 @@
 import sys
 import os
 import shutil
+import traceback
+import multiprocessing
 from glob import glob
 
+import numpy as np
+
 from PyQt5.QtCore import (Qt, qInstallMessageHandler, QtInfoMsg, QtCriticalMsg, QtDebugMsg,
                           QtWarningMsg, QtFatalMsg, QSettings, pyqtSlot, QStandardPaths, QUrl)
 from PyQt5.QtGui import QIcon, QDesktopServices
 from PyQt5.QtWidgets import (QApplication, QMessageBox, QMainWindow, QDockWidget, QAction,
-                             QFileDialog, QProgressDialog)
+                             QFileDialog, QProgressDialog, QLabel, QInputDialog)
 
 from P13pt.spectrumfitter.dataloader import DataLoader
 from P13pt.spectrumfitter.navigator import Navigator
 from P13pt.spectrumfitter.fitter import Fitter
-from P13pt.spectrumfitter.plotter import Plotter
-from P13pt.spectrumfitter.load_fitresults import load_fitresults
+from P13pt.spectrumfitter.batchfit import fit_spectra, fitted_data, warm_start_stats
+from P13pt.spectrumfitter.globalfit import global_fit
+from P13pt.spectrumfitter.fitcache import FitCache
+from P13pt.spectrumfitter.plotter import Plotter, FIGURES
+from P13pt.spectrumfitter.sweepmap import SweepMap
+from P13pt.spectrumfitter.imageexport import ExportJob, export_images, FORMATS
+from P13pt.spectrumfitter.load_fitresults import load_fitresults, save_fitresults
 from P13pt.params_from_filename import params_from_filename
 
 class MainWindow(QMainWindow):
     session_file = None
+    sweepmap_generation = None  # generation of the data loader's pipeline of the spectra in the sweep map
 
     def __init__(self, parent=None):
         super(MainWindow, self).__init__(parent)
 
         self.settings = QSettings("Mercury", "SpectrumFitter")
 
+        # results of previous fits, see fit_all
+        self.fit_cache = FitCache(os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation),
+                                               'fitcache.json'))
+
         # set up data loading area
         self.dock_loader = QDockWidget('Data loading', self)
         self.dock_loader.setObjectName('loader')
@@ -40,6 +54,8 @@ class MainWindow(QMainWindow):
         # set up plotter
         self.plotter = Plotter()
         self.setCentralWidget(self.plotter)
+        self.frame_time = QLabel()
+        self.statusBar().addPermanentWidget(self.frame_time)
 
         # set up fitter
         self.dock_fitter = QDockWidget('Fitting', self)
@@ -47,10 +63,18 @@ class MainWindow(QMainWindow):
         self.fitter = Fitter()
         self.dock_fitter.setWidget(self.fitter)
 
+        # set up sweep map
+        self.dock_sweepmap = QDockWidget('Sweep map', self)
+        self.dock_sweepmap.setObjectName('sweepmap')
+        self.sweepmap = SweepMap()
+        self.dock_sweepmap.setWidget(self.sweepmap)
+
         # set up the dock positions
         self.addDockWidget(Qt.TopDockWidgetArea, self.dock_loader)
         self.addDockWidget(Qt.LeftDockWidgetArea, self.dock_navigator)
         self.addDockWidget(Qt.RightDockWidgetArea, self.dock_fitter)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.dock_sweepmap)
+        self.dock_sweepmap.hide()
 
         # set up menus
         fileMenu = self.menuBar().addMenu('File')
@@ -69,7 +93,7 @@ class MainWindow(QMainWindow):
             fileMenu.addAction(a)
 
         viewMenu = self.menuBar().addMenu('View')
-        for w in [self.dock_loader, self.dock_navigator, self.dock_fitter]:
+        for w in [self.dock_loader, self.dock_navigator, self.dock_fitter, self.dock_sweepmap]:
             viewMenu.addAction(w.toggleViewAction())
         self.act_restore_default_view = QAction('Restore default', self)
         viewMenu.addAction(self.act_restore_default_view)
@@ -82,15 +106,26 @@ class MainWindow(QMainWindow):
         toolsMenu.addAction(self.act_install_builtin_models)
         self.act_open_model_folder = QAction('Open model folder', self)
         toolsMenu.addAction(self.act_open_model_folder)
+        self.act_clear_fit_cache = QAction('Clear fit cache', self)
+        toolsMenu.addAction(self.act_clear_fit_cache)
 
         # make connections
         self.loader.dataset_changed.connect(self.dataset_changed)
         self.loader.new_file_in_dataset.connect(self.navigator.new_file_in_dataset)
         self.loader.deembedding_changed.connect(self.deembedding_changed)
+        self.loader.cache_changed.connect(lambda: self.navigator.mark_cached(self.loader.pipeline.prepared()))
+        self.loader.cache_changed.connect(self.update_sweepmap)
+        self.loader.new_file_in_dataset.connect(self.sweepmap.new_file_in_dataset)
+        self.sweepmap.spectrum_selected.connect(self.navigator.file_list.setCurrentRow)
+        self.sweepmap.load_all.connect(self.load_all_spectra)
         self.navigator.selection_changed.connect(self.selection_changed)
         self.fitter.fit_changed.connect(lambda: self.plotter.plot_fit(self.fitter.model))
         self.fitter.fitted_param_changed.connect(self.plotter.fitted_param_changed)
+        self.fitter.fitted_param_changed.connect(self.sweepmap.fitted_param_changed)
+        self.plotter.frame_drawn.connect(
+            lambda figure, t: self.frame_time.setText('Redraw ({}): {:.1f} ms'.format(figure, t*1e3)))
         self.fitter.btn_fitall.clicked.connect(self.fit_all)
+        self.fitter.btn_globalfit.clicked.connect(self.global_fit)
         self.act_new_session.triggered.connect(self.new_session)
         self.act_load_session.triggered.connect(self.load_session)
         self.act_save_session.triggered.connect(self.save_session)
@@ -101,6 +136,7 @@ class MainWindow(QMainWindow):
         self.act_toggle_display_style.triggered.connect(self.toggle_display_style)
         self.act_install_builtin_models.triggered.connect(self.install_builtin_models)
         self.act_open_model_folder.triggered.connect(self.open_model_folder)
+        self.act_clear_fit_cache.triggered.connect(self.clear_fit_cache)
 
         # set up fitted parameter (this has to be done after making connections, so that fitter and plotter sync)
         self.fitter.fitted_param = '-Y12'       # default value
@@ -118,14 +154,20 @@ class MainWindow(QMainWindow):
             self.restoreGeometry(self.settings.value("geometry"))
         if self.settings.contains('windowState'):
             self.restoreState(self.settings.value("windowState"))
+        if self.settings.contains('cacheBudget'):
+            self.loader.spn_cache.setValue(int(self.settings.value('cacheBudget')))
 
     def closeEvent(self, event):
         self.settings.setValue("geometry", self.saveGeometry())
         self.settings.setValue("windowState", self.saveState())
+        self.settings.setValue('cacheBudget', self.loader.cache_budget)
         super(MainWindow, self).closeEvent(event)
 
     def dataset_changed(self):
         self.fitter.empty_cache()
+        self.fitter.update_sweep_params(params_from_filename(self.loader.dut_files[0]) if self.loader.dut_files else [])
+        self.sweepmap.set_dataset(self.loader.dut_files)
+        self.update_sweepmap()
         self.navigator.update_file_list(self.loader.dut_files)
         for a in [self.act_save_session, self.act_save_session_as, self.act_save_image, self.act_save_allimages]:
             a.setEnabled(True)
@@ -147,6 +189,7 @@ class MainWindow(QMainWindow):
         else:
             self.plotter.clear()
         self.fitter.update_network(spectrum, self.loader.dut_files[i])
+        self.loader.prefetch(i)
 
     def selection_changed(self, i):
         if i < 0:       # when file_list is cleared:
@@ -160,7 +203,10 @@ class MainWindow(QMainWindow):
             self.plotter.plot(spectrum, params_from_filename(self.loader.dut_files[i]))
         else:
             self.plotter.clear()
+        self.sweepmap.select(i)
         self.fitter.update_network(spectrum, self.loader.dut_files[i])
+        # prepare the neighbouring spectra in the background
+        self.loader.prefetch(i)
 
         QApplication.restoreOverrideCursor()
 
@@ -171,6 +217,7 @@ class MainWindow(QMainWindow):
         self.loader.clear()
         self.navigator.clear()
         self.plotter.clear()
+        self.sweepmap.set_dataset([])
         for a in [self.act_save_session, self.act_save_session_as, self.act_save_image, self.act_save_allimages]:
             a.setEnabled(False)
 
@@ -180,53 +227,28 @@ class MainWindow(QMainWindow):
             res_file, filter = QFileDialog.getSaveFileName(self, 'Fit results file', filter='*.txt')
         if not res_file:
             return
-        res_folder = os.path.dirname(res_file)
 
         try:
-            with open(res_file, 'w') as f:
-                # write the header
-                f.write('# fitting results generated by P13pt spectrum fitter\n')
-                if len(self.loader.dut_files) == 1:
-                    f.write('# dut: ' +
-                            os.path.join(
-                                os.path.relpath(self.loader.dut_folder, res_folder),
-                                self.loader.dut_files[0]
-                            ).replace('\\', '/') + '\n')
-                else:
-                    f.write('# dut: ' + os.path.relpath(self.loader.dut_folder, res_folder).replace('\\', '/') + '\n')
-                if self.loader.thru and self.loader.thru_toggle_status:
-                    f.write('# thru: ' + os.path.relpath(self.loader.thru_file, res_folder).replace('\\', '/') + '\n')
-                if self.loader.dummy and self.loader.dummy_toggle_status:
-                    f.write('# dummy: ' + os.path.relpath(self.loader.dummy_file, res_folder).replace('\\', '/') + '\n')
-                f.write('# fitted_param: ' + self.plotter.fitted_param + '\n')
-                try:
-                    ra = float(self.loader.txt_ra.text())
-                except:
-                    ra = 0.
-                if not ra == 0:
-                    f.write('# ra: ' + str(ra) + '\n')
-                if self.fitter.model:
-                    f.write('# model: ' + os.path.basename(self.fitter.model_file).replace('\\', '/') + '\n')
-                    f.write('# model_func: ' + self.fitter.cmb_modelfunc.currentText() + '\n')
-                    # TODO: this all could clearly be done in a more elegant way
-                    if self.fitter.cmb_fitmethod.currentText() != 'No fit methods found':
-                        f.write('# fit_method: ' + self.fitter.cmb_fitmethod.currentText() + '\n')
-                    # determine columns
-                    f.write('# filename\t')
-                    for p in params_from_filename(self.loader.dut_files[0]):
-                        f.write(p + '\t')
-                    f.write('\t'.join([p for p in self.fitter.model.params]))
-                    f.write('\n')
-
-                    # write data
-                    filelist = sorted([filename for filename in self.fitter.model_params])
-                    for filename in filelist:
-                        f.write(filename + '\t')
-                        # TODO: what if some filenames do not contain all parameters? should catch exceptions
-                        for p in params_from_filename(self.loader.dut_files[0]):
-                            f.write(str(params_from_filename(filename)[p]) + '\t')
-                        f.write('\t'.join([str(self.fitter.model_params[filename][p]) for p in self.fitter.model.params]))
-                        f.write('\n')
+            ra = float(self.loader.txt_ra.text())
+        except:
+            ra = 0.
+        model = self.fitter.model
+        try:
+            save_fitresults(res_file,
+                            os.path.join(self.loader.dut_folder, self.loader.dut_files[0])
+                            if len(self.loader.dut_files) == 1 else self.loader.dut_folder,
+                            self.loader.dut_files,
+                            thru=self.loader.thru_file if self.loader.thru and self.loader.thru_toggle_status else None,
+                            dummy=self.loader.dummy_file if self.loader.dummy and self.loader.dummy_toggle_status else None,
+                            ra=ra,
+                            fitted_param=self.plotter.fitted_param,
+                            model_file=self.fitter.model_file if model else None,
+                            model_func=self.fitter.cmb_modelfunc.currentText() if model else None,
+                            # TODO: this all could clearly be done in a more elegant way
+                            fit_method=self.fitter.cmb_fitmethod.currentText()
+                            if model and self.fitter.cmb_fitmethod.currentText() != 'No fit methods found' else None,
+                            params=[p for p in model.params] if model else None,
+                            model_params=self.fitter.model_params)
         except EnvironmentError as e:
             QMessageBox.critical(self, 'Error', 'Could not save session: '+str(e))
             return
@@ -278,24 +300,169 @@ class MainWindow(QMainWindow):
         self.setWindowTitle('Spectrum Fitter - '+res_file)
         self.session_file = res_file
 
+    def prepare_all(self, progressdialog):
+        # prepare the spectra one after the other (using the cache of the data
+        # loader) and yield (file name, spectrum), stops if the dialog is
+        # cancelled; the callers only keep what they need of each spectrum,
+        # so that all spectra are never in memory at once
+        for i, filename in enumerate(self.loader.dut_files):
+            QApplication.processEvents()
+            if progressdialog.wasCanceled():
+                return
+            spectrum = self.loader.get_spectrum(i)
+            if spectrum is not None:
+                yield filename, spectrum
+            progressdialog.setValue(i)
+
+    @pyqtSlot()
+    def update_sweepmap(self):
+        # add the spectra that were prepared since the last update to the sweep
+        # map, the spectra of the map are outdated when the pipeline drops
+        # cached results (e.g. when the de-embedding changes)
+        pipeline = self.loader.pipeline
+        if pipeline.generation != self.sweepmap_generation:
+            self.sweepmap_generation = pipeline.generation
+            self.sweepmap.clear()
+        for filename in pipeline.prepared():
+            if not self.sweepmap.has(filename):
+                self.sweepmap.add(filename, pipeline.peek(filename))
+
+    @pyqtSlot()
+    def load_all_spectra(self):
+        # the spectra are added to the sweep map as they get prepared
+        progressdialog = QProgressDialog('Preparing spectra...', 'Cancel', 0, len(self.loader.dut_files), self)
+        progressdialog.setWindowTitle('Progress')
+        progressdialog.setModal(True)
+        progressdialog.setAutoClose(True)
+        progressdialog.show()
+        for i in range(len(self.loader.dut_files)):
+            QApplication.processEvents()
+            if progressdialog.wasCanceled():
+                break
+            self.loader.get_spectrum(i)
+            progressdialog.setValue(i)
+        progressdialog.close()
+
     #TODO: this is not really in the right place
     @pyqtSlot()
     def fit_all(self):
-         totalnum = len(self.loader.dut_files)
-
-         progressdialog = QProgressDialog('Fitting all spectra...', 'Cancel', 0, totalnum-1, self)
-         progressdialog.setWindowTitle('Progress')
-         progressdialog.setModal(True)
-         progressdialog.setAutoClose(True)
-         progressdialog.show()
-
-         for i in range(totalnum):
-             QApplication.processEvents()
-             if progressdialog.wasCanceled():
-                 break
-             self.navigator.file_list.setCurrentRow(i)
-             self.fitter.fit_model()
-             progressdialog.setValue(i)
+        totalnum = len(self.loader.dut_files)
+
+        progressdialog = QProgressDialog('Preparing spectra...', 'Cancel', 0, totalnum, self)
+        progressdialog.setWindowTitle('Progress')
+        progressdialog.setModal(True)
+        progressdialog.setAutoClose(True)
+        progressdialog.show()
+
+        # the spectra are prepared here and the fits run in worker processes
+        # without any Qt widgets, the jobs only keep the fitted data; the
+        # results (also from the fit cache) already come during the
+        # preparation
+        fits = []
+        prepared = [False]
+
+        def jobs():
+            count = 0
+            for filename, spectrum in self.prepare_all(progressdialog):
+                count += 1
+                yield self.fitter.fit_job(spectrum, filename)
+            if not progressdialog.wasCanceled():
+                prepared[0] = True
+                progressdialog.setLabelText('Fitting all spectra...')
+                progressdialog.setMaximum(count)
+                progressdialog.setValue(len(fits))
+        errors = []
+
+        def poll():
+            QApplication.processEvents()
+            return not progressdialog.wasCanceled()
+
+        # only the spectrum on screen is plotted (see Fitter.store_fit)
+        warm_start = self.fitter.warm_start_param()
+        fit_cached = set(self.navigator.fit_cached)
+        for k, fit in enumerate(fit_spectra(jobs(), poll=poll, warm_start=warm_start, cache=self.fit_cache,
+                                            model_func=self.fitter.cmb_modelfunc.currentText())):
+            fits.append(fit)
+            if fit.error is None:
+                self.fitter.store_fit(fit.filename, fit.values)
+                if fit.start == 'cached':
+                    fit_cached.add(fit.filename)
+                else:
+                    fit_cached.discard(fit.filename)
+            else:
+                errors.append(fit.filename + ':\n' + fit.error)
+            if prepared[0]:
+                progressdialog.setValue(k+1)
+        progressdialog.close()
+        if not fits:
+            return
+        self.navigator.mark_fit_cached(fit_cached)
+        try:
+            self.fit_cache.save()
+        except (IOError, OSError) as e:
+            errors.append('Could not save the fit cache: ' + str(e))
+
+        stats = warm_start_stats(fits)
+        if warm_start:
+            self.statusBar().showMessage('Warm start: {warm} warm, {fallback} fallback and {cold} cold start(s), '
+                                         '{cached} from the fit cache, {nfev} function evaluations, '
+                                         'about {nfev_saved} saved'.format(**stats))
+        elif stats['cached']:
+            self.statusBar().showMessage('{cached} of {total} fit results from the fit cache'.format(
+                total=len(fits), **stats))
+
+        if errors:
+            QMessageBox.critical(self, 'Error', 'Error during fit:\n' + '\n'.join(errors))
+
+    @pyqtSlot()
+    def global_fit(self):
+        progressdialog = QProgressDialog('Preparing spectra...', 'Cancel', 0, len(self.loader.dut_files), self)
+        progressdialog.setWindowTitle('Progress')
+        progressdialog.setModal(True)
+        progressdialog.setAutoClose(True)
+        progressdialog.show()
+        # only the fitted data of the spectra is kept
+        filenames, y, f = [], [], None
+        for filename, spectrum in self.prepare_all(progressdialog):
+            if f is None:
+                f = spectrum.f
+            elif len(spectrum.f) != len(f) or not np.allclose(spectrum.f, f):
+                progressdialog.close()
+                QMessageBox.critical(self, 'Error', 'The global fit needs all spectra on the same frequencies.')
+                return
+            filenames.append(filename)
+            y.append(fitted_data(spectrum, self.fitter.fitted_param))
+        if progressdialog.wasCanceled() or not filenames:
+            progressdialog.close()
+            return
+        y = np.array(y)
+        initial = [self.fitter.initial_values(filename) for filename in filenames]
+        shared, fixed = self.fitter.global_fit_params()
+
+        # the dialog stays open during the fit, which can be cancelled
+        progressdialog.setLabelText('Global fit of {} spectra...'.format(len(filenames)))
+        progressdialog.setRange(0, 0)
+
+        def poll():
+            QApplication.processEvents()
+            return not progressdialog.wasCanceled()
+
+        try:
+            res = global_fit(self.fitter.model, f, y, initial, shared, fixed,
+                             func=str(self.fitter.cmb_modelfunc.currentText()), poll=poll)
+        except Exception:
+            progressdialog.close()
+            QMessageBox.critical(self, 'Error', 'Error during global fit: ' + traceback.format_exc())
+            return
+        progressdialog.close()
+        if res is None:
+            self.statusBar().showMessage('Global fit cancelled')
+            return
+
+        for filename, values in zip(filenames, res.values):
+            self.fitter.store_fit(filename, values)
+        self.navigator.mark_fit_cached(self.navigator.fit_cached - set(filenames))
+        self.statusBar().showMessage('Global fit: {}, {} function evaluations'.format(res.message, res.nfev))
 
     def save_image(self):
         basename, ext = os.path.splitext(self.loader.dut_files[self.navigator.file_list.currentRow()])
@@ -308,23 +475,57 @@ class MainWindow(QMainWindow):
     def save_all_images(self):
         foldername = QFileDialog.getExistingDirectory(self, 'Choose folder',
                                                       self.loader.dut_folder)
+        if not foldername:
+            return
+        fmt, ok = QInputDialog.getItem(self, 'Image format', 'Format:', FORMATS, 0, False)
+        if not ok:
+            return
 
         totalnum = len(self.loader.dut_files)
 
-        progressdialog = QProgressDialog('Saving all images...', 'Cancel', 0, totalnum - 1, self)
+        progressdialog = QProgressDialog('Saving all images...', 'Cancel', 0, totalnum, self)
         progressdialog.setWindowTitle('Progress')
         progressdialog.setModal(True)
         progressdialog.setAutoClose(True)
         progressdialog.show()
 
-        for i in range(totalnum):
+        # the images of the current tab are drawn in worker processes, from
+        # the prepared spectra and the fitted values, without the Qt widgets;
+        # the spectra are prepared as the workers need them (see export_images)
+        name = FIGURES[self.plotter.currentIndex()]
+        figure = self.plotter.figures[name]
+        model = self.fitter.model is not None
+
+        def jobs():
+            for filename, spectrum in self.prepare_all(progressdialog):
+                params = params_from_filename(filename)
+                yield ExportJob(os.path.join(foldername, os.path.splitext(filename)[0] + '.' + fmt),
+                                spectrum.f, spectrum.s, spectrum.y,
+                                ', '.join([key + '=' + str(params[key]) for key in params]),
+                                name, self.plotter.display_style, self.fitter.fitted_param,
+                                self.fitter.model_file if model else None,
+                                str(self.fitter.cmb_modelfunc.currentText()) if model else None,
+                                self.fitter.model_params.get(filename) if model else None,
+                                tuple(figure.get_size_inches()), figure.dpi)
+
+        def poll():
             QApplication.processEvents()
-            if progressdialog.wasCanceled():
-                break
-            self.navigator.file_list.setCurrentRow(i)
-            basename, ext = os.path.splitext(self.loader.dut_files[self.navigator.file_list.currentRow()])
-            self.plotter.save_fig(os.path.join(foldername, basename+'.png'))
-            progressdialog.setValue(i)
+            return not progressdialog.wasCanceled()
+
+        errors = []
+        saved = skipped = 0
+        for result in export_images(jobs(), poll=poll):
+            if result.error is not None:
+                errors.append(result.filename + ':\n' + result.error)
+            elif result.skipped:
+                skipped += 1
+            else:
+                saved += 1
+        progressdialog.close()
+        self.statusBar().showMessage('{} image(s) saved, {} already up to date'.format(saved, skipped))
+
+        if errors:
+            QMessageBox.critical(self, 'Error', 'Error while saving images:\n' + '\n'.join(errors))
 
     def load_recent(self):
         action = self.sender()
@@ -359,6 +560,11 @@ class MainWindow(QMainWindow):
             # if file does not exist or user does not mind replacing it, let's copy:
             shutil.copyfile(filename, os.path.join(self.fitter.models_dir, os.path.basename(filename)))
 
+    def clear_fit_cache(self):
+        self.fit_cache.clear()
+        self.fit_cache.save()
+        self.navigator.mark_fit_cached([])
+
     def open_model_folder(self):
         QDesktopServices.openUrl(QUrl.fromLocalFile(self.fitter.models_dir))
 
@@ -375,6 +581,7 @@ def msghandler(type, context, message):
         QMessageBox.critical(None, 'Fatal error', message)
 
 def main():
+    multiprocessing.freeze_support()    # for the worker processes of "Fit all"
     qInstallMessageHandler(msghandler)
 
     # CD into directory where this script is saved
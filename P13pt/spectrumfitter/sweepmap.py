@@ -0,0 +1,342 @@
+"""
+Sweep map: the fitted parameter of all spectra of a dataset as one image.
+
+The S matrices of the spectra are stacked on a shared frequency grid (the
+grid of the first spectrum, decimated to at most max_points frequencies) in
+a single array, see NetworkStack. The image shows the magnitude, the real or
+the imaginary part of the fitted parameter versus the frequency and a file
+name parameter (e.g. Vg). The spectra are added as they get prepared, the
+rows of the others are empty.
+"""
+import numpy as np
+
+from PyQt5.QtCore import QTimer, pyqtSignal, pyqtSlot
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QComboBox, QLabel, QPushButton
+
+import matplotlib.pyplot as plt
+from matplotlib.ticker import FuncFormatter, MaxNLocator
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+
+from P13pt.rfspectrum import NetworkStack, Resampler, grid_key, params_array
+from P13pt.params_from_filename import params_from_filename
+from P13pt.spectrumfitter.batchfit import parse_fitted_param_str
+
+COMPONENTS = ['Magnitude', 'Real part', 'Imaginary part']
+
+
+class SweepGrid(object):
+    """The spectra of a dataset on a shared frequency grid.
+
+    Arguments
+    ---------
+    filenames : list of strings
+        the files of the dataset (more can be appended)
+    max_points : int or None
+        the maximum number of frequencies of the grid (default: max_points)
+    """
+    max_points = 1000
+
+    def __init__(self, filenames=(), max_points=None):
+        if max_points is not None:
+            self.max_points = max_points
+        self.filenames = []
+        self.index = {}         # file name -> row
+        self.loaded = np.zeros(0, dtype=bool)
+        self.f = None           # the shared grid
+        self.s = None           # S matrices on the shared grid, shape (capacity, N, P, P)
+        self.z0 = 50.
+        self.source = None      # grid key of the first spectrum and step of the decimation
+        self.quantity = {}      # fitted parameter -> its values for all rows (NaN if not loaded)
+        self._params = None
+        for filename in filenames:
+            self.append(filename)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def append(self, filename):
+        """Add a file to the dataset (without its spectrum)."""
+        self.index[filename] = len(self.filenames)
+        self.filenames.append(filename)
+        self.loaded = np.append(self.loaded, False)
+        self._params = None
+        if self.s is not None and len(self.s) < len(self.filenames):
+            self._grow(len(self.filenames))
+
+    def _grow(self, rows):
+        # the capacity is doubled, so that appending files is cheap
+        s = np.full((max(rows, 2*len(self.s)),) + self.s.shape[1:], np.nan, dtype=complex)
+        s[:len(self.s)] = self.s
+        self.s = s
+        for fitted_param, values in self.quantity.items():
+            self.quantity[fitted_param] = np.full(s.shape[:2], np.nan, dtype=complex)
+            self.quantity[fitted_param][:len(values)] = values
+
+    @property
+    def params(self):
+        """The parameters in the file names, see params_array."""
+        if self._params is None:
+            self._params = params_array([params_from_filename(filename) for filename in self.filenames])
+        return self._params
+
+    def add(self, filename, network):
+        """Put the spectrum of a file on the shared grid.
+
+        Returns
+        -------
+        False if the spectrum does not cover the shared grid (it is not added)
+        """
+        row = self.index[filename]
+        if self.f is None:
+            step = -(-len(network.f)//self.max_points)
+            self.f = np.asarray(network.f[::step], dtype=float)
+            self.source = grid_key(network.f), step
+            self.z0 = np.asarray(network.z0).flat[0].real
+            self.s = np.full((len(self.filenames), len(self.f)) + network.s.shape[1:], np.nan, dtype=complex)
+        if network.s.shape[1:] != self.s.shape[2:]:
+            return False
+        if grid_key(network.f) == self.source[0]:
+            s = network.s[::self.source[1]]
+        elif Resampler.covers(network.f, self.f):
+            s = Resampler.for_grids(network.f, self.f)(network.s, mode='magphase')
+        else:
+            return False
+        self.s[row] = s
+        self.loaded[row] = True
+        for fitted_param, values in self.quantity.items():
+            values[row] = self._quantity(self.s[row:row+1], fitted_param)[0]
+        return True
+
+    def clear(self):
+        """Remove all spectra (the files are kept)."""
+        self.f = self.s = self.source = None
+        self.loaded[:] = False
+        self.quantity = {}
+
+    def stack(self):
+        """The loaded spectra as a NetworkStack (None if there are none)."""
+        rows = np.flatnonzero(self.loaded)
+        if not len(rows):
+            return None
+        return NetworkStack(self.f, self.s[rows], self.params[rows], [self.filenames[i] for i in rows], self.z0)
+
+    def _quantity(self, s, fitted_param):
+        sign, param, i, j = parse_fitted_param_str(fitted_param)
+        stack = NetworkStack(self.f, s, z0=self.z0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sign*(stack.y if param == 'Y' else stack.s)[:, :, i, j]
+
+    def values(self, fitted_param):
+        """The fitted parameter (e.g. '-Y12') of all files on the shared grid,
+        shape (M, N), NaN where the spectrum is not loaded.
+
+        It is computed for the whole stack at once the first time, and only
+        for the new spectra afterwards.
+        """
+        if self.s is None:
+            return None
+        if fitted_param not in self.quantity:
+            values = np.full(self.s.shape[:2], np.nan, dtype=complex)
+            rows = np.flatnonzero(self.loaded)
+            if len(rows):
+                values[rows] = self._quantity(self.s[rows], fitted_param)
+            self.quantity = {fitted_param: values}      # only the current one is kept
+        return self.quantity[fitted_param][:len(self.filenames)]
+
+    def order(self, param=None):
+        """Rows sorted by a file name parameter (None: in the order of the
+        files), files without the parameter last."""
+        if param is None or param not in (self.params.dtype.names or ()):
+            return np.arange(len(self.filenames))
+        column = self.params[param]
+        if column.dtype.kind == 'f':
+            return np.lexsort((column, np.isnan(column)))
+        return np.argsort(column, kind='mergesort')
+
+    def image(self, fitted_param, component='Magnitude', param=None):
+        """The image of the sweep map.
+
+        Arguments
+        ---------
+        fitted_param : string
+            e.g. '-Y12' (Y in mS)
+        component : string
+            one of COMPONENTS (the magnitude in dB)
+        param : string or None
+            the file name parameter of the rows, see order
+
+        Returns
+        -------
+        (image, order): the image of shape (M, N) (NaN where the spectrum is
+        not loaded) and the file of each row
+        """
+        order = self.order(param)
+        values = self.values(fitted_param)
+        if values is None:
+            return None, order
+        values = values[order]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if component == 'Magnitude':
+                return 20.*np.log10(np.abs(values)), order
+        mult = 1e3 if parse_fitted_param_str(fitted_param)[1] == 'Y' else 1
+        return (values.real if component == 'Real part' else values.imag)*mult, order
+
+
+class SweepMap(QWidget):
+    spectrum_selected = pyqtSignal(int)     # index of the file of a row that was clicked
+    load_all = pyqtSignal()
+    fitted_param = None
+    redraw_delay = 200      # ms, the spectra that are added in the meantime are drawn at once
+
+    def __init__(self, parent=None):
+        super(QWidget, self).__init__(parent)
+        self.grid = SweepGrid()
+        self.order = np.zeros(0, dtype=int)
+        self.current = None     # index of the selected file
+
+        # set up widgets
+        self.cmb_component = QComboBox()
+        self.cmb_component.addItems(COMPONENTS)
+        self.cmb_param = QComboBox()
+        self.btn_loadall = QPushButton('Load all spectra')
+        self.figure = plt.figure()
+        self.ax = self.figure.add_subplot(111)
+        self.ax.set_xlabel('f [GHz]')
+        self.canvas = FigureCanvas(self.figure)
+        self.toolbar = NavigationToolbar(self.canvas, self)
+        self.image = None
+        self.colorbar = None
+        self.marker = self.ax.axhline(0., color='w', lw=1., ls='--', visible=False)
+
+        # set up layout
+        l1 = QHBoxLayout()
+        for w in [QLabel('Show:'), self.cmb_component, QLabel('Rows:'), self.cmb_param, self.btn_loadall]:
+            l1.addWidget(w)
+        l1.addStretch()
+        l2 = QVBoxLayout()
+        l2.addLayout(l1)
+        for w in [self.toolbar, self.canvas]:
+            l2.addWidget(w)
+        self.setLayout(l2)
+
+        # the redraws are delayed, e.g. while the spectra are loaded one after the other
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.redraw)
+
+        # set up connections
+        self.cmb_component.currentIndexChanged.connect(self.schedule_redraw)
+        self.cmb_param.currentIndexChanged.connect(self.schedule_redraw)
+        self.btn_loadall.clicked.connect(self.load_all)
+        self.canvas.mpl_connect('button_press_event', self.clicked)
+
+    def set_dataset(self, filenames):
+        self.grid = SweepGrid(filenames)
+        # keep the parameter of the rows if the files have it, otherwise the first one
+        current = self.param()
+        names = self.grid.params.dtype.names or ()
+        self.cmb_param.blockSignals(True)
+        self.cmb_param.clear()
+        self.cmb_param.addItem('File order')
+        for name in names:
+            self.cmb_param.addItem(name)
+        if current in names:
+            self.cmb_param.setCurrentText(current)
+        elif names:
+            self.cmb_param.setCurrentIndex(1)
+        self.cmb_param.blockSignals(False)
+        self.schedule_redraw()
+
+    @pyqtSlot(str)
+    def new_file_in_dataset(self, filename):
+        self.grid.append(filename)
+        self.schedule_redraw()
+
+    def add(self, filename, network):
+        if filename in self.grid.index and self.grid.add(filename, network):
+            self.schedule_redraw()
+
+    def has(self, filename):
+        return filename in self.grid.index and self.grid.loaded[self.grid.index[filename]]
+
+    def clear(self):
+        # the spectra changed (e.g. the de-embedding), the files are kept
+        self.grid.clear()
+        self.schedule_redraw()
+
+    @pyqtSlot(str)
+    def fitted_param_changed(self, s):
+        self.fitted_param = s
+        self.schedule_redraw()
+
+    def select(self, index):
+        self.current = index
+        self.update_marker()
+        self.canvas.draw_idle()
+
+    def schedule_redraw(self):
+        if not self.timer.isActive():
+            self.timer.start(self.redraw_delay)
+
+    def param(self):
+        return self.cmb_param.currentText() if self.cmb_param.currentIndex() > 0 else None
+
+    def redraw(self):
+        if not self.isVisible() or self.fitted_param is None:
+            return      # drawn when the map is shown
+        image, self.order = self.grid.image(self.fitted_param, self.cmb_component.currentText(), self.param())
+        if image is None:
+            if self.image is not None:
+                self.image.set_visible(False)
+            self.canvas.draw_idle()
+            return
+        extent = (self.grid.f[0]/1e9, self.grid.f[-1]/1e9, len(image)-0.5, -0.5)
+        if self.image is None:
+            self.image = self.ax.imshow(image, aspect='auto', interpolation='nearest', extent=extent)
+            self.colorbar = self.figure.colorbar(self.image, ax=self.ax)
+            # one tick per row at most, labelled with the parameter of the row
+            self.ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+            self.ax.yaxis.set_major_formatter(FuncFormatter(self.row_label))
+        else:
+            self.image.set_data(image)
+            self.image.set_extent(extent)
+            self.image.set_visible(True)
+        finite = image[np.isfinite(image)]
+        if len(finite):
+            self.image.set_clim(finite.min(), finite.max())
+        sign, param, i, j = parse_fitted_param_str(self.fitted_param)
+        unit = ' [dB]' if self.cmb_component.currentIndex() == 0 else (' [mS]' if param == 'Y' else '')
+        self.colorbar.set_label(self.fitted_param + ' ' + self.cmb_component.currentText().lower() + unit)
+        self.ax.set_ylabel(self.param() or 'File')
+        self.update_marker()
+        self.canvas.draw_idle()
+
+    def row_label(self, y, pos=None):
+        # the value of the parameter of the row (or the file)
+        row = int(round(y))
+        if not 0 <= row < len(self.order):
+            return ''
+        param = self.param()
+        if param is None:
+            return str(self.order[row])
+        value = self.grid.params[param][self.order[row]]
+        return '{:g}'.format(value) if isinstance(value, float) else str(value)
+
+    def update_marker(self):
+        rows = np.flatnonzero(self.order == self.current) if self.current is not None else []
+        self.marker.set_visible(len(rows) > 0)
+        if len(rows):
+            self.marker.set_ydata([rows[0], rows[0]])
+
+    def showEvent(self, event):
+        super(SweepMap, self).showEvent(event)
+        self.schedule_redraw()
+
+    def clicked(self, event):
+        # not while zooming or panning
+        if event.inaxes is not self.ax or self.toolbar.mode or event.button != 1:
+            return
+        row = int(round(event.ydata))
+        if 0 <= row < len(self.order):
+            self.spectrum_selected.emit(int(self.order[row]))
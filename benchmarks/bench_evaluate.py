@@ -0,0 +1,44 @@
+"""Benchmark of the batched evaluation of the model functions.
+
+Evaluates the model functions of the shipped models for M sets of parameters
+(e.g. the fitted values of M spectra) on 101 and 2001 frequency points, once with a
+Python loop over the sets and once with
+:meth:`P13pt.spectrumfitter.basemodel.BaseModel.evaluate`.
+
+Usage (from the repository root): PYTHONPATH=. python benchmarks/bench_evaluate.py
+"""
+from __future__ import print_function
+import os
+import timeit
+
+import numpy as np
+
+from P13pt.spectrumfitter.batchfit import load_model_class, new_model
+
+models = os.path.join(os.path.dirname(__file__), '..', 'P13pt', 'spectrumfitter', 'models')
+
+
+def main():
+    print('{:>24} {:>8} {:>6} {:>6} {:>10} {:>12} {:>9}'.format('model', 'function', 'points', 'sets', 'loop [ms]',
+                                                                 'batch [ms]', 'speed-up'))
+    rng = np.random.RandomState(0)
+    for name in ['fec_model_RCLRlo', 'fec_model_CfresQ', 'fec_model_RCLRaCaRasup', 'fec_model_D3_10K',
+                 'reso_alexandre']:
+        model = new_model(load_model_class(os.path.join(models, name + '.py')))
+        func = sorted(n[5:] for n in dir(model) if n.startswith('func_'))[0]
+        for points, count in [(101, 100), (101, 1000), (2001, 10), (2001, 100), (2001, 1000)]:
+            w = 2.*np.pi*np.linspace(1e7, 40e9, points)
+            # the sets of parameters vary around the initial values
+            values = dict((p, model.values[p]*rng.uniform(0.5, 1.5, count)) for p in model.params)
+            rows = [dict((p, values[p][m]) for p in values) for m in range(count)]
+            loop = lambda: [getattr(model, 'func_' + func)(w, **row) for row in rows]
+            batch = lambda: model.evaluate(w, values, func)
+            assert np.allclose(np.array(loop()), batch(), equal_nan=True)
+            t_loop = min(timeit.repeat(loop, number=1, repeat=5))
+            t_batch = min(timeit.repeat(batch, number=1, repeat=5))
+            print('{:>24} {:>8} {:>6} {:>6} {:>10.2f} {:>12.2f} {:>8.1f}x'.format(
+                name, func, points, count, t_loop*1e3, t_batch*1e3, t_loop/t_batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Benchmark of the grid search initializer (BaseModel.grid_search).
+
+Fits spectra with a fit method of a model, whose initial values come from a
+threshold detection of the crossover of the real and imaginary parts, and with
+BaseModel.fit_grid at several grid densities. Shows the success rate and the
+cost per spectrum.
+
+A fit is a success if its relative residual is at most 10% above the best one
+found by any of the methods for that spectrum (and, for generated spectra,
+if the fitted values are within 5% of the true ones).
+
+Without arguments, spectra are generated with random values (log-uniform
+over typical ranges, with 2% noise). Recorded spectra can be used instead:
+
+    PYTHONPATH=. python benchmarks/bench_grid.py [--spectra FOLDER --model MODEL.py --fit-method NAME
+                                                  --params r c rlo [--fitted-param -Y12]]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from P13pt.spectrumfitter.batchfit import load_model_class, new_model, fitted_data, CheckState
+from P13pt.spectrumfitter.preparation import Dataset
+
+models = os.path.join(os.path.dirname(__file__), '..', 'P13pt', 'spectrumfitter', 'models')
+
+# model, fit method, fitted parameters, (min, max) of the generated values
+GENERATED = [
+    ('fec_model_RCLRlo', 'RCRa', ['r', 'c', 'rlo'],
+     dict(r=(100., 20000.), c=(20e-15, 400e-15), l=(0., 0.), rcont=(10., 300.))),
+    ('fec_model_CfresQ', 'CfresQ', ['c', 'fres', 'q'],
+     dict(c=(20e-15, 400e-15), fres=(1e9, 80e9), q=(0.1, 1.), rcont=(0., 0.))),
+]
+
+
+class Quiet(object):
+    # the fit methods print the detected crossover
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def generate(model, ranges, f, count, noise=0.02, seed=0):
+    rng = np.random.RandomState(seed)
+    values = []
+    for m in range(count):
+        v = dict((p, lo if lo == hi else np.exp(rng.uniform(np.log(lo), np.log(hi)))) for p, (lo, hi) in ranges.items())
+        if 'rlo' in model.params:
+            v['rlo'] = v['r']/3. + v.pop('rcont')
+        values.append(v)
+    func, args = model.fitted_function()
+    spectra = [func(2.*np.pi*f, *[v[p] for p in args]) for v in values]
+    spectra = [y*(1. + noise*(rng.randn(len(f)) + 1j*rng.randn(len(f)))) for y in spectra]
+    return spectra, values
+
+
+def run(model, method, f, spectra, params):
+    # the fitted values, relative residuals and time per spectrum
+    values, residuals = [], []
+    start = time.time()
+    for y in spectra:
+        model.reset_values()
+        try:
+            with Quiet():
+                if method == 'grid':
+                    model.fit_grid(f, y, dict((p, CheckState(p in params)) for p in model.params))
+                else:
+                    getattr(model, 'fit_' + method)(f, y)
+        except Exception:
+            pass
+        values.append(dict(model.values))
+        computed = model.evaluate(2.*np.pi*f, model.values)[0]
+        residuals.append(np.linalg.norm(np.nan_to_num(y - computed))/np.linalg.norm(y))
+    return values, np.array(residuals), (time.time() - start)/len(spectra)
+
+
+def compare(name, model, fit_method, f, spectra, params, truth=None, densities=(3, 4, 6, 8, 12)):
+    runs = [(fit_method, None)] + [('grid', d) for d in densities]
+    results = []
+    for method, density in runs:
+        model.grid_density = density or type(model).grid_density
+        results.append(run(model, method, f, spectra, params))
+    best = np.min([residuals for values, residuals, t in results], axis=0)
+    for (method, density), (values, residuals, t) in zip(runs, results):
+        success = residuals <= 1.1*best
+        if truth is not None:
+            success &= np.array([all(abs(v[p]/t_[p] - 1.) < 0.05 for p in params) for v, t_ in zip(values, truth)])
+        label = method if density is None else 'grid {}^{}'.format(density, len(params))
+        print('{:>18} {:>14} {:>8.0f}% {:>12.1f}'.format(name, label, 100.*np.mean(success), 1e3*t))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Success rate and cost of the grid search initializer.')
+    parser.add_argument('--spectra', help='folder with recorded spectra')
+    parser.add_argument('--model', help='model file')
+    parser.add_argument('--fit-method', help='fit method to compare with')
+    parser.add_argument('--params', nargs='+', help='parameters of the grid')
+    parser.add_argument('--fitted-param', default='-Y12', help='fitted parameter (default: -Y12)')
+    parser.add_argument('--count', type=int, default=50, help='number of generated spectra (default: 50)')
+    args = parser.parse_args()
+
+    print('{:>18} {:>14} {:>9} {:>12}'.format('model', 'method', 'success', 'time [ms]'))
+    if args.spectra:
+        dataset = Dataset(args.spectra)
+        networks = [dataset.get_spectrum(i) for i in range(len(dataset))]
+        model = new_model(load_model_class(args.model))
+        compare(os.path.basename(args.model), model, args.fit_method, networks[0].f,
+                [fitted_data(n, args.fitted_param) for n in networks], args.params)
+    else:
+        f = np.linspace(1e7, 40e9, 401)
+        for name, fit_method, params, ranges in GENERATED:
+            model = new_model(load_model_class(os.path.join(models, name + '.py')))
+            spectra, truth = generate(model, ranges, f, args.count)
+            compare(name[10:], model, fit_method, f, spectra, params, truth)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Benchmark of the analytic Jacobians of the FEC models.
+
+Fits spectra with the fit methods of the models, once with the analytic
+Jacobian (grad_admittance, passed to leastsq as Dfun) and once with finite
+differences, and compares the number of evaluations of the objective function
+and of the Jacobian, the wall time and the fitted values.
+
+Without arguments, sweeps of spectra are generated with the model functions
+(with 1% noise). Recorded spectra can be used instead:
+
+    PYTHONPATH=. python benchmarks/bench_jacobian.py [--spectra FOLDER --model MODEL.py
+                                                     --fit-method NAME [--fitted-param -Y12]]
+"""
+from __future__ import print_function
+import os
+import time
+import argparse
+
+import numpy as np
+
+from P13pt.spectrumfitter.batchfit import load_model_class, new_model, fitted_data, takes_checkboxes
+from P13pt.spectrumfitter.preparation import Dataset
+
+models = os.path.join(os.path.dirname(__file__), '..', 'P13pt', 'spectrumfitter', 'models')
+
+# model, fit method, values of the generated spectra (a list means a sweep)
+GENERATED = [
+    ('fec_model_RCLRlo', 'RCRa', dict(r=list(np.linspace(300., 900., 10)), c=200e-15, l=0., rlo=230.)),
+    ('fec_model_CfresQ', 'CfresQ', dict(c=200e-15, fres=list(np.linspace(20e9, 40e9, 10)), q=0.6, rcont=20.)),
+    ('fec_model_RCLRaCaRasup', 'RCRa', dict(r=list(np.linspace(500., 2000., 10)), c=200e-15, l=0., gl=0.,
+                                          ra=200., ca=0., rasup=0.)),
+    ('fec_model_D3_10K', 'RCRa', dict(r=list(np.linspace(500., 2000., 10)), c=200e-15, l=0., gl=0.,
+                                    ra=200., ca=0., rasup=0.)),
+    # all parameters varied at once
+    ('fec_model_D3_10K', 'default', dict(r=list(np.linspace(500., 2000., 10)), c=200e-15, l=100e-12, gl=1e-5,
+                                       ra=200., ca=10e-15, rasup=30.)),
+]
+
+
+class Checked(object):
+    # all parameters are varied by fit methods with check boxes
+    def isChecked(self):
+        return True
+
+
+class Counter(object):
+    def __init__(self, func):
+        self.func = func
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+        return self.func(*args, **kwargs)
+
+
+def generate(model, values, f, noise=0.01, seed=0):
+    rng = np.random.RandomState(seed)
+    func, args = model.fitted_function()
+    n = max(len(v) for v in values.values() if isinstance(v, list))
+    spectra = []
+    for i in range(n):
+        y = func(2.*np.pi*f, *[values[p][i] if isinstance(values[p], list) else values[p] for p in args])
+        spectra.append(y*(1. + noise*(rng.randn(len(f)) + 1j*rng.randn(len(f)))))
+    return spectra
+
+
+def run(model, fit_method, f, spectra, analytic):
+    model.analytic_jacobian = analytic
+    objective = model.objective = Counter(type(model).objective.__get__(model))
+    jacobian = model.jacobian = Counter(type(model).jacobian.__get__(model))
+    results = []
+    start = time.time()
+    for y in spectra:
+        model.reset_values()
+        fit = getattr(model, 'fit_' + fit_method)
+        if takes_checkboxes(fit):
+            fit(f, y, dict((p, Checked()) for p in model.params))
+        else:
+            fit(f, y)
+        results.append(dict(model.values))
+    return time.time() - start, objective.count, jacobian.count, results
+
+
+def compare(name, model, fit_method, f, spectra, repeat=3):
+    t_fd, nfev_fd, njev_fd, fd = min(run(model, fit_method, f, spectra, False) for k in range(repeat))
+    t_an, nfev_an, njev_an, an = min(run(model, fit_method, f, spectra, True) for k in range(repeat))
+    deviation = max(abs(a[p]/b[p] - 1.) for a, b in zip(an, fd) for p in a if b[p] != 0.)
+    print('{:>24} {:>7} {:>12} {:>14} {:>10.3f} {:>10.3f} {:>8.1f}x {:>10.1e}'.format(
+        name, len(spectra), nfev_fd, '{} + {}'.format(nfev_an, njev_an), t_fd, t_an, t_fd/t_an, deviation))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare analytic and finite difference Jacobians.')
+    parser.add_argument('--spectra', help='folder with recorded spectra')
+    parser.add_argument('--model', help='model file')
+    parser.add_argument('--fit-method', help='fit method')
+    parser.add_argument('--fitted-param', default='-Y12', help='fitted parameter (default: -Y12)')
+    args = parser.parse_args()
+
+    print('{:>24} {:>7} {:>12} {:>14} {:>10} {:>10} {:>9} {:>10}'.format(
+        'model', 'spectra', 'nfev (FD)', 'nfev + njev', 'FD [s]', 'exact [s]', 'speed-up', 'deviation'))
+    if args.spectra:
+        dataset = Dataset(args.spectra)
+        networks = [dataset.get_spectrum(i) for i in range(len(dataset))]
+        model = new_model(load_model_class(args.model))
+        compare(os.path.basename(args.model), model, args.fit_method, networks[0].f,
+                [fitted_data(n, args.fitted_param) for n in networks])
+    else:
+        f = np.linspace(1e7, 40e9, 2001)
+        for name, fit_method, values in GENERATED:
+            model = new_model(load_model_class(os.path.join(models, name + '.py')))
+            compare(name, model, fit_method, f, generate(model, values, f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Benchmark of the thru de-embedding for networks with P ports.
+
+Compares the batched de-embedding (:class:`P13pt.rfspectrum.ThruDeembedder`)
+with the frequency point by frequency point reference implementation
+(:meth:`P13pt.rfspectrum.Network.deembed_thru_reference`) for 2, 4, 6 and 8
+ports. The half-thru inverse is calculated once per thru, the de-embedding
+of each DUT is then a few batched matrix operations whose cost per frequency
+point only grows with the size of the matrices, while the reference is
+dominated by the Python loop over the frequency points.
+
+Usage (from the repository root): PYTHONPATH=. python benchmarks/bench_nport_deembedding.py
+"""
+from __future__ import print_function
+import timeit
+
+import numpy as np
+
+from P13pt.rfspectrum import Network, ThruDeembedder, _from_abcd
+
+
+def line_abcd(f, length, z0=50., alpha=2., v=1.5e8):
+    gamma = alpha + 1j*2.*np.pi*f/v
+    abcd = np.empty((len(f), 2, 2), dtype=complex)
+    abcd[:, 0, 0] = abcd[:, 1, 1] = np.cosh(gamma*length)
+    abcd[:, 0, 1] = z0*np.sinh(gamma*length)
+    abcd[:, 1, 0] = np.sinh(gamma*length)/z0
+    return abcd
+
+
+def make_networks(f, nports):
+    """Thru made of P/2 uncoupled lines of different lengths and a DUT."""
+    n = nports//2
+    half_thru = np.zeros((len(f), nports, nports), dtype=complex)
+    for k in range(n):
+        line = line_abcd(f, (200.+50.*k)*1e-6)
+        for i in range(2):
+            for j in range(2):
+                half_thru[:, i*n+k, j*n+k] = line[:, i, j]
+    dut = np.tile(np.eye(nports, dtype=complex), (len(f), 1, 1))
+    dut[:, :n, n:] = 100.*(1. + np.random.rand(n, n))
+    thru = Network(f=f, s=_from_abcd(np.matmul(half_thru, half_thru)))
+    dut = Network(f=f, s=_from_abcd(np.matmul(np.matmul(half_thru, dut), half_thru)))
+    return thru, dut
+
+
+def main():
+    f = np.linspace(1e8, 40e9, 2001)
+    print('{:>6} {:>14} {:>14} {:>14} {:>9} {:>15}'.format(
+        'ports', 'reference [s]', 'half-thru [s]', 'per DUT [s]', 'speed-up', 'per point [us]'))
+    for nports in [2, 4, 6, 8]:
+        thru, dut = make_networks(f, nports)
+        assert np.allclose(dut.deembed_thru_reference(thru).s, ThruDeembedder(thru).deembed(dut).s)
+        t_ref = min(timeit.repeat(lambda: dut.deembed_thru_reference(thru), number=1, repeat=3))
+        # square root and inverse of the thru, done once per thru
+        t_setup = min(timeit.repeat(lambda: ThruDeembedder(thru), number=5, repeat=3))/5
+        deembedder = ThruDeembedder(thru)
+        t_dut = min(timeit.repeat(lambda: deembedder.deembed(dut), number=10, repeat=3))/10
+        print('{:>6} {:>14.4f} {:>14.4f} {:>14.4f} {:>8.1f}x {:>15.2f}'.format(
+            nports, t_ref, t_setup, t_dut, t_ref/t_dut, t_dut/len(f)*1e6))
+
+
+if __name__ == '__main__':
+    main()
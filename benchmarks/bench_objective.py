@@ -0,0 +1,61 @@
+"""Benchmark of the objective function of the shipped FEC models.
+
+Compares the objective that each model used to implement (unpacking the
+parameters by name, discarding the result of np.nan_to_num and allocating a
+residual array filled from temporary arrays) with the generic
+:meth:`P13pt.spectrumfitter.basemodel.BaseModel.objective`, per evaluation and
+for 401 and 2001 frequency points. Most of the time is spent in the model
+function itself, so the cost of an evaluation is shown as the time of the
+model function plus the overhead of the objective around it.
+
+Usage (from the repository root): PYTHONPATH=. python benchmarks/bench_objective.py
+"""
+from __future__ import print_function
+import os
+import timeit
+
+import numpy as np
+from lmfit import Parameters
+
+from P13pt.spectrumfitter.batchfit import load_model_class, new_model
+
+models = os.path.join(os.path.dirname(__file__), '..', 'P13pt', 'spectrumfitter', 'models')
+
+
+def legacy_objective(model, params, x_data, y_data):
+    # the objective as it was implemented in each model file
+    func, args = model.fitted_function()
+    values = [params[p].value for p in args]
+    computed_admittance = func(x_data, *values)
+    np.nan_to_num(computed_admittance)
+    res = np.empty((2, len(y_data)))
+    res[0] = y_data.real - computed_admittance.real
+    res[1] = y_data.imag - computed_admittance.imag
+    return np.ravel(res)
+
+
+def main():
+    print('{:>24} {:>7} {:>14} {:>16} {:>16}'.format('model', 'points', 'function [us]',
+                                                     'overhead before', 'overhead after'))
+    for name in ['fec_model_RCLRlo', 'fec_model_CfresQ', 'fec_model_RCLRaCaRasup', 'fec_model_D3_10K']:
+        model = new_model(load_model_class(os.path.join(models, name + '.py')))
+        params = Parameters()
+        for p in model.params:
+            params.add(p, value=model.values[p])
+        func, args = model.fitted_function()
+        values = [model.values[p] for p in args]
+        for n in [401, 2001]:
+            w = 2.*np.pi*np.linspace(1e7, 40e9, n)
+            y = 1.01*func(w, *values)
+            assert np.allclose(legacy_objective(model, params, w, y), model.objective(params, w, y))
+            number = 2000
+            timing = lambda f: min(timeit.repeat(f, number=number, repeat=7))/number*1e6
+            t_func = timing(lambda: func(w, *values))
+            before = timing(lambda: legacy_objective(model, params, w, y))
+            after = timing(lambda: model.objective(params, w, y))
+            print('{:>24} {:>7} {:>14.2f} {:>13.2f} us {:>13.2f} us'.format(
+                name, n, t_func, before-t_func, after-t_func))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Benchmark of the "P13 standard" spectrum file reader.
+
+Compares :func:`P13pt.rfspectrum.read_p13` with the numpy.genfromtxt based
+reference implementation on files with 1k, 10k and 100k frequency points.
+
+Usage (from the repository root): PYTHONPATH=. python benchmarks/bench_p13_reader.py
+"""
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import timeit
+
+import numpy as np
+
+from P13pt.rfspectrum import read_p13, read_p13_reference
+
+
+def make_file(folder, npoints):
+    filename = os.path.join(folder, 'spectrum_n={}.txt'.format(npoints))
+    table = np.random.rand(9, npoints)
+    table[0] = np.linspace(1e7, 50e9, npoints)
+    np.savetxt(filename, table.T)
+    return filename
+
+
+def main():
+    folder = tempfile.mkdtemp()
+    try:
+        print('{:>8} {:>14} {:>14} {:>9}'.format('points', 'genfromtxt [s]', 'read_p13 [s]', 'speed-up'))
+        for npoints in [1000, 10000, 100000]:
+            filename = make_file(folder, npoints)
+            f, s = read_p13(filename)
+            f_ref, s_ref = read_p13_reference(filename)
+            assert np.array_equal(f, f_ref) and np.array_equal(s, s_ref)
+            number = max(1, 100000//npoints)
+            t_ref = min(timeit.repeat(lambda: read_p13_reference(filename), number=number, repeat=3))/number
+            t_new = min(timeit.repeat(lambda: read_p13(filename), number=number, repeat=3))/number
+            print('{:>8} {:>14.5f} {:>14.5f} {:>8.1f}x'.format(npoints, t_ref, t_new, t_ref/t_new))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
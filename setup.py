@@ -46,5 +46,8 @@ setuptools.setup(
                                   'mdb = P13pt.mdb.mdb:main',
                                   'sscalign = P13pt.sscalign.sscalign:main',
                                   'p13pt-makelinks = P13pt.make_links:main'
-                                  ]}
+                                  ],
+                  'console_scripts': ['p13pt-touchstone = P13pt.convert_touchstone:main',
+                                      'p13pt-fit = P13pt.spectrumfitter.fitsession:main'
+                                      ]}
 )
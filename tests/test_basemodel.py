@@ -0,0 +1,159 @@
+import numpy as np
+from lmfit import Parameters
+
+from P13pt.spectrumfitter.basemodel import BaseModel
+
+
+class Model(BaseModel):
+    params = {'r': [0, 10, 1, 1, 'Ohm'], 'c': [0, 10, 2, 1e-3, 'mF']}
+
+    def func_rc(self, w, r, c):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 1./(r + 1./(1j*w*c))
+
+
+def test_objective():
+    model = Model()
+    assert model.fitted_function()[1] == ('r', 'c')
+    params = Parameters()
+    params.add('r', value=2.)
+    params.add('c', value=1e-3)
+    w = np.linspace(0., 1e3, 11)
+    y = np.nan_to_num(model.func_rc(w, 1., 2e-3))
+
+    res = model.objective(params, w, y)
+    computed = np.nan_to_num(model.func_rc(w, 2., 1e-3))
+    assert not np.isfinite(model.func_rc(w, 2., 1e-3)).all()     # sanitized at w=0
+    assert np.allclose(res, np.concatenate([(y - computed).real, (y - computed).imag]))
+    assert np.allclose(model.objective(params, w, y, part=1), (y - computed).imag)
+
+    # the parameters are found by lmfit
+    from lmfit import minimize
+    fitted = minimize(model.objective, params, args=(w[1:], y[1:])).params
+    assert np.isclose(fitted['r'].value, 1.) and np.isclose(fitted['c'].value, 2e-3)
+
+
+def test_jacobian():
+    import os
+    from P13pt.spectrumfitter.batchfit import load_model_class, new_model
+
+    models = os.path.join(os.path.dirname(__file__), '..', 'P13pt', 'spectrumfitter', 'models')
+    w = 2.*np.pi*np.linspace(1e7, 40e9, 101)
+    for name in ['fec_model_RCLRlo', 'fec_model_CfresQ', 'fec_model_RCLRaCaRasup', 'fec_model_D3_10K']:
+        model = new_model(load_model_class(os.path.join(models, name + '.py')))
+        func, args = model.fitted_function()
+        values = [model.values[p] if model.values[p] else model.params[p][3] for p in args]
+        # the gradient matches central finite differences
+        for k, d in enumerate(model.gradient()(w, *values)):
+            h = 1e-6*values[k]
+            up, down = list(values), list(values)
+            up[k] += h
+            down[k] -= h
+            fd = (func(w, *up) - func(w, *down))/(2.*h)
+            assert np.linalg.norm(d - fd) < 1e-5*np.linalg.norm(fd)
+
+    # the fit converges with the analytic Jacobian
+    model = Model()
+    model.grad_rc = lambda w, r, c: [-model.func_rc(w, r, c)**2, model.func_rc(w, r, c)**2/(1j*w*c*c)]
+    w = np.linspace(1., 1e3, 11)
+    y = model.func_rc(w, 1., 2e-3)
+    params = Parameters()
+    params.add('r', value=2.)
+    params.add('c', value=1e-3)
+    res = model.minimize(params, w, y)
+    assert np.isclose(res.params['r'].value, 1.) and np.isclose(res.params['c'].value, 2e-3)
+    assert res.nfev < model.minimize(params, w, y, Dfun=None).nfev
+
+
+def test_evaluate():
+    import os
+    from P13pt.spectrumfitter.batchfit import load_model_class, new_model
+
+    models = os.path.join(os.path.dirname(__file__), '..', 'P13pt', 'spectrumfitter', 'models')
+    w = 2.*np.pi*np.linspace(1e7, 40e9, 51)
+    for name in ['fec_model_RCLRlo', 'fec_model_CfresQ', 'fec_model_RCLRaCaRasup', 'fec_model_D3_10K',
+                 'reso_alexandre']:
+        model = new_model(load_model_class(os.path.join(models, name + '.py')))
+        # a range of values for each parameter, including 0 where it is allowed
+        values = dict((p, np.linspace(max(model.params[p][0], model.params[p][2]/2.), model.params[p][2], 4)
+                       *model.params[p][3]) for p in model.params)
+        if 'ca' in values:
+            # with and without access resistance and capacitance
+            values['ra'] = np.array([0., 0., 100., 200.])
+            values['ca'] = np.array([0., 10e-15, 0., 10e-15])
+        for func in [n[5:] for n in dir(model) if n.startswith('func_')]:
+            batch = model.evaluate(w, values, func)
+            assert batch.shape == (4, len(w))
+            for m in range(4):
+                expected = getattr(model, 'func_' + func)(w, **dict((p, values[p][m]) for p in values))
+                assert np.allclose(batch[m], expected, rtol=1e-12, equal_nan=True)
+            # scalars are the same for all sets of parameters
+            values1 = dict((p, values[p][1]) for p in values)
+            assert np.allclose(model.evaluate(w, values1, func), batch[1], rtol=1e-12, equal_nan=True)
+
+    # model functions that do not broadcast
+    class Scalar(Model):
+        def func_rc(self, w, r, c):
+            if r == 0.:
+                return 1j*w*c
+            return super(Scalar, self).func_rc(w, r, c)
+    values = dict(r=np.array([0., 1.]), c=1e-3)
+    assert np.allclose(Scalar().evaluate(w, values), [1j*w*1e-3, Model().func_rc(w, 1., 1e-3)])
+
+
+def test_grid_search():
+    from P13pt.spectrumfitter.batchfit import CheckState
+
+    model = Model()
+    # logarithmic grid strictly within the range of the slider
+    grid = model.grid('c', 4)
+    assert len(grid) == 4 and 0. < grid[0] < grid[-1] < 10e-3
+    assert np.allclose(grid[1:]/grid[:-1], grid[1]/grid[0])
+
+    w = np.linspace(1., 1e3, 101)
+    y = model.func_rc(w, 3., 5e-3)
+    values = model.grid_search(w/(2.*np.pi), y)
+    assert abs(values['r']/3. - 1.) < 0.2 and abs(values['c']/5e-3 - 1.) < 0.2
+    # only the parameters of the grid change
+    values = model.grid_search(w/(2.*np.pi), y, ['r'])
+    assert values['c'] == model.values['c'] and values['r'] != model.values['r']
+
+    model.fit_grid(w/(2.*np.pi), y, dict(r=CheckState(True), c=CheckState(True)))
+    assert np.isclose(model.values['r'], 3.) and np.isclose(model.values['c'], 5e-3)
+
+    # the crossover of the data, else of the best point of the grid
+    f, y = w[3:]/(2.*np.pi), y[3:]
+    model.reset_values()
+    below = np.abs(y.real-y.imag) < 0.1
+    assert model.crossover(f, y, ['r', 'c'], threshold=0.1) == f[below][0] and model.values['r'] == 1.
+    fc = model.crossover(f, y, ['r', 'c'], threshold=0.)
+    assert abs(model.values['r']/3. - 1.) < 0.2 and abs(model.values['c']/5e-3 - 1.) < 0.2
+    assert abs(fc*2.*np.pi*3.*5e-3 - 1.) < 0.2
+
+
+def test_fitted_function():
+    import os
+    from P13pt.spectrumfitter.batchfit import FitJob, fit_spectra, load_model_class, model_methods, new_model
+
+    models = os.path.join(os.path.dirname(__file__), '..', 'P13pt', 'spectrumfitter', 'models')
+    model_file = os.path.join(models, 'reso_alexandre.py')
+    # fitted_function is not listed as a fit method
+    assert model_methods(load_model_class(model_file), 'fit_') == ['grid']
+    assert model_methods(load_model_class(os.path.join(models, 'fec_model_CfresQ.py')), 'fit_') == ['CfresQ', 'grid']
+
+    # the model function selected in the fitter, else fitted_func, else the first one
+    model = new_model(load_model_class(model_file))
+    assert model.fitted_function()[0].__name__ == 'func_s11'
+    model.func = model.func_s12
+    assert model.fitted_function()[0].__name__ == 'func_s12'
+    model.func, model.fitted_func = None, 's12'
+    assert model.fitted_function()[0].__name__ == 'func_s12'
+
+    # also in the worker processes
+    f = np.linspace(1e8, 10e9, 201)
+    model = new_model(load_model_class(model_file))
+    values = dict(model.values, r=3000.)
+    y = model.func_s12(2.*np.pi*f, **values)
+    checkboxes = dict((p, p == 'r') for p in model.params)
+    fit, = fit_spectra([FitJob('s12.txt', f, y, model_file, 'grid', checkboxes, None, 's12')], processes=1)
+    assert fit.error is None and np.isclose(fit.values['r'], 3000., rtol=1e-4)
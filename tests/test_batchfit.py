@@ -0,0 +1,188 @@
+import os
+import numpy as np
+
+from P13pt.spectrumfitter.batchfit import FitJob, fit_spectra, load_model_class, new_model
+
+models = os.path.join(os.path.dirname(__file__), '..', 'P13pt', 'spectrumfitter', 'models')
+
+CHECKBOX_MODEL = '''
+import numpy as np
+from P13pt.spectrumfitter.basemodel import BaseModel
+
+class Model(BaseModel):
+    params = {'a': [0, 10, 1, 1, ''], 'b': [0, 10, 1, 1, '']}
+
+    def func_line(self, w, a, b):
+        return a*w + b
+
+    def fit_line(self, f, y, checkboxes):
+        p = np.polyfit(f, y.real, 1)
+        for name, value in zip(['a', 'b'], p):
+            if checkboxes[name].isChecked():
+                self.values[name] = value
+'''
+
+
+def test_fit_spectra(tmpdir):
+    # the builtin models create Qt widgets in their __init__, which is skipped
+    model_file = os.path.join(models, 'fec_model_RCLRlo.py')
+    model = new_model(load_model_class(model_file))
+    f = np.linspace(1e7, 40e9, 401)
+    truth = [dict(r=r, c=200e-15, l=0., rlo=r/3.+30.) for r in [300., 600.]]
+    jobs = [FitJob('r={}.txt'.format(v['r']), f,
+                   model.func_admittance(2.*np.pi*f, v['r'], v['c'], v['l'], v['rlo']),
+                   model_file, 'RCRa', None, None) for v in truth]
+
+    line_file = str(tmpdir.join('line.py'))
+    with open(line_file, 'w') as fh:
+        fh.write(CHECKBOX_MODEL)
+    jobs.append(FitJob('line.txt', f, 2.*f + 3., line_file, 'line', dict(a=True, b=False), dict(b=5.)))
+    jobs.append(FitJob('broken.txt', f, f, line_file, 'missing', None, None))
+
+    results = dict((fit.filename, (fit.values, fit.error)) for fit in fit_spectra(jobs, processes=2))
+    assert sorted(results) == sorted(job.filename for job in jobs)
+    # same result as fitting in this process
+    for job in jobs[:2]:
+        values, error = results[job.filename]
+        assert error is None
+        model.fit_RCRa(job.f, job.y)
+        assert values == model.values
+    values, error = results['line.txt']
+    assert np.isclose(values['a'], 2.) and values['b'] == 5.
+    values, error = results['broken.txt']
+    assert values is None and 'AttributeError' in error
+
+    # cancellation
+    assert list(fit_spectra(jobs, processes=2, poll=lambda: False)) == []
+
+
+def test_fit_window(tmpdir):
+    model_file = str(tmpdir.join('line.py'))
+    with open(model_file, 'w') as fh:
+        fh.write(CHECKBOX_MODEL)
+    f = np.linspace(1e7, 40e9, 101)
+    taken = []
+
+    def jobs():
+        for a in range(6):
+            taken.append(a)
+            yield FitJob('line{}.txt'.format(a), f, a*f + 3., model_file, 'line', dict(a=True, b=True), None)
+
+    # the jobs are taken as the fits complete
+    fits = fit_spectra(jobs(), processes=1, window=2)
+    next(fits)
+    assert len(taken) == 2
+    assert len(list(fits)) == 5 and len(taken) == 6
+
+    # and the fit can be cancelled while they are taken
+    del taken[:]
+    calls = []
+    assert list(fit_spectra(jobs(), processes=1, poll=lambda: len(calls) < 3 and not calls.append(1))) == []
+    assert len(taken) == 3
+
+
+def test_fit_session(tmpdir):
+    from skrf import y2s
+    from P13pt.rfspectrum import Network
+    from P13pt.spectrumfitter.fitsession import fit_session
+    from P13pt.spectrumfitter.load_fitresults import load_fitresults, save_fitresults
+    from test_rfspectrum import save_p13
+
+    model = new_model(load_model_class(os.path.join(models, 'fec_model_RCLRlo.py')))
+    f = np.linspace(1e7, 40e9, 201)
+    dut = tmpdir.mkdir('dut')
+    files = []
+    for vg in [-1, 0, 1]:
+        y = model.func_admittance(2.*np.pi*f, 500.+100.*vg, 200e-15, 0., 200.+30.*vg)
+        ntwk = Network(f=f, s=y2s(np.array([[y+1e-4, -y], [-y, y+1e-4]]).transpose(2, 0, 1)))
+        files.append('Vg={}.txt'.format(vg))
+        save_p13(str(dut.join(files[-1])), ntwk)
+
+    session = str(tmpdir.join('session.txt'))
+    save_fitresults(session, str(dut), files, ra=5., model_file='fec_model_RCLRlo.py', model_func='admittance',
+                    fit_method='RCRa', params=list(model.params), model_params={})
+    output = str(tmpdir.join('results.txt'))
+    results = fit_session(session, output, models=str(tmpdir), processes=2, log=lambda *args: None)
+    assert sorted(results) == sorted(files)
+
+    data, dut_path, thru, dummy, ra, info = load_fitresults(output, readfilenameparams=False, extrainfo=True)
+    assert dut_path == 'dut' and ra == 5. and info['fit_method'] == 'RCRa'
+    assert list(data['filename']) == sorted(files)
+    for i, filename in enumerate(data['filename']):
+        assert float(data['r'][i]) == results[filename]['r']
+
+
+def test_warm_start():
+    from P13pt.spectrumfitter.batchfit import warm_start_stats
+
+    model_file = os.path.join(models, 'fec_model_RCLRlo.py')
+    model = new_model(load_model_class(model_file))
+    f = np.linspace(1e7, 40e9, 401)
+    jobs = []
+    for vg in [0.4, -0.4, 0., 0.2, 0.6, -0.2]:     # not in sweep order
+        r, rlo = (5000., 2000.) if vg == 0.4 else (500.+100.*vg, 200.+30.*vg)
+        y = model.func_admittance(2.*np.pi*f, r, 200e-15, 0., rlo)
+        jobs.append(FitJob('Vg={}.txt'.format(vg), f, y, model_file, 'RCRa', None, None))
+
+    fits = list(fit_spectra(jobs, processes=1, warm_start='Vg'))
+    assert [fit.filename for fit in fits] == ['Vg={}.txt'.format(vg) for vg in [-0.4, -0.2, 0., 0.2, 0.4, 0.6]]
+    # the outlier at Vg=0.4 makes the warm start diverge for it or the next spectrum
+    starts = [fit.start for fit in fits]
+    assert starts[:4] == ['cold', 'warm', 'warm', 'warm'] and sorted(starts[4:]) == ['fallback', 'warm']
+    for fit in fits[1:4]:
+        vg = float(fit.filename[3:-4])
+        assert np.isclose(fit.values['r'], 500.+100.*vg, rtol=1e-3)
+        assert fit.values['l'] == 0.    # not varied by the fit method
+    stats = warm_start_stats(fits)
+    assert stats['warm'] == 4 and stats['fallback'] == 1
+    assert stats['nfev'] == sum(fit.nfev for fit in fits) and stats['nfev_saved'] > 0
+
+
+def test_fit_cache(tmpdir):
+    from P13pt.spectrumfitter.fitcache import FitCache
+
+    model_file = str(tmpdir.join('line.py'))
+    with open(model_file, 'w') as fh:
+        fh.write(CHECKBOX_MODEL)
+    f = np.linspace(1e7, 40e9, 101)
+    jobs = [FitJob('line{}.txt'.format(a), f, a*f + 3., model_file, 'line', dict(a=True, b=True), None)
+            for a in [1., 2.]]
+    cache_file = str(tmpdir.join('cache', 'fitcache.json'))
+
+    cache = FitCache(cache_file)
+    fits = dict((fit.filename, fit) for fit in fit_spectra(jobs, processes=1, cache=cache, model_func='line'))
+    assert set(fit.start for fit in fits.values()) == {'cold'}
+    cache.save()
+
+    # the cache is persistent
+    cache = FitCache(cache_file)
+    for fit in fit_spectra(jobs, processes=1, cache=cache, model_func='line'):
+        assert fit.start == 'cached' and fit.values == fits[fit.filename].values
+    # the results are only stored under the inputs of the fit
+    restarted = jobs[0]._replace(values=fits[jobs[0].filename].values)
+    assert [fit.start for fit in fit_spectra([restarted], processes=1, cache=cache, model_func='line')] == ['cold']
+    assert len(cache) == 3
+
+    # any change of the inputs is a miss
+    changed = [jobs[0]._replace(y=jobs[0].y + 1.), jobs[0]._replace(checkboxes=dict(a=True, b=False)),
+               jobs[0]._replace(fit_method='missing')]
+    assert [fit.start for fit in fit_spectra(changed, processes=1, cache=cache, model_func='line')] == ['cold']*3
+    assert [fit.start for fit in fit_spectra(jobs[:1], processes=1, cache=cache, model_func='other')] == ['cold']
+    for kws in [dict(warm_start='Vg'), dict(divergence=3.)]:
+        assert [fit.start for fit in fit_spectra(jobs[1:], processes=1, cache=cache, model_func='line', **kws)] \
+            == ['cold']
+    with open(model_file, 'a') as fh:
+        fh.write('\n# modified\n')
+    assert [fit.start for fit in fit_spectra(jobs[:1], processes=1, cache=cache, model_func='line')] == ['cold']
+
+    # a broken cache file is ignored
+    for text in ['{"a": 1', '{"a": 1}', '[["a", 1]]', '3']:
+        with open(cache_file, 'w') as fh:
+            fh.write(text)
+        assert len(FitCache(cache_file)) == 0
+
+    # the least recently stored entries are dropped
+    cache = FitCache(max_entries=2)
+    for key in 'abca':
+        cache.put(key, dict(x=1.))
+    assert list(cache.results) == ['c', 'a'] and 'b' not in cache
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+
+from P13pt.spectrumfitter.batchfit import load_model_class, new_model
+from P13pt.spectrumfitter.globalfit import global_fit
+
+models = os.path.join(os.path.dirname(__file__), '..', 'P13pt', 'spectrumfitter', 'models')
+
+
+def test_global_fit():
+    model = new_model(load_model_class(os.path.join(models, 'fec_model_RCLRlo.py')))
+    f = np.linspace(1e7, 40e9, 201)
+    truth = [dict(r=r, c=200e-15, l=50e-12, rlo=r/3.+40.) for r in [300., 500., 700., 900.]]
+    y = np.array([model.func_admittance(2.*np.pi*f, v['r'], v['c'], v['l'], v['rlo']) for v in truth])
+    initial = [dict(r=1.2*v['r'], c=250e-15, l=80e-12, rlo=v['rlo']) for v in truth]
+
+    res = global_fit(model, f, y, initial, shared=['c', 'l'], fixed=['rlo'])
+    assert res.success
+    for values, v in zip(res.values, truth):
+        for p in ['r', 'c', 'l']:
+            assert np.isclose(values[p], v[p], rtol=1e-4)
+        assert values['rlo'] == v['rlo']
+    # the shared parameters are the same for all spectra
+    assert len(set(values['l'] for values in res.values)) == 1
+
+
+def test_global_fit_access():
+    # a per-spectrum access resistance
+    model = new_model(load_model_class(os.path.join(models, 'fec_model_D3_10K.py')))
+    f = np.linspace(1e7, 40e9, 201)
+    truth = [dict(r=r, c=200e-15, l=0., gl=0., ra=100.+r/10., ca=0., rasup=0.) for r in [500., 1000., 1500.]]
+    func, args = model.fitted_function()
+    y = np.array([func(2.*np.pi*f, *[v[p] for p in args]) for v in truth])
+    initial = [dict(v, r=0.8*v['r'], ra=150.) for v in truth]
+
+    res = global_fit(model, f, y, initial, shared=['c'], fixed=['l', 'gl', 'ca', 'rasup'])
+    for values, v in zip(res.values, truth):
+        assert np.isclose(values['r'], v['r'], rtol=1e-4) and np.isclose(values['ra'], v['ra'], rtol=1e-4)
+
+
+def test_global_fit_single_value_range():
+    # a parameter whose slider range is a single value is not varied
+    model = new_model(load_model_class(os.path.join(models, 'fec_model_RCLRlo.py')))
+    model.params = dict(model.params, l=[50., 50., 50., 1e-12, 'pH'])
+    f = np.linspace(1e7, 40e9, 201)
+    truth = [dict(r=r, c=200e-15, l=50e-12, rlo=r/3.+40.) for r in [300., 500.]]
+    y = np.array([model.func_admittance(2.*np.pi*f, v['r'], v['c'], v['l'], v['rlo']) for v in truth])
+    initial = [dict(r=1.2*v['r'], c=250e-15, l=80e-12, rlo=v['rlo']) for v in truth]
+
+    res = global_fit(model, f, y, initial, shared=['c', 'l'], fixed=['rlo'])
+    assert res.success
+    for values, v in zip(res.values, truth):
+        assert values['l'] == 50e-12 and np.isclose(values['r'], v['r'], rtol=1e-4)
+
+    # cancellation
+    calls = []
+    assert global_fit(model, f, y, initial, shared=['c'], poll=lambda: len(calls) < 3 and not calls.append(1)) is None
+    assert len(calls) == 3
+
+
+def test_global_fit_func():
+    # the model function selected in the fitter, not the default one (s11)
+    model = new_model(load_model_class(os.path.join(models, 'reso_alexandre.py')))
+    f = np.linspace(1e8, 10e9, 201)
+    truth = [dict(model.values, r=r) for r in [2000., 4000.]]
+    y = model.evaluate(2.*np.pi*f, dict(model.values, r=np.array([v['r'] for v in truth])), 's12')
+    initial = [dict(v, r=3000.) for v in truth]
+
+    res = global_fit(model, f, y, initial, fixed=['l', 'c', 'tau', 'ra', 'length'], func='s12')
+    for values, v in zip(res.values, truth):
+        assert np.isclose(values['r'], v['r'], rtol=1e-4)
+    res = global_fit(model, f, y, initial, fixed=['l', 'c', 'tau', 'ra', 'length'])
+    assert not np.isclose(res.values[0]['r'], 2000., rtol=1e-2)
@@ -0,0 +1,61 @@
+import os
+import numpy as np
+
+from P13pt.spectrumfitter.imageexport import ExportJob, export_images
+
+models = os.path.join(os.path.dirname(__file__), '..', 'P13pt', 'spectrumfitter', 'models')
+
+
+def test_export_images(tmpdir):
+    model_file = os.path.join(models, 'fec_model_RCLRlo.py')
+    f = np.linspace(1e7, 40e9, 101)
+    y = np.zeros((len(f), 2, 2), dtype=complex)
+    y[:, 0, 1] = y[:, 1, 0] = -1e-3/(1. + 1j*f/1e10)
+    s = y/(1. + y)
+    values = dict(r=500., c=200e-15, l=0., rlo=200.)
+    jobs = [ExportJob(str(tmpdir.join('Vg={}.'.format(vg) + fmt)), f, s, y, 'Vg={}'.format(vg), figure, style,
+                      '-Y12', model_file, 'admittance', values if figure == 'fit' else None, (6.4, 4.8), 50)
+            for vg, fmt, figure, style in [(0, 'png', 'fit', 'MP'), (1, 'svg', 'y', 'RI'), (2, 'pdf', 's', 'MP')]]
+    jobs.append(jobs[0]._replace(filename=str(tmpdir.join('broken.png')), model_func='missing'))
+
+    results = dict((r.filename, r) for r in export_images(jobs, processes=2))
+    assert sorted(results) == sorted(job.filename for job in jobs)
+    for job in jobs[:3]:
+        assert results[job.filename].error is None and not results[job.filename].skipped
+        assert os.path.getsize(job.filename) > 0
+    assert 'AttributeError' in results[jobs[3].filename].error
+
+    # only the images that are not up to date are drawn again
+    jobs[1] = jobs[1]._replace(title='Vg=1.0')
+    results = dict((r.filename, r.skipped) for r in export_images(jobs, processes=2))
+    assert results == {jobs[0].filename: True, jobs[1].filename: False, jobs[2].filename: True,
+                       jobs[3].filename: False}
+    assert not any(r.skipped for r in export_images(jobs[:1], force=True))
+
+    # cancellation
+    assert list(export_images(jobs[3:], processes=2, poll=lambda: False)) == []
+
+    # the jobs are taken as there is room in the window
+    taken = []
+
+    def generate():
+        for k in range(6):
+            taken.append(k)
+            yield jobs[1]._replace(filename=str(tmpdir.join('w{}.png'.format(k))))
+    results = export_images(generate(), processes=1, window=2)
+    assert not next(results).skipped and len(taken) == 2
+    assert len(list(results)) == 5 and len(taken) == 6
+
+
+def test_nport_panels():
+    from P13pt.spectrumfitter.imageexport import get_figure
+
+    f = np.linspace(1e7, 40e9, 101)
+    s = np.arange(len(f)*9).reshape(-1, 3, 3)*(1. + 1j)
+    job = ExportJob('s.png', f, s, s, '', 's', 'RI', '-Y12', None, None, None, (6.4, 4.8), 50)
+    # one panel per element of the S matrix
+    figure, panels, created = get_figure(job)
+    assert len(panels) == 9 and panels[5][0].get_ylabel() == '$S_{23}$'
+    assert np.all(panels[5][4] == s[:, 1, 2])
+    figure, panels, created = get_figure(job._replace(s=s[:, :2, :2]))
+    assert len(panels) == 4 and created
@@ -0,0 +1,142 @@
+import os
+import numpy as np
+import pytest
+from skrf import y2s
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+
+from P13pt.rfspectrum import Network
+from P13pt.spectrumfitter.plotter import Plotter
+
+
+def network(f, r):
+    y12 = -1./(r + 1./(1j*2.*np.pi*f*200e-15))
+    y = np.array([[1e-4 - y12, y12], [y12, 1e-4 - y12]]).transpose(2, 0, 1)
+    return Network(f=f, s=y2s(y))
+
+
+class Model(object):
+    # the fitted function and values, as used by Plotter.plot_fit
+    def __init__(self, r):
+        self.values = dict(r=r)
+
+    def func(self, w, r):
+        return 1./(r + 1./(1j*w*200e-15))
+
+
+class Calls(object):
+    # counts the calls of a method
+    def __init__(self, obj, name):
+        self.count = 0
+        method = getattr(obj, name)
+
+        def wrapper(*args, **kwargs):
+            self.count += 1
+            return method(*args, **kwargs)
+        setattr(obj, name, wrapper)
+
+
+@pytest.fixture
+def plotter():
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    plotter = Plotter()
+    plotter.display_style = 'RI'
+    plotter.fitted_param_changed('-Y12')
+    yield plotter
+    plotter.deleteLater()
+    app.processEvents()
+
+
+def test_plot(plotter):
+    f = np.linspace(1e9, 40e9, 101)
+    ntwk = network(f, 500.)
+    plotter.plot(ntwk, {'Vg': '0'})
+    (ln1, ln2), = plotter.lines['fit']
+    assert np.allclose(ln1.get_xdata(), f/1e9)
+    assert np.allclose(ln1.get_ydata(), -ntwk.y[:, 0, 1].real*1e3)
+    assert np.allclose(ln2.get_ydata(), -ntwk.y[:, 0, 1].imag*1e3)
+    assert plotter.ax.get_title() == 'Vg=0' and plotter.dirty == {'y', 's'}
+
+    # the model lines are drawn on the background of the figure
+    draw, blit = Calls(plotter.canvas, 'draw'), Calls(plotter.canvas, 'blit')
+    for r in [400., 450.]:
+        plotter.plot_fit(Model(r))
+        assert np.allclose(plotter.line_r.get_ydata(), Model(r).func(2.*np.pi*f, r).real*1e3)
+        assert np.allclose(plotter.line_i.get_ydata(), Model(r).func(2.*np.pi*f, r).imag*1e3)
+    assert draw.count == 0 and blit.count == 2
+
+    # not after a resize of the canvas
+    plotter.figure.set_size_inches(5., 3., forward=False)
+    plotter.plot_fit(Model(500.))
+    assert draw.count == 1 and plotter.background_bounds == plotter.figure.bbox.bounds
+    plotter.plot_fit(Model(400.))
+    assert draw.count == 1 and blit.count == 3
+
+    # nor after a tab switch
+    plotter.setCurrentIndex(1)
+    plotter.setCurrentIndex(0)
+    plotter.plot_fit(Model(500.))
+    assert draw.count == 2
+
+
+def test_hidden_tabs(plotter):
+    f = np.linspace(1e9, 40e9, 101)
+    ntwk = network(f, 500.)
+    plotter.setCurrentIndex(1)
+    plotter.plot(ntwk, {'Vg': '0'})
+    assert plotter.dirty == {'fit', 's'}
+    assert np.allclose(plotter.lines['y'][1][0].get_ydata(), ntwk.y[:, 0, 1].real*1e3)
+
+    # the model is drawn when the fitting figure is shown
+    draw = Calls(plotter.canvas, 'draw')
+    plotter.plot_fit(Model(400.))
+    assert draw.count == 0
+    plotter.setCurrentIndex(0)
+    assert draw.count == 1 and plotter.dirty == {'s'}
+    assert np.allclose(plotter.lines['fit'][0][0].get_ydata(), -ntwk.y[:, 0, 1].real*1e3)
+    plotter.setCurrentIndex(2)
+    assert np.allclose(plotter.lines['s'][3][1].get_ydata(), ntwk.s[:, 1, 1].imag) and not plotter.dirty
+
+    # the hidden figures are also cleared
+    plotter.clear()
+    assert plotter.dirty == {'fit', 'y'} and len(plotter.lines['s'][0][0].get_xdata()) == 0
+    for index in [0, 1]:
+        plotter.setCurrentIndex(index)
+        assert len(plotter.lines[['fit', 'y'][index]][0][0].get_xdata()) == 0
+    assert len(plotter.line_r.get_xdata()) == 0 and plotter.ax.get_title() == '' and not plotter.dirty
+
+
+def test_save_fig(plotter, tmpdir):
+    f = np.linspace(1e9, 40e9, 101)
+    plotter.plot(network(f, 500.), {'Vg': '0'})
+    images = []
+    for r in [400., 200., 400.]:
+        plotter.plot_fit(Model(r))
+        images.append(str(tmpdir.join('fit{}.png'.format(len(images)))))
+        plotter.save_fig(images[-1])
+    # the saved figures contain the model curve
+    data = [open(filename, 'rb').read() for filename in images]
+    assert data[0] != data[1] and data[0] == data[2]
+    assert plotter.line_r.get_animated() and not plotter.saving
+
+    # the background is not replaced while saving
+    background = plotter.background
+    plotter.plot_fit(Model(300.))
+    assert plotter.background is background
+
+
+def test_nport(plotter):
+    from skrf import Network as SkrfNetwork
+    f = np.linspace(1e9, 40e9, 101)
+    s = 0.1*np.arange(len(f)*9).reshape(-1, 3, 3)/(len(f)*9)*(1. + 1j)
+    plotter.setCurrentIndex(2)
+    plotter.plot(SkrfNetwork(f=f, s=s, f_unit='Hz'), {'Vg': '0'})
+    # one panel per element of the S matrix
+    assert len(plotter.lines['s']) == 9 and plotter.axes['s'][5][0].get_ylabel() == '$S_{23}$'
+    assert np.allclose(plotter.lines['s'][5][0].get_ydata(), s[:, 1, 2].real)
+    plotter.setCurrentIndex(1)
+    assert len(plotter.lines['y']) == 9
+
+    plotter.plot(network(f, 500.), {'Vg': '0'})
+    assert len(plotter.lines['y']) == 4 and len(plotter.figure_y.axes) == 8
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from P13pt.rfspectrum import Network, ThruDeembedder
+from P13pt.spectrumfitter.preparation import prepare_spectrum, DeembeddingError
+from test_rfspectrum import thru_and_dut, rc_abcd
+from skrf import a2s as abcd2s
+
+
+def test_prepare_spectrum(thru_and_dut):
+    thru, dut, bare = thru_and_dut
+    deembedder = ThruDeembedder(thru)
+    assert np.allclose(prepare_spectrum(dut, deembedder).s, bare.s)
+
+    # dummy on a different grid, contact resistance
+    f = np.linspace(5e7, 41e9, 300)
+    dummy = Network(f=f, s=abcd2s(rc_abcd(f, r=1e3)))
+    prepared = prepare_spectrum(dut, deembedder, dummy, ra=10.)
+    y = bare.y - Network(f=bare.f, s=abcd2s(rc_abcd(bare.f, r=1e3))).y
+    assert np.allclose(prepared.y[:, 0, 0], 1./(1./y[:, 0, 0] - 10.), rtol=1e-3)
+    assert np.allclose(prepared.y[:, 0, 1], 1./(1./y[:, 0, 1] + 10.), rtol=1e-3)
+
+    narrow = Network(f=dut.f[10:-10], s=dut.s[10:-10])
+    with pytest.raises(DeembeddingError) as error:
+        prepare_spectrum(dut, ThruDeembedder(narrow))
+    assert error.value.stage == 'thru'
+
+
+def test_spectrum_cache(thru_and_dut):
+    from P13pt.spectrumfitter.preparation import SpectrumCache, network_nbytes
+    _, dut, bare = thru_and_dut
+    size = network_nbytes(dut)
+    cache = SpectrumCache(budget=2.5*size)
+    for name in 'abc':
+        cache.put(name, Network(f=dut.f, s=dut.s))
+    assert cache.keys() == ['b', 'c'] and cache.evictions == 1
+    assert cache.get('a') is None and cache.get('b') is not None
+    cache.put('d', Network(f=dut.f, s=dut.s))
+    assert cache.keys() == ['b', 'd']
+    # the Y matrix is calculated after caching, which is noticed on access
+    cache.get('d').y
+    cache.get('d')
+    assert cache.keys() == ['d'] and cache.nbytes > size
+    assert cache.stats()['hits'] == 3 and cache.stats()['misses'] == 1
+    cache.set_budget(1)
+    assert len(cache) == 1
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_spectrum_pipeline(thru_and_dut):
+    from P13pt.spectrumfitter.preparation import SpectrumPipeline
+    thru, dut, bare = thru_and_dut
+    dummy = Network(f=dut.f, s=abcd2s(rc_abcd(dut.f, r=1e3)))
+    loaded = []
+
+    def load():
+        loaded.append(1)
+        return Network(f=dut.f, s=dut.s)
+
+    pipeline = SpectrumPipeline()
+    pipeline.configure(thru=ThruDeembedder(thru), dummy=dummy, ra=10.)
+    prepared = pipeline.prepare('dut', load)
+    assert np.allclose(prepared.y, prepare_spectrum(dut, ThruDeembedder(thru), dummy, 10.).y)
+    assert pipeline.prepare('dut', load) is prepared and len(loaded) == 1
+    assert sorted(pipeline.cache.keys()) == [('dummy', 'dut'), ('ra', 'dut'), ('raw', 'dut'), ('thru', 'dut')]
+
+    # a new contact resistance only redoes the last stage
+    generation = pipeline.generation
+    assert pipeline.configure(ra=10.) is None and pipeline.generation == generation
+    assert pipeline.configure(ra=0.) == 'ra'
+    assert pipeline.lookup('dut')[0] == 3 and pipeline.prepared() == ['dut']
+    assert np.allclose(pipeline.prepare('dut', load).y, bare.y - dummy.y)
+
+    # switching off the dummy keeps the thru de-embedded spectrum
+    assert pipeline.configure(dummy=None, ra=5.) == 'dummy'
+    assert sorted(pipeline.cache.keys()) == [('raw', 'dut'), ('thru', 'dut')]
+    assert np.allclose(pipeline.prepare('dut', load).y, prepare_spectrum(bare, ra=5.).y)
+    assert len(loaded) == 1
@@ -0,0 +1,419 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+from P13pt.rfspectrum import (Network, ThruDeembedder, sqrtm_2x2, read_p13,
+                               read_p13_reference)
+from skrf import a2s as abcd2s
+
+
+def line_abcd(f, length, z0=60., alpha=2., v=1.5e8):
+    """ABCD matrix of a lossy transmission line."""
+    gamma = alpha + 1j*2.*np.pi*f/v
+    abcd = np.empty((len(f), 2, 2), dtype=complex)
+    abcd[:, 0, 0] = np.cosh(gamma*length)
+    abcd[:, 0, 1] = z0*np.sinh(gamma*length)
+    abcd[:, 1, 0] = np.sinh(gamma*length)/z0
+    abcd[:, 1, 1] = np.cosh(gamma*length)
+    return abcd
+
+
+def rc_abcd(f, r=300., c=150e-15):
+    """ABCD matrix of a series resistor followed by a shunt capacitor."""
+    w = 2.*np.pi*f
+    abcd = np.empty((len(f), 2, 2), dtype=complex)
+    abcd[:, 0, 0] = 1. + 1j*w*r*c
+    abcd[:, 0, 1] = r
+    abcd[:, 1, 0] = 1j*w*c
+    abcd[:, 1, 1] = 1.
+    return abcd
+
+
+def save_p13(filename, ntwk):
+    """Save a network in the "P13 standard" format."""
+    columns = [ntwk.f]
+    for i, j in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+        columns += [ntwk.s[:, i, j].real, ntwk.s[:, i, j].imag]
+    np.savetxt(filename, np.array(columns).T)
+
+
+@pytest.fixture
+def thru_and_dut():
+    f = np.linspace(1e8, 40e9, 401)
+    half_thru = line_abcd(f, 300e-6)
+    dut = rc_abcd(f)
+    thru = Network(f=f, s=abcd2s(np.matmul(half_thru, half_thru)))
+    embedded = Network(f=f, s=abcd2s(np.matmul(np.matmul(half_thru, dut), half_thru)),
+                       params={'Vg': '0.1'})
+    return thru, embedded, Network(f=f, s=abcd2s(dut))
+
+
+def test_sqrtm_2x2(thru_and_dut):
+    from scipy.linalg import sqrtm
+    from skrf import s2a as s2abcd
+    thru, dut, _ = thru_and_dut
+    m = s2abcd(thru.s)
+    root = sqrtm_2x2(m)
+    assert np.allclose(np.matmul(root, root), m)
+    assert np.allclose(root, np.array([sqrtm(x) for x in m]))
+
+
+def test_deembed_thru_matches_reference(thru_and_dut):
+    thru, dut, bare = thru_and_dut
+    fast = dut.deembed_thru(thru)
+    reference = dut.deembed_thru_reference(thru)
+    assert np.allclose(fast.s, reference.s)
+    assert np.allclose(fast.s, bare.s)
+    assert np.allclose(fast.f, dut.f)
+    assert fast.params == dut.params
+    # the original network must not be modified
+    assert not np.allclose(dut.s, fast.s)
+
+
+def test_thru_deembedder_stack(thru_and_dut):
+    thru, dut, bare = thru_and_dut
+    deembedder = ThruDeembedder(thru)
+    stack = np.array([dut.s, dut.s, bare.s])
+    deembedded = deembedder.deembed_s(stack)
+    assert deembedded.shape == stack.shape
+    assert np.allclose(deembedded[0], bare.s)
+    assert np.allclose(deembedded[2], deembedder.deembed(bare).s)
+
+
+def test_thru_deembedder_cache(tmp_path, thru_and_dut):
+    thru, dut, _ = thru_and_dut
+    filename = str(tmp_path / 'thru.txt')
+    save_p13(filename, thru)
+    thru = Network(filename)
+    assert ThruDeembedder.for_thru(thru) is ThruDeembedder.for_thru(Network(filename))
+    # networks that were not read from a file are not cached
+    assert ThruDeembedder.for_thru(dut) is not ThruDeembedder.for_thru(dut)
+    assert dut.deembed_thru(thru).file is None
+
+    # requested concurrently by worker threads
+    from concurrent.futures import ThreadPoolExecutor
+    ThruDeembedder._cache.clear()
+    with ThreadPoolExecutor(8) as pool:
+        deembedders = list(pool.map(lambda k: ThruDeembedder.for_thru(Network(filename)), range(32)))
+    assert all(d is deembedders[0] for d in deembedders)
+
+    # the de-embedders for other grids are bounded
+    deembedder = deembedders[0]
+    grids = [np.linspace(thru.f[0], thru.f[-1], 50+k) for k in range(deembedder.grid_cache_size+3)]
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(deembedder.on_grid, grids))
+    assert len(deembedder._on_grid) == deembedder.grid_cache_size
+    assert deembedder.on_grid(grids[-1]) is deembedder.on_grid(grids[-1])
+
+
+def test_read_p13(tmp_path, thru_and_dut):
+    _, dut, _ = thru_and_dut
+    filename = str(tmp_path / 'dut.txt')
+    save_p13(filename, dut)
+    f, s = read_p13(filename)
+    f_ref, s_ref = read_p13_reference(filename)
+    assert np.array_equal(f, f_ref) and np.array_equal(s, s_ref)
+    assert np.allclose(s, dut.s)
+
+    # comments and column headers
+    with open(filename) as fid:
+        text = fid.read()
+    with open(str(tmp_path / 'dut.dat'), 'w') as fid:
+        fid.write('# comment\n\nf s11r s11i s12r s12i s21r s21i s22r s22i\n' + text)
+    ntwk = Network(str(tmp_path / 'dut.dat'))
+    assert np.array_equal(ntwk.s, s)
+    assert ntwk.name == 'dut'
+
+    with open(filename, 'w') as fid:
+        fid.write('1 2 3 4\n5 6 7 8\n')
+    with pytest.raises(Exception):
+        read_p13(filename)
+
+    # invalid numbers, also in the last one, without changing the warning filters
+    import warnings
+    filters = list(warnings.filters)
+    for bad in ['1 2 3 4 5 6 7 8 9\n1 2 x 4 5 6 7 8 9\n', '1 2 3 4 5 6 7 8 9\n1 2 3 4 5 6 7 8 9x\n']:
+        with open(filename, 'w') as fid:
+            fid.write(bad)
+        with pytest.raises(Exception):
+            read_p13(filename)
+    assert warnings.filters == filters
+
+
+@pytest.fixture
+def sidecar_cache():
+    from P13pt.rfspectrum import spectrum_cache
+    settings = spectrum_cache.enabled, spectrum_cache.directory, spectrum_cache.local, spectrum_cache.min_age
+    spectrum_cache.enabled, spectrum_cache.directory, spectrum_cache.local, spectrum_cache.min_age = True, None, True, 0.
+    yield spectrum_cache
+    spectrum_cache.enabled, spectrum_cache.directory, spectrum_cache.local, spectrum_cache.min_age = settings
+
+
+def test_sidecar_cache(tmp_path, monkeypatch, sidecar_cache, thru_and_dut):
+    import P13pt.rfspectrum
+    _, dut, bare = thru_and_dut
+    filename = str(tmp_path / 'dut_Vg=0.1.txt')
+    save_p13(filename, dut)
+    ntwk = Network(filename)
+    assert os.path.exists(sidecar_cache.path(filename))
+    assert ntwk.params == {'dut': None, 'Vg': '0.1'}
+
+    # the second time, the file is not parsed
+    def fail(*args):
+        raise AssertionError('file should not be parsed')
+    monkeypatch.setattr(P13pt.rfspectrum, 'read_p13', fail)
+    assert np.array_equal(Network(filename).s, ntwk.s)
+    monkeypatch.undo()
+
+    # a rewritten file invalidates the sidecar
+    save_p13(filename, bare)
+    os.utime(filename, (1e9, 1e9))
+    assert np.allclose(Network(filename).s, bare.s)
+
+    # separate directory
+    sidecar_cache.local, sidecar_cache.directory = False, str(tmp_path / 'cache')
+    Network(filename)
+    assert os.path.dirname(sidecar_cache.path(filename)) == sidecar_cache.directory
+    assert os.path.exists(sidecar_cache.path(filename))
+
+    # by default, nothing is written to the data folder
+    from P13pt.rfspectrum import SidecarCache
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'user_cache'))
+    monkeypatch.setattr(sys, 'platform', 'linux')
+    for setting in ['', 'on']:
+        monkeypatch.setenv('P13PT_SPECTRUM_CACHE', setting)
+        path = SidecarCache.from_env().path(filename)
+        assert os.path.dirname(path) == str(tmp_path / 'user_cache' / 'P13pt' / 'spectra')
+    monkeypatch.setenv('P13PT_SPECTRUM_CACHE', 'local')
+    assert os.path.dirname(SidecarCache.from_env().path(filename)) == str(tmp_path / '.p13cache')
+    monkeypatch.setenv('P13PT_SPECTRUM_CACHE', 'off')
+    assert not SidecarCache.from_env().enabled
+    monkeypatch.undo()
+
+    # a file that was modified just now is not cached
+    sidecar_cache.min_age = 60.
+    filename = str(tmp_path / 'new.txt')
+    save_p13(filename, bare)
+    Network(filename)
+    assert not os.path.exists(sidecar_cache.path(filename))
+
+
+def test_network_stack(tmp_path, thru_and_dut):
+    from P13pt.rfspectrum import NetworkStack
+    thru, dut, bare = thru_and_dut
+    files = []
+    for vg in [0.3, -0.1, 0.1]:
+        files.append(str(tmp_path / '2020-01-01_12h00m00s_Vg={}_dut.txt'.format(vg)))
+        save_p13(files[-1], dut)
+    stack = NetworkStack.from_files(files)
+    assert stack.s.shape == (3, len(dut.f), 2, 2)
+    assert stack.params['Vg'].dtype == float and stack.params['dut'].all()
+    assert np.allclose(stack.y[1], dut.y)
+    assert np.allclose(stack.abcd[2], Network(files[2]).a)
+
+    deembedded = stack.deembed_thru(thru)
+    assert np.allclose(deembedded.s, bare.s[None])
+    assert np.array_equal(deembedded.sort_by('Vg').params['Vg'], [-0.1, 0.1, 0.3])
+    selected = deembedded.select(Vg=0.1)
+    assert len(selected) == 1 and selected.names == [os.path.basename(files[2])[:-4]]
+    ntwk = selected[0]
+    assert np.allclose(ntwk.s, bare.s) and ntwk.params['Vg'] == 0.1
+
+    stack.y = stack.y - stack.y[0]
+    assert np.allclose(stack.y, 0.)
+
+
+def test_convert_to_touchstone(tmp_path, thru_and_dut):
+    from P13pt.rfspectrum import convert_to_touchstone, convert_folder_to_touchstone
+    _, dut, _ = thru_and_dut
+    folder = tmp_path / 'p13'
+    folder.mkdir()
+    for i in range(3):
+        save_p13(str(folder / 'dut_{}.txt'.format(i)), dut)
+    filename = str(folder / 'dut_0.txt')
+
+    convert_to_touchstone(filename, str(tmp_path / 'dut.s2p'), chunksize=7)
+    assert np.allclose(Network(str(tmp_path / 'dut.s2p')).s, dut.s)
+    # the values are written as they are in the original file
+    with open(filename) as old, open(str(tmp_path / 'dut.s2p')) as new:
+        old_rows = [l.split() for l in old if not l.startswith('#')]
+        new_rows = [l.split() for l in new if l[0] not in '#!']
+    assert new_rows == [[r[k] for k in [0, 1, 2, 5, 6, 3, 4, 7, 8]] for r in old_rows]
+
+    converted = convert_folder_to_touchstone(str(folder), str(tmp_path / 's2p'), processes=2)
+    assert len(converted) == 3
+    assert np.allclose(Network(converted[2]).s, dut.s)
+    # up to date files are skipped
+    assert convert_folder_to_touchstone(str(folder), str(tmp_path / 's2p')) == []
+
+
+def test_convert_touchstone_script(tmp_path, thru_and_dut, monkeypatch):
+    from P13pt import convert_touchstone
+    _, dut, _ = thru_and_dut
+    filename = str(tmp_path / 'dut.txt')
+    save_p13(filename, dut)
+    # blank lines between the comments
+    with open(filename) as f:
+        text = f.read()
+    with open(filename, 'w') as f:
+        f.write('\n# comment\n\n' + text)
+
+    newfilename = str(tmp_path / 'dut.s2p')
+    for args, converted in [([], True), ([], False), (['-f'], True)]:
+        if os.path.exists(newfilename):
+            os.utime(newfilename, (os.path.getmtime(filename) + 10.,)*2)
+        mtime = os.path.getmtime(newfilename) if os.path.exists(newfilename) else None
+        monkeypatch.setattr(sys, 'argv', ['p13pt-touchstone'] + args + [filename])
+        convert_touchstone.main()
+        assert (os.path.getmtime(newfilename) != mtime) == converted
+    assert np.allclose(Network(newfilename).s, dut.s)
+    with open(newfilename) as f:
+        assert f.readline() == '! comment\n'
+
+
+def test_resampler(thru_and_dut):
+    from P13pt.rfspectrum import Resampler
+    thru, _, _ = thru_and_dut
+    f = np.linspace(2e8, 39e9, 333)
+    resampler = Resampler.for_grids(thru.f, f)
+    assert Resampler.for_grids(thru.f, f) is resampler
+    # linear interpolation is exact for linear data
+    data = (2.+1j)*thru.f[:, None]*np.ones((1, 3))
+    assert np.allclose(resampler(data, axis=0), (2.+1j)*f[:, None])
+    assert np.allclose(np.abs(resampler(data, axis=0, mode='magphase')), np.sqrt(5.)*f[:, None])
+    with pytest.raises(ValueError):
+        Resampler(f, thru.f)
+
+    # de-embedding with a thru measured on a different grid
+    half_thru = line_abcd(f, 300e-6)
+    dut = Network(f=f, s=abcd2s(np.matmul(np.matmul(half_thru, rc_abcd(f)), half_thru)))
+    deembedded = ThruDeembedder(thru).on_grid(f).deembed(dut)
+    assert np.allclose(deembedded.s, abcd2s(rc_abcd(f)), atol=1e-3)
+    assert np.allclose(thru.resample(f).s, abcd2s(np.matmul(half_thru, half_thru)), atol=1e-3)
+
+
+def test_memoized_representations(thru_and_dut):
+    from skrf import s2y
+    _, dut, bare = thru_and_dut
+    Network.reset_conversion_stats()
+    y = dut.y
+    assert dut.y is y and np.allclose(y, s2y(dut.s, dut.z0))
+    assert Network.conversion_stats == {'conversions': 1, 'avoided': 1}
+    y = y.copy()    # the cached array is modified in place below
+
+    # Y becomes authoritative, S and Z are derived from it
+    dut.y -= bare.y
+    assert Network.conversion_stats['conversions'] == 2
+    assert np.allclose(dut.y, y - bare.y)
+    assert np.allclose(dut.s, Network(f=dut.f, s=dut.s).s)
+    assert np.allclose(dut.z, np.linalg.inv(dut.y))
+    assert np.allclose(Network(f=dut.f, s=dut.s).y, y - bare.y)
+
+    # changing the port impedance keeps S
+    s = dut.s
+    dut.z0 = 25.
+    assert dut.s is s and not np.allclose(dut.y, y - bare.y)
+
+    # in place modifications need an explicit invalidation
+    dut.s[:, 0, 1] = 0.
+    dut.invalidate()
+    assert np.allclose(dut.y, s2y(dut.s, dut.z0))
+    assert dut._with_s(bare.s).y is not dut.y
+
+    # the statistics are counted correctly by concurrent threads
+    from concurrent.futures import ThreadPoolExecutor
+    Network.reset_conversion_stats()
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda k: [Network(f=dut.f[:2], s=dut.s[:2]).y for _ in range(200)], range(8)))
+    assert Network.conversion_stats == {'conversions': 1600, 'avoided': 0}
+
+
+def test_multi_spectrum_file(tmp_path, thru_and_dut):
+    from P13pt.rfspectrum import NetworkStack, convert_to_stack
+    thru, dut, bare = thru_and_dut
+    filename = str(tmp_path / 'sweep.txt')
+    with open(filename, 'w') as fid:
+        fid.write('# sweep over Vg\n')
+        for vg, ntwk in [(0.1, dut), (0.2, bare)]:
+            save_p13(str(tmp_path / 'tmp.txt'), ntwk)
+            fid.write('# 2020-01-01_12h00m00s_Vg={}\n'.format(vg))
+            fid.write(open(str(tmp_path / 'tmp.txt')).read())
+        # no comment line, the frequency restarts
+        fid.write(open(str(tmp_path / 'tmp.txt')).read())
+
+    stack = NetworkStack.from_multi_spectrum_file(filename)
+    assert isinstance(stack.s, np.memmap) and stack.s.shape == (3, len(dut.f), 2, 2)
+    assert np.allclose(stack.f, dut.f)
+    assert np.allclose(stack.s[0], dut.s) and np.allclose(stack.s[2], bare.s)
+    assert stack.names == ['2020-01-01_12h00m00s_Vg=0.1', '2020-01-01_12h00m00s_Vg=0.2', 'sweep_2']
+    assert np.allclose(stack.params['Vg'][:2], [0.1, 0.2]) and np.isnan(stack.params['Vg'][2])
+    assert np.allclose(stack.select(Vg=0.2)[0].s, bare.s)
+    cropped = stack[1:].crop(1e9, 2e9)
+    assert isinstance(cropped.s, np.memmap) and cropped.f.min() >= 1e9 and cropped.f.max() <= 2e9
+    # small chunks give the same result
+    other = NetworkStack.from_stack_folder(convert_to_stack(filename, str(tmp_path / 'other'), chunksize=7))
+    assert np.array_equal(other.s, stack.s)
+
+    with open(filename, 'a') as fid:
+        fid.write('# Vg=0.3\n1 0 0 0 0 0 0 0 0\n')
+    os.utime(filename, (1e9, 1e9))
+    with pytest.raises(Exception):
+        NetworkStack.from_multi_spectrum_file(filename)
+
+
+def block_diag_abcd(first, second):
+    """Block ABCD matrix of two uncoupled 2-port networks."""
+    abcd = np.zeros((len(first), 4, 4), dtype=complex)
+    for i in range(2):
+        for j in range(2):
+            abcd[:, 2*i, 2*j] = first[:, i, j]
+            abcd[:, 2*i+1, 2*j+1] = second[:, i, j]
+    return abcd
+
+
+def test_nport(tmp_path, monkeypatch):
+    from skrf import s2a as s2abcd
+    from P13pt import convert_touchstone
+    from P13pt.rfspectrum import s2abcd_block, abcd2s_block, sqrtm_stack, convert_to_touchstone
+    f = np.linspace(1e8, 40e9, 201)
+    # the block conversions coincide with scikit-rf for 2-port networks
+    s = abcd2s(rc_abcd(f))
+    assert np.allclose(s2abcd_block(s), s2abcd(s))
+    assert np.allclose(abcd2s_block(s2abcd(s)), s)
+
+    # 4-port: two coupled lines (mixed by a series impedance matrix and a
+    # shunt admittance matrix) between two uncoupled lines
+    half_thru = block_diag_abcd(line_abcd(f, 300e-6), line_abcd(f, 200e-6, z0=45.))
+    w = 2.*np.pi*f[:, None, None]
+    z = np.array([[100., 20.], [20., 80.]]) + 1j*w*np.array([[1e-10, 2e-11], [2e-11, 1e-10]])
+    y = 1j*w*np.array([[1e-13, -2e-14], [-2e-14, 1e-13]])
+    dut = np.empty((len(f), 4, 4), dtype=complex)
+    dut[:, :2, :2] = np.eye(2) + np.matmul(z, y)
+    dut[:, :2, 2:] = z
+    dut[:, 2:, :2] = y
+    dut[:, 2:, 2:] = np.eye(2)
+    assert np.allclose(s2abcd_block(abcd2s_block(dut)), dut)
+    assert np.allclose(sqrtm_stack(np.matmul(half_thru, half_thru)), half_thru)
+
+    thru = Network(f=f, s=abcd2s_block(np.matmul(half_thru, half_thru)))
+    embedded = Network(f=f, s=abcd2s_block(np.matmul(np.matmul(half_thru, dut), half_thru)))
+    deembedded = embedded.deembed_thru(thru)
+    assert np.allclose(deembedded.s, abcd2s_block(dut))
+    assert np.allclose(embedded.deembed_thru_reference(thru).s, deembedded.s)
+
+    # reading and writing 4-port files
+    filename = str(tmp_path / 'dut.txt')
+    table = np.empty((len(f), 33))
+    table[:, 0] = f
+    table[:, 1::2] = embedded.s.reshape(len(f), 16).real
+    table[:, 2::2] = embedded.s.reshape(len(f), 16).imag
+    np.savetxt(filename, table)
+    assert np.allclose(Network(filename).s, embedded.s)
+    convert_to_touchstone(filename, str(tmp_path / 'dut.s4p'))
+    assert np.allclose(Network(str(tmp_path / 'dut.s4p')).s, embedded.s)
+    # also with the script, which picks the extension
+    os.remove(str(tmp_path / 'dut.s4p'))
+    monkeypatch.setattr(sys, 'argv', ['p13pt-touchstone', filename])
+    convert_touchstone.main()
+    assert np.allclose(Network(str(tmp_path / 'dut.s4p')).s, embedded.s)
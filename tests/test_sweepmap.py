@@ -0,0 +1,38 @@
+import numpy as np
+from skrf import y2s
+
+from P13pt.rfspectrum import Network
+from P13pt.spectrumfitter.sweepmap import SweepGrid
+
+
+def network(f, vg):
+    y12 = -1e-3*(2. + vg)/(1. + 1j*f/1e10)
+    y = np.array([[1e-4 - y12, y12], [y12, 1e-4 - y12]]).transpose(2, 0, 1)
+    return Network(f=f, s=y2s(y))
+
+
+def test_sweep_grid():
+    f = np.linspace(1e9, 40e9, 391)
+    grid = SweepGrid(['Vg=1.txt', 'Vg=-1.txt', 'Vg=0.txt'], max_points=100)
+    assert grid.values('-Y12') is None
+    assert grid.add('Vg=1.txt', network(f, 1.))
+    # decimated to at most max_points frequencies
+    assert len(grid.f) <= 100 and grid.f[0] == f[0]
+    image, order = grid.image('-Y12', 'Real part', 'Vg')
+    assert list(order) == [1, 2, 0]
+    assert np.all(np.isnan(image[:2])) and np.allclose(image[2], 3./(1. + (grid.f/1e10)**2))
+
+    # a spectrum on another grid is resampled, one that does not cover the grid is not added
+    assert grid.add('Vg=-1.txt', network(np.linspace(0., 40e9, 801), -1.))
+    assert not grid.add('Vg=0.txt', network(np.linspace(5e9, 40e9, 391), 0.))
+    values = grid.values('-Y12')
+    assert np.allclose(values[1], network(grid.f, -1.).y[:, 0, 1]*-1., rtol=1e-3)
+    assert len(grid.stack()) == 2
+
+    # files appended later
+    grid.append('Vg=2.txt')
+    assert grid.add('Vg=2.txt', network(f, 2.))
+    image, order = grid.image('+S21', 'Magnitude', 'Vg')
+    assert image.shape == (4, len(grid.f)) and list(order) == [1, 2, 0, 3]
+    assert np.allclose(image[3], 20.*np.log10(np.abs(network(grid.f, 2.).s[:, 1, 0])))
+    assert np.isnan(image[1]).all()